@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+"""
+Deterministic generator of headed TSV files: the same arguments make the same file.
+
+    python benchmarks/generate.py [-r ROWS] [-c COLUMNS] [-k KEYS] [-s SKEW] [--sorted FRACTION]
+
+COLUMNS are name:kind, the kinds being key (one of KEYS keys, Zipf-distributed with the
+exponent SKEW, 0 is uniform), int, float, bool and str. The rows are sorted by the key
+columns, then all but the FRACTION of them are displaced; fully sorted files declare
+their ORDER.
+"""
+import sys
+import random
+import argparse
+from bisect import bisect
+
+KINDS = {
+    'key': 'str',
+    'int': 'int',
+    'float': 'float',
+    'bool': 'bool',
+    'str': 'str',
+}
+
+DEFAULT_COLUMNS = "key:key,qty:int,price:float,paid:bool,comment:str"
+
+
+def parse_columns(columns):
+    """ List of (name, kind) of name:kind,... """
+    parsed = []
+    for column in columns.split(","):
+        name, _, kind = column.strip().partition(":")
+        if kind not in KINDS:
+            raise ValueError("Unknown column kind '%s', one of %s expected" %
+                             (kind, ", ".join(sorted(KINDS))))
+        parsed.append((name, kind))
+    return parsed
+
+
+def header(columns, sortedness=1.0):
+    keys = [name for name, kind in columns if kind == 'key']
+    fields = ", ".join(name if KINDS[kind] == 'str' else "%s:%s" % (name, KINDS[kind])
+                       for name, kind in columns)
+    if keys and sortedness >= 1:
+        return "# %s # ORDER: %s" % (fields, ", ".join(keys))
+    return "# %s" % fields
+
+
+def key_sampler(rng, keys, skew):
+    """ Sampler of key numbers: number n has weight 1 / (n + 1) ** skew """
+    total = 0.0
+    cumulative = []
+    for number in xrange(keys):
+        total += 1.0 / (number + 1) ** skew
+        cumulative.append(total)
+    return lambda: min(bisect(cumulative, rng.random() * total), keys - 1)
+
+
+def value_makers(rng, columns, keys, skew):
+    words = ["alpha", "beta", "gamma", "delta", "epsilon", "zeta", "eta", "theta"]
+    sample_key = key_sampler(rng, keys, skew)
+    makers = {
+        # fixed width, so that the text order is the number order
+        'key': lambda: "k%08d" % sample_key(),
+        'int': lambda: str(rng.randint(-1000, 1000000)),
+        'float': lambda: repr(round(rng.uniform(0, 1000), 3)),
+        'bool': lambda: "1" if rng.random() < 0.5 else "0",
+        'str': lambda: " ".join(rng.choice(words) for _ in xrange(rng.randint(1, 4))),
+    }
+    return [makers[kind] for name, kind in columns]
+
+
+def rows(count, columns, keys=1000, skew=0.0, sortedness=1.0, seed=1):
+    """ Rows of values (strings) of the columns """
+    rng = random.Random(seed)
+    makers = value_makers(rng, columns, keys, skew)
+    result = [[make() for make in makers] for _ in xrange(count)]
+    key_indices = [index for index, (name, kind) in enumerate(columns) if kind == 'key']
+    if key_indices:
+        result.sort(key=lambda row: [row[index] for index in key_indices])
+        if sortedness < 1:
+            for index in xrange(count):
+                if rng.random() >= sortedness:
+                    other = rng.randrange(count)
+                    result[index], result[other] = result[other], result[index]
+    return result
+
+
+def generate(output, count, columns, keys=1000, skew=0.0, sortedness=1.0, seed=1):
+    output.write("%s\n" % header(columns, sortedness))
+    data = rows(count, columns, keys, skew, sortedness, seed)
+    for start in xrange(0, count, 65536):
+        output.write("".join("%s\n" % "\t".join(row) for row in data[start:start + 65536]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a synthetic headed TSV to stdout.")
+    parser.add_argument('-r', '--rows', type=int, default=100000)
+    parser.add_argument('-c', '--columns', default=DEFAULT_COLUMNS,
+                        help="name:kind,... with kinds key, int, float, bool, str, "
+                             "default is %s" % DEFAULT_COLUMNS)
+    parser.add_argument('-k', '--keys', type=int, default=1000, help="Distinct keys, default 1000")
+    parser.add_argument('-s', '--skew', type=float, default=0.0,
+                        help="Zipf exponent of the key frequencies, default 0 is uniform")
+    parser.add_argument('--sorted', type=float, default=1.0, metavar="FRACTION",
+                        help="Fraction of rows left in key order, default 1")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    generate(sys.stdout, args.rows, parse_columns(args.columns), args.keys, args.skew,
+             args.sorted, args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""
+Rows per second of parse_file and parse_batches, before (the generic loop it replaced) and after.
+
+    python benchmarks/parse_file.py [ROWS]
+"""
+import os
+import sys
+import time
+from itertools import izip
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from tabkit.header import parse_header
+from tabkit.utils import parse_file, parse_batches, xsplit
+
+REPEAT = 3
+
+
+def parse_file_before(stream, data_desc):
+    """ The loop parse_file used to run: a split generator and conversion of every field """
+    RowClass = data_desc.row_class()
+    rowlen = len(data_desc)
+    for line in stream:
+        values = [f.type(v) for v, f in izip(xsplit(line.rstrip("\n")), data_desc)]
+        if len(values) < rowlen:
+            values += [f.type() for f in data_desc.fields[len(values):]]
+        yield RowClass(*values)
+
+
+def rows_per_second(parse, lines):
+    best = None
+    for _ in xrange(REPEAT):
+        start = time.time()
+        for _ in parse(lines):
+            pass
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(lines) / best
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    data_desc = parse_header("# name, qty:int, price:float, tag, paid:bool, comment")
+    lines = ["item%d\t%d\t%f\ttag%d\t%d\tsome text\n" % (i, i, i / 3.0, i % 10, i % 2)
+             for i in xrange(rows)]
+
+    cases = [
+        ("before", lambda lines: parse_file_before(lines, data_desc)),
+        ("after", lambda lines: parse_file(lines, data_desc=data_desc)),
+        ("strict", lambda lines: parse_file(lines, data_desc=data_desc, strict=True)),
+        ("tuples", lambda lines: parse_file(lines, data_desc=data_desc, tuples=True)),
+        ("batches", lambda lines: parse_batches(lines, data_desc=data_desc)),
+    ]
+    for name, parse in cases:
+        print "%-8s %10.0f rows/s" % (name, rows_per_second(parse, lines))
+
+
+if __name__ == '__main__':
+    main()
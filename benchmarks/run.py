@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+"""
+Benchmark suite: throughput of the tools and of the library hot paths on generated data.
+
+    python benchmarks/run.py [-r ROWS] [--repeat N] [-o RESULTS] [--baseline FILE]
+                             [--threshold FRACTION] [--save-baseline] [SCENARIO ...]
+
+The results are a headed TSV of rows/s, bytes/s, CPU time and peak RSS per scenario, the best
+of the repeated runs. They are compared with the baseline (benchmarks/baseline.tsv by default,
+recorded with --save-baseline): a scenario slower by more than the threshold, or taking more
+memory by more than the threshold and RSS_SLACK, is a regression and the suite fails.
+
+The datasets are generated and every scenario runs in processes of their own, started by
+benchmarks/spawn.py, so that the peak RSS is that of the scenario, not of the runner.
+
+The baseline holds for the machine and the ROWS it was recorded with, record it anew on
+another machine and after intended changes of performance.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import resource
+import argparse
+import tempfile
+import subprocess
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS, os.pardir))
+
+from tabkit.header import parse_header
+from tabkit.utils import parse_file, Writer
+
+BASELINE = os.path.join(BENCHMARKS, "baseline.tsv")
+GENERATE = os.path.join(BENCHMARKS, "generate.py")
+SPAWN = os.path.join(BENCHMARKS, "spawn.py")
+# first argument of run.py running a library scenario in a process of its own
+LIBRARY_ARG = '--library'
+RESULTS_HEADER = ("# scenario, rows:int, bytes:int, seconds:float, rows_per_sec:float, "
+                  "bytes_per_sec:float, cpu_seconds:float, peak_rss_kb:int")
+# memory growth below this is noise of the allocator and the interpreter
+RSS_SLACK = 4096
+
+# datasets: file name, arguments of generate.py but the row and key counts, share of the rows
+DATASETS = {
+    'sorted': (['--skew', '1'], 1.0),
+    'shuffled': (['--sorted', '0', '--seed', '2'], 1.0),
+    'labels': (['--columns', 'key:key,label:str', '--seed', '3'], 0.1),
+}
+
+# tool scenarios: name, arguments of tabkit.scripts, datasets read
+TOOLS = [
+    ('tcat', ['cat'], ['sorted']),
+    ('tcut', ['cut', '-f', 'key,price'], ['sorted']),
+    ('tsrt', ['sort', '-k', 'price:num'], ['shuffled']),
+    ('tjoin', ['join', '-1', 'key', '-2', 'key'], ['sorted', 'labels']),
+    ('tmap_awk', ['map', '-f', 'paid', '-o', 'key;total=qty*price'], ['sorted']),
+    ('tgrp_awk', ['group', '-g', 'key', '-o', 'n=count();qty=sum(qty);price=max(price)'],
+     ['sorted']),
+    ('tpretty', ['pretty', '-x'], ['sorted']),
+]
+
+
+def bench_parse_file(paths):
+    with open(paths[0]) as stream:
+        for row in parse_file(stream):
+            pass
+
+
+def bench_writer(paths):
+    with open(paths[0]) as stream:
+        rows = parse_file(stream, tuples=True)
+        data_desc = rows.data_desc
+        rows = list(rows)
+    with tempfile.TemporaryFile() as output:
+        start = measure()
+        Writer(output, data_desc).writerows(rows)
+        output.flush()
+        return start
+
+
+def bench_parse_header(paths):
+    with open(paths[0]) as stream:
+        header = stream.readline()
+    count = count_rows(paths[0])
+    start = measure()
+    for _ in xrange(count):
+        parse_header(header)
+    return start
+
+
+# library scenarios: name, function of the dataset paths, datasets read; the function returns
+# the measure() its hot part started with, if there is a setup not to count
+LIBRARY = [
+    ('parse_file', bench_parse_file, ['sorted']),
+    ('Writer', bench_writer, ['sorted']),
+    ('parse_header', bench_parse_header, ['sorted']),
+]
+
+
+def count_rows(path):
+    with open(path) as f:
+        return sum(1 for line in f) - 1
+
+
+def data_bytes(path):
+    with open(path) as f:
+        return os.path.getsize(path) - len(f.readline())
+
+
+def measure():
+    """ Wall clock and CPU time of the process so far """
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return time.time(), usage.ru_utime + usage.ru_stime
+
+
+def make_datasets(directory, rows):
+    """ Paths of the datasets, written by generate.py: the runner doesn't hold the data """
+    paths = {}
+    for name, (args, share) in sorted(DATASETS.items()):
+        paths[name] = os.path.join(directory, "%s.tsv" % name)
+        command = [sys.executable, GENERATE, '--rows', str(max(1, int(rows * share))),
+                   '--keys', str(max(1, rows // 100))] + args
+        with open(paths[name], 'w') as output:
+            subprocess.check_call(command, stdout=output)
+    return paths
+
+
+def spawn(command, stdout):
+    """ Seconds, CPU seconds and peak RSS of the command run by spawn.py, its children included """
+    env = dict(os.environ, PYTHONPATH=os.path.join(BENCHMARKS, os.pardir))
+    with tempfile.NamedTemporaryFile(prefix="tabkit_bench_") as result:
+        subprocess.check_call([sys.executable, '-S', SPAWN, result.name] + command,
+                              stdout=stdout, env=env)
+        seconds, cpu_seconds, rss, status = json.load(open(result.name))
+    if status:
+        raise RuntimeError("%s failed with status %d" % (" ".join(command), status))
+    return seconds, cpu_seconds, rss
+
+
+def run_tool(args, paths):
+    """ Seconds, CPU seconds and peak RSS of the tool, its children included """
+    with open(os.devnull, 'w') as devnull:
+        return spawn([sys.executable, '-m', 'tabkit.scripts'] + args + paths, devnull)
+
+
+def run_library(function, paths):
+    """ Seconds, CPU seconds and peak RSS of the function run in a process of its own """
+    with tempfile.TemporaryFile() as measured:
+        _, _, rss = spawn([sys.executable, os.path.abspath(__file__), LIBRARY_ARG,
+                           function.__name__] + paths, measured)
+        measured.seek(0)
+        seconds, cpu_seconds = json.load(measured)
+    return seconds, cpu_seconds, rss
+
+
+def library_main(name, paths):
+    """ Run the library function, write the seconds and CPU seconds of its hot part as JSON """
+    function = dict((function.__name__, function) for _, function, _ in LIBRARY)[name]
+    start = measure()
+    start = function(paths) or start
+    end = measure()
+    json.dump([end[0] - start[0], end[1] - start[1]], sys.stdout)
+
+
+def run_scenarios(names, paths, repeat):
+    """ Results of the scenarios: dicts of the fields of RESULTS_HEADER """
+    scenarios = [(name, run_tool, args, datasets) for name, args, datasets in TOOLS]
+    scenarios.extend((name, run_library, function, datasets)
+                     for name, function, datasets in LIBRARY)
+    for name, run, target, datasets in scenarios:
+        if names and name not in names:
+            continue
+        inputs = [paths[dataset] for dataset in datasets]
+        runs = [run(target, inputs) for _ in xrange(repeat)]
+        seconds, cpu_seconds, _ = min(runs)
+        rows = sum(count_rows(path) for path in inputs)
+        size = sum(data_bytes(path) for path in inputs)
+        yield {
+            'scenario': name,
+            'rows': rows,
+            'bytes': size,
+            'seconds': seconds,
+            'rows_per_sec': rows / seconds,
+            'bytes_per_sec': size / seconds,
+            'cpu_seconds': cpu_seconds,
+            'peak_rss_kb': max(rss for _, _, rss in runs),
+        }
+
+
+def write_results(output, results):
+    output.write("%s\n" % RESULTS_HEADER)
+    for result in results:
+        output.write("%(scenario)s\t%(rows)d\t%(bytes)d\t%(seconds).4f\t%(rows_per_sec).1f\t"
+                     "%(bytes_per_sec).1f\t%(cpu_seconds).4f\t%(peak_rss_kb)d\n" % result)
+    output.flush()
+
+
+def compare(results, baseline_path, threshold):
+    """ Report the changes against the baseline to stderr, the number of regressions """
+    with open(baseline_path) as baseline_file:
+        baseline = dict((row.scenario, row) for row in parse_file(baseline_file))
+    regressions = 0
+    for result in results:
+        base = baseline.get(result['scenario'])
+        if base is None:
+            sys.stderr.write("%-12s no baseline\n" % result['scenario'])
+            continue
+        if base.rows != result['rows']:
+            sys.stderr.write("%-12s baseline of %d rows, not comparable\n" %
+                             (result['scenario'], base.rows))
+            continue
+        speed = result['rows_per_sec'] / base.rows_per_sec - 1
+        rss = float(result['peak_rss_kb']) / base.peak_rss_kb - 1
+        slower = speed < -threshold
+        bigger = rss > threshold and result['peak_rss_kb'] - base.peak_rss_kb > RSS_SLACK
+        status = "REGRESSION" if slower or bigger else "ok"
+        regressions += slower or bigger
+        sys.stderr.write("%-12s %+6.1f%% rows/s  %+6.1f%% peak RSS  %s\n" %
+                         (result['scenario'], speed * 100, rss * 100, status))
+    if regressions:
+        sys.stderr.write("%d REGRESSION(S) beyond %.0f%% against %s\n" %
+                         (regressions, threshold * 100, baseline_path))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the benchmarks, write the results as TSV.")
+    parser.add_argument('scenarios', metavar='SCENARIO', nargs="*",
+                        help="Scenarios to run, all by default: %s" % ", ".join(
+                            name for name, _, _ in TOOLS + LIBRARY))
+    parser.add_argument('-r', '--rows', type=int, default=100000,
+                        help="Rows of the main datasets, default 100000")
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="Runs per scenario, the best counts, default 5")
+    parser.add_argument('-o', '--output', type=argparse.FileType('w'), default=sys.stdout,
+                        help="Write the results to OUTPUT instead of stdout")
+    parser.add_argument('--baseline', default=BASELINE,
+                        help="Baseline to compare with, default is benchmarks/baseline.tsv")
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help="Relative slowdown or memory growth failing the suite, default 0.25")
+    parser.add_argument('--save-baseline', action="store_true",
+                        help="Record the results as the baseline instead of comparing")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="tabkit_bench_")
+    try:
+        paths = make_datasets(directory, args.rows)
+        results = list(run_scenarios(args.scenarios, paths, args.repeat))
+    finally:
+        shutil.rmtree(directory)
+
+    write_results(args.output, results)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as baseline:
+            write_results(baseline, results)
+    elif os.path.exists(args.baseline) and compare(results, args.baseline, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == [LIBRARY_ARG]:
+        library_main(sys.argv[2], sys.argv[3:])
+    else:
+        main()
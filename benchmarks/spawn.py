@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+"""
+Run a command, write its seconds, CPU seconds, peak RSS and wait status to RESULT as JSON.
+
+    python -S benchmarks/spawn.py RESULT COMMAND [ARG ...]
+
+The peak RSS of a process survives exec: a command forked right from the benchmark runner
+would report the memory of the runner as its own. This small process forks it instead. The
+CPU time and peak RSS cover the command and the children it waited for.
+"""
+import os
+import sys
+import json
+import time
+
+
+def main():
+    result, command = sys.argv[1], sys.argv[2:]
+    start = time.time()
+    pid = os.fork()
+    if not pid:
+        try:
+            os.execvp(command[0], command)
+        finally:
+            os._exit(127)
+    _, status, usage = os.wait4(pid, 0)
+    seconds = time.time() - start
+    with open(result, 'w') as output:
+        json.dump([seconds, usage.ru_utime + usage.ru_stime, usage.ru_maxrss, status], output)
+
+
+if __name__ == '__main__':
+    main()
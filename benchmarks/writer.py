@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+"""
+Rows per second of Writer, a call per row (before) and writerows (after).
+
+    python benchmarks/writer.py [ROWS]
+"""
+import os
+import sys
+import time
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from tabkit.header import parse_header
+from tabkit.utils import Writer
+
+REPEAT = 3
+
+
+def rows_per_second(write, rows):
+    best = None
+    for _ in xrange(REPEAT):
+        with tempfile.TemporaryFile() as output:
+            start = time.time()
+            write(output, rows)
+            output.flush()
+            elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(rows) / best
+
+
+def call_per_row(strict):
+    def write(output, rows):
+        writer = Writer(output, data_desc, strict=strict)
+        names = data_desc.field_names
+        for row in rows:
+            writer(**dict(zip(names, row)))
+    return write
+
+
+def writerows(strict):
+    def write(output, rows):
+        Writer(output, data_desc, strict=strict).writerows(rows)
+    return write
+
+
+data_desc = parse_header("# name, qty:int, price:float, tag, paid:bool, comment")
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    rows = [("item%d" % i, i, i / 3.0, "tag%d" % (i % 10), bool(i % 2), "some text")
+            for i in xrange(count)]
+
+    for strict in (False, True):
+        mode = "strict" if strict else "loose"
+        print "%-6s before %10.0f rows/s" % (mode, rows_per_second(call_per_row(strict), rows))
+        print "%-6s after  %10.0f rows/s" % (mode, rows_per_second(writerows(strict), rows))
+
+
+if __name__ == '__main__':
+    main()
@@ -6,6 +6,9 @@ setup(
     name="tabkit",
     version="0.13",
     packages=find_packages(),
+    extras_require={
+        "numpy": ["numpy"]
+    },
     entry_points={
         "console_scripts": [
             'tcat = tabkit.scripts:cat',
@@ -14,7 +17,11 @@ setup(
             'tjoin = tabkit.scripts:join',
             'tmap_awk = tabkit.scripts:map',
             'tgrp_awk = tabkit.scripts:group',
-            'tpretty = tabkit.scripts:pretty'
+            'tpipe = tabkit.scripts:pipe',
+            'tpretty = tabkit.scripts:pretty',
+            'tcache = tabkit.scripts:cache',
+            'tindex = tabkit.scripts:index',
+            'tlookup = tabkit.scripts:lookup'
         ]
     },
     author="Andrei Fyodorov",
@@ -1,2 +1,4 @@
-from .map import map_program, AwkNodeVisitor
-from .group import grp_program, AggregateAwkNodeVisitor
+from .map import map_program, MapProgram, AwkNodeVisitor
+from .group import grp_program, combine_program, AggregateAwkNodeVisitor
+from .join import HashJoinProgram
+from .implementations import awk_command, AWK_ENV
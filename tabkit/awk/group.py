@@ -1,16 +1,35 @@
 import ast
 import sys
+from copy import copy
 from itertools import chain
 from collections import OrderedDict
 
 from .map import (
-    _join_exprs, Statement, Assignment, OmittedAssignment, Expression, SimpleExpression,
+    _join_exprs, printed, number_function, Statement, Assignment, OmittedAssignment, Expression, SimpleExpression,
     AwkNodeVisitor, OutputAwkGenerator
 )
 from ..exception import TabkitException
 from ..type import TabkitTypes
 
 
+# rough memory taken by a group in hash mode: the key and the aggregate array elements
+MEMORY_PER_GROUP = 512
+# the file hash group programs spill to comes from the environment, awk -v would interpret
+# backslashes in its path
+SPILL_ENV = 'TABKIT_SPILL'
+
+
+def state_output(code):
+    """
+    Code printing the partial result computed by an aggregate function: at full precision,
+    print would round it with OFMT before the combining program reads it.
+
+    >>> state_output('__aggr__0')
+    'sprintf("%.17g",__aggr__0)'
+    """
+    return 'sprintf("%%.17g",%s)' % code
+
+
 class GrpProgram(object):
     """
     Group program structure:
@@ -33,32 +52,71 @@ class GrpProgram(object):
     >>> str(GrpProgram(grp_keys=['a'], grp_output=['a']) + GrpProgram(aggr_output=['c', 'd']))
     'NR==1||__key__0!=a{if(NR>1)print __key__0,c,d;__key__0=a;}END{if(NR>0)print __key__0,c,d;}'
 
+    The outputs among numbers are numbers computed by the program, see number_output, the
+    aggr_states among number_states are printed by state_output.
     """
     def __init__(self, init_aggr=None, grp_keys=None, grp_exprs=None, grp_output=None,
-                 aggr_exprs=None, aggr_output=None):
+                 aggr_exprs=None, aggr_output=None, row_counter=None, aggr_states=None,
+                 arrays=None, numbers=None, number_states=None):
         self.init_aggr = init_aggr or []
         self.grp_keys = grp_keys or []
         self.grp_exprs = grp_exprs or []
         self.grp_output = grp_output or []
         self.aggr_exprs = aggr_exprs or []
         self.aggr_output = aggr_output or []
+        # NR counts the rows skipped by a fused filter as well
+        self.row_counter = row_counter or "NR"
+        # partial results of the aggregate functions, see combine_program
+        self.aggr_states = aggr_states or []
+        # aggregate variables, arrays indexed by the group key in hash mode
+        self.arrays = arrays or []
+        self.numbers = numbers or set()
+        self.number_states = number_states or set()
 
     def __add__(self, other):
-        return GrpProgram(self.init_aggr + other.init_aggr,
-                          self.grp_keys + other.grp_keys,
-                          self.grp_exprs + other.grp_exprs,
-                          self.grp_output + other.grp_output,
-                          self.aggr_exprs + other.aggr_exprs,
-                          self.aggr_output + other.aggr_output)
+        return self.__class__(self.init_aggr + other.init_aggr,
+                              self.grp_keys + other.grp_keys,
+                              self.grp_exprs + other.grp_exprs,
+                              self.grp_output + other.grp_output,
+                              self.aggr_exprs + other.aggr_exprs,
+                              self.aggr_output + other.aggr_output,
+                              self.row_counter,
+                              self.aggr_states + other.aggr_states,
+                              self.arrays + other.arrays,
+                              self.numbers | other.numbers,
+                              self.number_states | other.number_states)
+
+    def keys(self):
+        """ Distinct group key expressions """
+        return list(OrderedDict.fromkeys(self.grp_keys))
+
+    def partial(self):
+        """ The program printing the group keys and the partial results instead of the output """
+        program = copy(self)
+        program.grp_output = self.keys()
+        program.aggr_output = self.state_exprs()
+        # the keys are printed as they are
+        program.numbers = set()
+        return program
+
+    def state_exprs(self):
+        """ Codes printing the partial results """
+        return [state_output(state) if state in self.number_states else state
+                for state in self.aggr_states]
+
+    def print_exprs(self, key_vars):
+        """ Codes of the output, the group keys printed from key_vars """
+        return (printed([key_vars[expr] for expr in self.grp_output],
+                        set(key_vars[expr] for expr in self.grp_output if expr in self.numbers)) +
+                printed(self.aggr_output, self.numbers))
 
     def __str__(self):
         grp_exprs = _join_exprs(self.grp_exprs)
         if grp_exprs:
             grp_exprs = "{%s}" % grp_exprs
 
-        keys = OrderedDict((expr, "__key__%x" % n) for n, expr in enumerate(self.grp_keys))
-        print_exprs = [keys[expr] for expr in self.grp_output] + self.aggr_output
-        print_expr = "print %s;" % ",".join(expr for expr in print_exprs)
+        keys = OrderedDict((expr, "__key__%x" % n) for n, expr in enumerate(self.keys()))
+        print_expr = "print %s;" % ",".join(self.print_exprs(keys))
         key_cond = "%s" % "||".join("%s!=%s" % (var, expr) for expr, var in keys.iteritems())
         key_exprs = _join_exprs("%s=%s" % (var, expr) for expr, var in keys.iteritems())
 
@@ -67,11 +125,79 @@ class GrpProgram(object):
         if aggr_exprs:
             aggr_exprs = "{%s}" % aggr_exprs
 
-        return "%sNR==1||%s{if(NR>1)%s%s%s}%sEND{if(NR>0)%s}" % (
-            grp_exprs, key_cond, print_expr, key_exprs, init_aggr, aggr_exprs, print_expr)
+        return "{grp}{nr}==1||{cond}{{if({nr}>1){print_}{keys}{init}}}{aggr}END{{if({nr}>0){print_}}}{func}".format(
+            grp=grp_exprs, nr=self.row_counter, cond=key_cond, print_=print_expr, keys=key_exprs,
+            init=init_aggr, aggr=aggr_exprs,
+            func=number_function(self.grp_output + self.aggr_output, self.numbers))
+
+
+class HashGrpProgram(GrpProgram):
+    """
+    Hash group program structure, the input needs not to be sorted by the group keys:
+
+    BEGIN { __spill = ENVIRON[SPILL_ENV] }
+    {
+        grp_exprs;
+        __key = grp_keys joined by SUBSEP;
+        if (new __key) {
+            if (__max_groups groups already) spill them to the file __spill;
+            remember __key;
+            init_aggr;
+        }
+        aggr_exprs;
+    }
+    END {
+        if (spilled) spill the rest;
+        else for each __key in order of appearance print grp_output, aggr_output;
+    }
+
+    The variables of aggregates are arrays indexed by __key. Spilled groups are printed as
+    their keys followed by aggr_states, combine_program aggregates them afterwards.
 
+    >>> print HashGrpProgram(grp_keys=['$1'], grp_output=['$1'], init_aggr=['__aggr__0[__key]=0'],
+    ...                      aggr_exprs=['__aggr__0[__key]++'], aggr_output=['__aggr__0[__key]'],
+    ...                      aggr_states=['__aggr__0[__key]'], arrays=['__aggr__0'])
+    BEGIN{__spill=ENVIRON["TABKIT_SPILL"]}{__key=$1;if(!(__key in __group)){if(__max_groups&&__groups>=__max_groups)__flush();__group[__key]=1;__keys[++__groups]=__key;__aggr__0[__key]=0;}__aggr__0[__key]++;}END{if(__spilled)__flush();else for(__i=1;__i<=__groups;__i++){__key=__keys[__i];split(__key,__k,SUBSEP);print __k[1],__aggr__0[__key];}}function __flush(__saved,__i){__saved=__key;for(__i=1;__i<=__groups;__i++){__key=__keys[__i];split(__key,__k,SUBSEP);print __k[1],__aggr__0[__key]>__spill;}delete __group;delete __keys;delete __aggr__0;__groups=0;__spilled=1;__key=__saved}
+    """
+    def __str__(self):
+        keys = self.keys()
+        key_fields = dict((expr, "__k[%d]" % n) for n, expr in enumerate(keys, 1))
+
+        def print_groups(print_exprs, redirect=""):
+            return (
+                "for(__i=1;__i<=__groups;__i++){__key=__keys[__i];split(__key,__k,SUBSEP);"
+                "print %s%s;}" % (",".join(print_exprs), redirect))
+
+        new_group = (
+            "if(!(__key in __group)){if(__max_groups&&__groups>=__max_groups)__flush();"
+            "__group[__key]=1;__keys[++__groups]=__key;%s}" % _join_exprs(self.init_aggr))
+        row = "{%s__key=%s;%s%s}" % (
+            _join_exprs(self.grp_exprs), " SUBSEP ".join(keys), new_group,
+            _join_exprs(self.aggr_exprs))
+        end = "END{if(__spilled)__flush();else %s}" % print_groups(self.print_exprs(key_fields))
+        flush = "function __flush(__saved,__i){__saved=__key;%s%s__groups=0;__spilled=1;__key=__saved}" % (
+            print_groups([key_fields[expr] for expr in keys] + self.state_exprs(), ">__spill"),
+            _join_exprs("delete %s" % array for array in ["__group", "__keys"] + self.arrays))
+        return 'BEGIN{__spill=ENVIRON["%s"]}%s%s%s%s' % (
+            SPILL_ENV, row, end, flush,
+            number_function(self.grp_output + self.aggr_output, self.numbers))
+
+
+def _visit_exprs(generator, exprs, what):
+    code = []
+    try:
+        for expr in exprs:
+            try:
+                tree = ast.parse(expr)
+            except SyntaxError as e:
+                raise TabkitException("Syntax error: %s" % e.msg)
+            code.extend(generator.visit(tree))
+    except TabkitException as e:
+        raise TabkitException("%s in %s expressions" % (e, what))
+    return code
 
-def grp_program(data_desc, grp_exprs, aggr_exprs=None):
+
+def grp_program(data_desc, grp_exprs, aggr_exprs=None, input_program=None, hashed=False):
     R'''
     >>> import re
     >>> from ..header import parse_header
@@ -83,10 +209,10 @@ def grp_program(data_desc, grp_exprs, aggr_exprs=None):
     ... )
     >>> print re.sub('([{};])', r'\1\n', str(awk))  # doctest: +NORMALIZE_WHITESPACE
     {
-        __var__0=(2**int(log($2)));
+        __var__0=(2^int(log($2)));
     }
     NR==1||__key__0!=$1||__key__1!=$2||__key__2!=__var__0{
-        if(NR>1)print __key__0,__key__1,__key__2,__aggr__1,__aggr__2;
+        if(NR>1)print __key__0,__key__1,(__key__2<2147483648&&__key__2>-2147483648?__key__2:__num(__key__2)),(__aggr__1<2147483648&&__aggr__1>-2147483648?__aggr__1:__num(__aggr__1)),(__aggr__2<2147483648&&__aggr__2>-2147483648?__aggr__2:__num(__aggr__2));
         __key__0=$1;
         __key__1=$2;
         __key__2=__var__0;
@@ -99,46 +225,127 @@ def grp_program(data_desc, grp_exprs, aggr_exprs=None):
         __aggr__2++;
     }
     END{
-        if(NR>0)print __key__0,__key__1,__key__2,__aggr__1,__aggr__2;
+        if(NR>0)print __key__0,__key__1,(__key__2<2147483648&&__key__2>-2147483648?__key__2:__num(__key__2)),(__aggr__1<2147483648&&__aggr__1>-2147483648?__aggr__1:__num(__aggr__1)),(__aggr__2<2147483648&&__aggr__2>-2147483648?__aggr__2:__num(__aggr__2));
     }
+    function __num(x){
+        return x==int(x)&&x<1e16&&x>-1e16?sprintf("%.0f",x):sprintf("%.6g",x)}
     >>> str(output_data_desc)
     '# new_a\tb\tlog_b:int\tsum_c:float\tcnt_d:int'
+
+    The input_program is fused in: the fields of data_desc then refer to its outputs.
+
+    >>> from .map import MapProgram
+    >>> awk, output_data_desc = grp_program(
+    ...     data_desc, grp_exprs=['a'], aggr_exprs=['n=count()'],
+    ...     input_program=MapProgram(output_cond=['$2>0'], output=['$3', '$2', '$1', '$4']))
+    >>> print re.sub('([{};])', r'\1\n', str(awk))  # doctest: +NORMALIZE_WHITESPACE
+    {
+        if(!($2>0))next;
+        __nr__++;
+    }
+    __nr__==1||__key__0!=$3{
+        if(__nr__>1)print __key__0,(__aggr__0<2147483648&&__aggr__0>-2147483648?__aggr__0:__num(__aggr__0));
+        __key__0=$3;
+        __aggr__0=0;
+    }
+    {
+        __aggr__0++;
+    }
+    END{
+        if(__nr__>0)print __key__0,(__aggr__0<2147483648&&__aggr__0>-2147483648?__aggr__0:__num(__aggr__0));
+    }
+    function __num(x){
+        return x==int(x)&&x<1e16&&x>-1e16?sprintf("%.0f",x):sprintf("%.6g",x)}
     '''
     aggr_exprs = aggr_exprs or list()
 
-    program = GrpProgram()
-
-    try:
-        group = GroupKeysAwkGenerator(data_desc)
-        for grp_expr in grp_exprs:
-            try:
-                tree = ast.parse(grp_expr)
-            except SyntaxError as e:
-                raise TabkitException("Syntax error: %s" % e.msg)
-            program.grp_exprs.extend(group.visit(tree))
-    except TabkitException as e:
-        raise TabkitException("%s in group expressions" % e)
+    program = HashGrpProgram() if hashed else GrpProgram()
+    generator_args = {}
+    if input_program:
+        program.grp_exprs.extend(input_program.input_exprs())
+        if input_program.output_cond:
+            program.row_counter = "__nr__"
+            program.grp_exprs.append("__nr__++")
+        generator_args = dict(field_codes=input_program.output, var_count=input_program.var_count)
+
+    group = GroupKeysAwkGenerator(data_desc, **generator_args)
+    program.grp_exprs.extend(_visit_exprs(group, grp_exprs, "group"))
     program.grp_keys.extend(group.group_keys())
     program.grp_output.extend(group.output_code())
+    inherited = input_program.numbers if input_program else ()
+    program.numbers.update(group.number_codes(inherited))
 
-    try:
-        aggr = AggregateAwkGenerator(data_desc, group_context=group.context)
-        for aggr_expr in aggr_exprs:
-            try:
-                tree = ast.parse(aggr_expr)
-            except SyntaxError as e:
-                raise TabkitException("Syntax error: %s" % e.msg)
-            program.aggr_exprs.extend(aggr.visit(tree))
-    except TabkitException as e:
-        raise TabkitException("%s in aggregate expressions" % e)
+    aggr = AggregateAwkGenerator(data_desc, group_context=group.context, hashed=hashed,
+                                 **generator_args)
+    program.aggr_exprs.extend(_visit_exprs(aggr, aggr_exprs, "aggregate"))
     program.init_aggr.extend(aggr.init_code())
     program.aggr_output.extend(aggr.output_code())
+    program.numbers.update(aggr.number_codes(inherited))
+    program.aggr_states.extend(aggr.states())
+    program.number_states.update(aggr.number_states())
+    program.arrays.extend(aggr.var_names)
 
     output_data_desc = group.output_data_desc() + aggr.output_data_desc()
 
     return program, output_data_desc
 
 
+def combine_program(data_desc, grp_exprs, aggr_exprs=None, hashed=False):
+    R'''
+    The program aggregating the output of grp_program(...)[0].partial(): the distinct group
+    keys followed by the partial results of the aggregate functions. The output is the same
+    as of grp_program over the whole input.
+
+    >>> from ..header import parse_header
+    >>> data_desc = parse_header("# a, b, c")
+    >>> partial, _ = grp_program(data_desc, ['a'], ['n=count()', 'm=max(b)', 'avg=sum(c)/n'])
+    >>> str(partial.partial())
+    'NR==1||__key__0!=$1{if(NR>1)print __key__0,sprintf("%.17g",__aggr__0),__aggr__1,sprintf("%.17g",__aggr__2);__key__0=$1;__aggr__0=0;__aggr__1=$2;__aggr__2=0;}{__aggr__0++;if($2>__aggr__1)__aggr__1=$2;__aggr__2+=$3;__aggr__3=(__aggr__2/__aggr__0);}END{if(NR>0)print __key__0,sprintf("%.17g",__aggr__0),__aggr__1,sprintf("%.17g",__aggr__2);}'
+    >>> awk, output_data_desc = combine_program(
+    ...     data_desc, ['a'], ['n=count()', 'm=max(b)', 'avg=sum(c)/n'])
+    >>> str(awk)
+    'NR==1||__key__0!=$1{if(NR>1)print __key__0,(__aggr__0<2147483648&&__aggr__0>-2147483648?__aggr__0:__num(__aggr__0)),__aggr__1,(__aggr__3<2147483648&&__aggr__3>-2147483648?__aggr__3:__num(__aggr__3));__key__0=$1;__aggr__0=0;__aggr__1=$3;__aggr__2=0;}{__aggr__0+=$2;if($3>__aggr__1)__aggr__1=$3;__aggr__2+=$4;__aggr__3=(__aggr__2/__aggr__0);}END{if(NR>0)print __key__0,(__aggr__0<2147483648&&__aggr__0>-2147483648?__aggr__0:__num(__aggr__0)),__aggr__1,(__aggr__3<2147483648&&__aggr__3>-2147483648?__aggr__3:__num(__aggr__3));}function __num(x){return x==int(x)&&x<1e16&&x>-1e16?sprintf("%.0f",x):sprintf("%.6g",x)}'
+    >>> str(output_data_desc)
+    '# a\tn:int\tm\tavg:float'
+
+    >>> combine_program(data_desc, ['a'], ['n=cumcount()'])
+    Traceback (most recent call last):
+    ...
+    TabkitException: Syntax error: cumulative function 'cumcount' can't be combined from partial results in aggregate expressions
+    '''
+    aggr_exprs = aggr_exprs or list()
+
+    group = GroupKeysAwkGenerator(data_desc)
+    _visit_exprs(group, grp_exprs, "group")
+    aggr = AggregateAwkGenerator(data_desc, group_context=group.context)
+    _visit_exprs(aggr, aggr_exprs, "aggregate")
+
+    # the partial results are read from the fields following the group keys
+    keys = list(OrderedDict.fromkeys(group.group_keys()))
+    key_fields = dict((code, "$%d" % n) for n, code in enumerate(keys, 1))
+    group_context = OrderedDict(
+        (name, SimpleExpression(code=key_fields[expr.code], type=expr.type))
+        for name, expr in group.context.iteritems())
+    states = [
+        SimpleExpression(code="$%d" % n, type=func.type)
+        for n, func in enumerate(aggr.aggregators, len(keys) + 1)]
+
+    combine = CombineAwkGenerator(data_desc, states, group_context=group_context, hashed=hashed)
+    program = HashGrpProgram() if hashed else GrpProgram()
+    program.grp_keys.extend(key_fields[code] for code in keys)
+    program.grp_output.extend(key_fields[code] for code in group.output_code())
+    program.numbers.update(key_fields[code] for code in group.number_codes())
+    program.aggr_exprs.extend(_visit_exprs(combine, aggr_exprs, "aggregate"))
+    program.init_aggr.extend(combine.init_code())
+    program.aggr_output.extend(combine.output_code())
+    program.numbers.update(combine.number_codes())
+    program.aggr_states.extend(combine.states())
+    program.number_states.update(combine.number_states())
+    program.arrays.extend(combine.var_names)
+
+    return program, group.output_data_desc() + combine.output_data_desc()
+
+
 class GroupKeysAwkGenerator(OutputAwkGenerator):
     def group_keys(self):
         return (expr.code for name, expr in self.context.iteritems())
@@ -170,18 +377,31 @@ class SimpleAggregateExpressions(AggregateExpression, SimpleExpression):
 class AggregateFunction(object):
     init_code_template = None
     code_template = None
+    # cumulative functions output a running value on every row and can't be computed by parts
+    cumulative = False
+    # the result is a number computed by the function, not one of the values as is
+    number = False
 
     def _set_code_attr(self, attr, *args, **kwargs):
         template = getattr(self, "%s_template" % attr)
         setattr(self, attr, template.format(*args, **kwargs) if template else None)
 
     def __init__(self, var_name, *args, **kwargs):
-        self._set_code_attr('init_code', var_name=var_name, **kwargs)
-        self._set_code_attr('code', *(arg.code for arg in args), var_name=var_name, **kwargs)
+        self.var_name = var_name
+        arg_codes = [arg.code for arg in args]
+        self._set_code_attr('init_code', *arg_codes, var_name=var_name, **kwargs)
+        self._set_code_attr('code', *arg_codes, var_name=var_name, **kwargs)
+
+    @classmethod
+    def combine(cls, var_name, state, *args):
+        """ The function aggregating partial results (state) of this function """
+        return cls(var_name, state, *args[1:])
 
 
 class CumulativeCountFunction(AggregateFunction):
     code_template = "{var_name}++"
+    cumulative = True
+    number = True
 
     def __init__(self, var_name):
         super(CumulativeCountFunction, self).__init__(var_name)
@@ -190,10 +410,17 @@ class CumulativeCountFunction(AggregateFunction):
 
 class CountFunction(CumulativeCountFunction):
     init_code_template = "{var_name}=0"
+    cumulative = False
+
+    @classmethod
+    def combine(cls, var_name, state, *args):
+        return SumFunction(var_name, state)
 
 
 class CumulativeSumFunction(AggregateFunction):
     code_template = "{var_name}+={0}"
+    cumulative = True
+    number = True
 
     def __init__(self, var_name, arg):
         super(CumulativeSumFunction, self).__init__(var_name, arg)
@@ -202,6 +429,7 @@ class CumulativeSumFunction(AggregateFunction):
 
 class SumFunction(CumulativeSumFunction):
     init_code_template = "{var_name}=0"
+    cumulative = False
 
 
 class GroupConcatFunction(AggregateFunction):
@@ -221,8 +449,9 @@ class GroupConcatFunction(AggregateFunction):
 
 class GenericCompareFunction(AggregateFunction):
     op = None
-    init_code_template = '{var_name}_is_none=1;{var_name}=""'
-    code_template = 'if({var_name}_is_none||{0}{op}{var_name}){{{var_name}={0};{var_name}_is_none=0}}'
+    # the init code runs on the first row of a group, so it starts from the first value
+    init_code_template = '{var_name}={0}'
+    code_template = 'if({0}{op}{var_name}){var_name}={0}'
 
     def __init__(self, var_name, arg):
         self.type = arg.type
@@ -264,10 +493,35 @@ class AggregateAwkNodeVisitor(AwkNodeVisitor):
 class AggregateAwkGenerator(AggregateAwkNodeVisitor, OutputAwkGenerator):
     var_name_template = "__aggr__%x"
 
-    def __init__(self, data_desc, context=None, group_context=None):
-        super(AggregateAwkGenerator, self).__init__(data_desc, context)
+    def __init__(self, data_desc, context=None, group_context=None, hashed=False, **kwargs):
+        super(AggregateAwkGenerator, self).__init__(data_desc, context, **kwargs)
         self.group_context = group_context or dict()
         self.aggregators = list()
+        # in hash mode every variable is an array indexed by the group key
+        self.hashed = hashed
+        self.var_names = list()
+        # variables of the aggregate functions computing numbers
+        self.number_vars = set()
+
+    def is_number(self, expr, inherited=()):
+        if isinstance(expr, SimpleAggregateExpressions):
+            return expr.code in self.number_vars
+        return super(AggregateAwkGenerator, self).is_number(expr, inherited)
+
+    def _new_var(self):
+        var_name = super(AggregateAwkGenerator, self)._new_var()
+        self.var_names.append(var_name)
+        if self.hashed:
+            return "%s[__key]" % var_name
+        return var_name
+
+    def states(self):
+        """ Variables holding the partial results of the aggregate functions """
+        return (aggr.var_name for aggr in self.aggregators)
+
+    def number_states(self):
+        """ States computed as numbers by the aggregate functions, not values as they are """
+        return (aggr.var_name for aggr in self.aggregators if getattr(aggr, 'number', False))
 
     def init_code(self):
         return (aggr.init_code for aggr in self.aggregators if aggr.init_code)
@@ -282,10 +536,19 @@ class AggregateAwkGenerator(AggregateAwkNodeVisitor, OutputAwkGenerator):
             return AggregateExpression.from_expression(expr)
         return expr
 
+    def aggregate_function(self, node, var_name, args):
+        func_class = self.aggregate_funcs[node.func.id]
+        if self.hashed and func_class.cumulative:
+            raise TabkitException(
+                "Syntax error: cumulative function '%s' is not supported in hash mode" % node.func.id)
+        return func_class(var_name, *args)
+
     def visit_AggregateFunction(self, node):
         var_name = self._new_var()
         args = super(AggregateAwkGenerator, self).visit_AggregateFunction(node)
-        func = self.aggregate_funcs[node.func.id](var_name, *args)
+        func = self.aggregate_function(node, var_name, args)
+        if getattr(func, 'number', False):
+            self.number_vars.add(var_name)
         return SimpleAggregateExpressions(
             code=var_name,
             type=func.type,
@@ -324,3 +587,19 @@ class AggregateAwkGenerator(AggregateAwkNodeVisitor, OutputAwkGenerator):
             if not isinstance(assign, OmittedAssignment):
                 code.append(assign.code)
         return code
+
+
+class CombineAwkGenerator(AggregateAwkGenerator):
+    """ Aggregates the partial results of the aggregate functions read from the states """
+
+    def __init__(self, data_desc, states, **kwargs):
+        super(CombineAwkGenerator, self).__init__(data_desc, **kwargs)
+        self.input_states = iter(states)
+
+    def aggregate_function(self, node, var_name, args):
+        func_class = self.aggregate_funcs[node.func.id]
+        if func_class.cumulative:
+            raise TabkitException(
+                "Syntax error: cumulative function '%s' can't be combined from partial results"
+                % node.func.id)
+        return func_class.combine(var_name, next(self.input_states), *args)
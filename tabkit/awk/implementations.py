@@ -0,0 +1,102 @@
+"""
+awk implementations to run the programs with. The fastest one found which runs them the way
+the other engines evaluate expressions is chosen, unless the --awk option of a tool or the
+TABKIT_AWK environment variable name one. sprintf("%d") of mawk still clamps to 32 bits.
+"""
+import os
+import sys
+import shlex
+import subprocess
+
+from .map import number_output, NUMBER_FUNCTION
+from ..exception import TabkitException
+from ..utils import which
+
+
+AWK_ENV = 'TABKIT_AWK'
+
+# in order of speed on the row programs we generate
+AWKS = ('mawk', 'gawk', 'busybox awk', 'nawk', 'awk')
+
+# the constructs the programs are made of, and the output of numbers they rely on: integral
+# values beyond 2^31 print as integers through number_output (mawk prints 2.14748e+09 itself)
+PROBE_PROGRAM = r'''{
+    n = split($0 SUBSEP "c", parts, SUBSEP); counts[$1, $2] = 2^3; delete counts;
+    for (key in counts) n = 0;
+    print n, NF, parts[2], %s, %s, %s, 0.1 + 0.2, 1/3, int(-2.5), $1 < $2, "10" < "9"
+}
+%s''' % (number_output("2^31"), number_output("2^53"), number_output("(-2^53)"), NUMBER_FUNCTION)
+PROBE_INPUT = "10\t9\n"
+PROBE_OUTPUT = "2\t2\tc\t2147483648\t9007199254740992\t-9007199254740992\t0.3\t0.333333\t-2\t0\t1\n"
+
+
+def probe(command):
+    """ Output of the probe program run by the awk command, None if it doesn't run """
+    env = dict(os.environ, LC_ALL='C')
+    try:
+        process = subprocess.Popen(
+            command + ['-F', '\t', '-v', 'OFS=\t', PROBE_PROGRAM], env=env, close_fds=True,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=open(os.devnull, 'w'))
+    except OSError:
+        return None
+    output, _ = process.communicate(PROBE_INPUT)
+    return output if process.returncode == 0 else None
+
+
+def available_awks():
+    """ Commands of the awks found, each implementation once """
+    paths = set()
+    for name in AWKS:
+        command = name.split()
+        path = which(command[0])
+        if path:
+            # awk and nawk are usually links to one of the others
+            path = (os.path.realpath(path),) + tuple(command[1:])
+            if path not in paths:
+                paths.add(path)
+                yield command
+
+
+_detected = []
+
+
+def detect_awk():
+    """
+    Command of the fastest compatible awk, the fastest one running the probe at all
+    if none is compatible, with a warning
+    """
+    if not _detected:
+        runnable = []
+        for command in available_awks():
+            output = probe(command)
+            if output == PROBE_OUTPUT:
+                break
+            if output is not None:
+                runnable.append(command)
+        else:
+            if not runnable:
+                raise TabkitException("No awk found, tried %s" % ", ".join(AWKS))
+            command = runnable[0]
+            sys.stderr.write("Warning: %s output may differ from the other engines and awks, "
+                             "install gawk or mawk, or set %s\n" % (" ".join(command), AWK_ENV))
+        _detected.append(command)
+    return list(_detected[0])
+
+
+def awk_command(awk=None):
+    """
+    Command line of the awk to run: awk as given (e.g. "busybox awk"), else from TABKIT_AWK,
+    else detected
+
+    >>> awk_command("awk -v x=1")
+    ['awk', '-v', 'x=1']
+    >>> probe(awk_command()) is not None
+    True
+    """
+    awk = awk or os.environ.get(AWK_ENV)
+    if awk:
+        command = shlex.split(awk)
+        if not which(command[0]):
+            raise TabkitException("awk '%s' not found" % command[0])
+        return command
+    return detect_awk()
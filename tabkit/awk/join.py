@@ -0,0 +1,76 @@
+def _awk_str(value):
+    return '"%s"' % value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+class HashJoinProgram(object):
+    r'''
+    Hash join program structure, the hashed file goes first and is read in BEGIN:
+
+    BEGIN {
+        while (getline hashed line) {
+            store the line and index it by its key;
+        }
+    }
+    {
+        if (key in index) {
+            mark the key matched;
+            for each hashed line with this key print pair_output;
+        }
+        else print streamed_output;
+    }
+    END {
+        for each hashed line with unmatched key print hashed_output;
+    }
+
+    >>> print HashJoinProgram(2, 3, 1, ['0', '1.2', '2.1'], unpairable={1, 2})
+    BEGIN{while((getline __line<ARGV[1])>0){split(__line,__h,"\t");__n++;__row[__n]=__line;__key[__n]=__h[3];__count[__h[3]]++;__index[__h[3],__count[__h[3]]]=__n}close(ARGV[1]);ARGV[1]=""}{__k=$1;if(__k in __count){__matched[__k]=1;for(__i=1;__i<=__count[__k];__i++){split(__row[__index[__k,__i]],__h,"\t");print __k,$2,__h[1];}}else print __k,$2,"";}END{for(__i=1;__i<=__n;__i++)if(!(__key[__i] in __matched)){split(__row[__i],__h,"\t");__k=__key[__i];print __k,"",__h[1];}}
+    '''
+    def __init__(self, hashed, hashed_key, streamed_key, output, unpairable=None,
+                 only_unpairable=None, empty=None):
+        # files are numbered 1 and 2, keys and output fields are numbered as in join
+        self.hashed = hashed
+        self.streamed = 3 - hashed
+        self.hashed_key = hashed_key
+        self.streamed_key = streamed_key
+        self.output = output
+        self.unpairable = (unpairable or set()) | (only_unpairable or set())
+        self.pairs = not only_unpairable
+        self.empty = _awk_str(empty or "")
+
+    def _print(self, hashed=True, streamed=True):
+        def field_code(spec):
+            if spec == "0":
+                return "__k"
+            fileno, fieldno = map(int, spec.split("."))
+            if fileno == self.hashed:
+                return "__h[%d]" % fieldno if hashed else self.empty
+            return "$%d" % fieldno if streamed else self.empty
+        return "print %s;" % ",".join(field_code(spec) for spec in self.output)
+
+    def __str__(self):
+        key = "__h[%d]" % self.hashed_key
+        load = (
+            'BEGIN{while((getline __line<ARGV[1])>0){split(__line,__h,"\\t");__n++;'
+            '__row[__n]=__line;__key[__n]=%s;__count[%s]++;__index[%s,__count[%s]]=__n}'
+            'close(ARGV[1]);ARGV[1]=""}' % (key, key, key, key))
+
+        matched = ""
+        if self.hashed in self.unpairable:
+            matched += "__matched[__k]=1;"
+        if self.pairs:
+            matched += (
+                'for(__i=1;__i<=__count[__k];__i++){split(__row[__index[__k,__i]],__h,"\\t");%s}' %
+                self._print())
+        stream = "{__k=$%d;if(__k in __count){%s}" % (self.streamed_key, matched)
+        if self.streamed in self.unpairable:
+            stream += "else %s" % self._print(hashed=False)
+        stream += "}"
+
+        end = ""
+        if self.hashed in self.unpairable:
+            end = (
+                'END{for(__i=1;__i<=__n;__i++)if(!(__key[__i] in __matched))'
+                '{split(__row[__i],__h,"\\t");__k=__key[__i];%s}}' % self._print(streamed=False))
+
+        return load + stream + end
+
@@ -8,10 +8,40 @@ from ..header import DataDesc
 from ..type import TabkitTypes, infer_type
 
 
+# types of the values awk computes as numbers
+NUMBER_TYPES = (TabkitTypes.int, TabkitTypes.float)
+
+
 def _join_exprs(exprs):
     return "".join("%s;" % expr for expr in exprs)
 
 
+def number_output(code):
+    """
+    Code printing the number the way the engines do whichever the awk: integral values as
+    integers below 1e16, the rest with %.6g. mawk prints integers beyond 2^31 with %.6g and
+    its sprintf %d clamps them, so NUMBER_FUNCTION prints them with %.0f.
+
+    >>> number_output('x')
+    '(x<2147483648&&x>-2147483648?x:__num(x))'
+    """
+    return "({0}<2147483648&&{0}>-2147483648?{0}:__num({0}))".format(code)
+
+
+NUMBER_FUNCTION = (
+    'function __num(x){return x==int(x)&&x<1e16&&x>-1e16?sprintf("%.0f",x):sprintf("%.6g",x)}')
+
+
+def printed(codes, numbers):
+    """ Codes to print the values of codes with, those among numbers printed as numbers """
+    return [number_output(code) if code in numbers else code for code in codes]
+
+
+def number_function(codes, numbers):
+    """ NUMBER_FUNCTION if some of the codes are printed as numbers """
+    return NUMBER_FUNCTION if numbers.intersection(codes) else ""
+
+
 class MapProgram(object):
     """
     Map program structure:
@@ -26,29 +56,56 @@ class MapProgram(object):
     >>> str(MapProgram(output=['a', 'b']) + MapProgram(output=['c', 'd']))
     '{print a,b,c,d;}'
 
+    >>> str(MapProgram(['x=$1*2'], ['x>2'], ['x', '$2']).cut([1]))
+    '{x=$1*2;}x>2{print $2;}'
+
+    The outputs among numbers are numbers computed by the program, see number_output.
     """
-    def __init__(self, row_exprs=None, output_cond=None, output=None):
+    def __init__(self, row_exprs=None, output_cond=None, output=None, numbers=None):
         self.row_exprs = row_exprs or []
         self.output_cond = output_cond or []
         self.output = output or []
+        self.numbers = numbers or set()
+        # shared by the programs fused together, so that their variables don't clash
+        self.var_count = count()
+
+    @classmethod
+    def identity(cls, data_desc):
+        """ Program printing its input as is, a starting point for fusing programs """
+        return cls(output=["$%d" % (index + 1) for index in xrange(len(data_desc))])
+
+    def input_exprs(self):
+        """ Row expressions which skip the rows filtered out, to feed the next program """
+        if self.output_cond:
+            return self.row_exprs + ["if(!(%s))next" % "&&".join(self.output_cond)]
+        return list(self.row_exprs)
+
+    def cut(self, indices):
+        """ Program printing only the outputs with these indices """
+        program = MapProgram(self.row_exprs, self.output_cond, [self.output[i] for i in indices],
+                             self.numbers)
+        program.var_count = self.var_count
+        return program
 
     def __add__(self, other):
         return MapProgram(self.row_exprs + other.row_exprs,
                           self.output_cond + other.output_cond,
-                          self.output + other.output)
+                          self.output + other.output,
+                          self.numbers | other.numbers)
 
     def __str__(self):
         row_exprs = _join_exprs(self.row_exprs)
         if row_exprs:
             row_exprs = "{%s}" % row_exprs
         output_cond = "&&".join(self.output_cond)
-        output_exprs = ",".join(self.output)
+        output_exprs = ",".join(printed(self.output, self.numbers))
         if output_exprs:
             output_exprs = "{print %s;}" % output_exprs
-        return "%s%s%s" % (row_exprs, output_cond, output_exprs)
+        return "%s%s%s%s" % (row_exprs, output_cond, output_exprs,
+                             number_function(self.output, self.numbers))
 
 
-def map_program(data_desc, output_exprs, filter_exprs=None):
+def map_program(data_desc, output_exprs, filter_exprs=None, input_program=None):
     r'''
     >>> import re
     >>> from ..header import parse_header
@@ -71,18 +128,50 @@ def map_program(data_desc, output_exprs, filter_exprs=None):
         __var__1=$2;
     }
     (__var__3==($1*$4)||__var__3==($4*$1))&&__var__2>=__var__3{
-        print __var__0,__var__1,__var__3,$1,$3,$4;
+        print __var__0,__var__1,(__var__3<2147483648&&__var__3>-2147483648?__var__3:__num(__var__3)),$1,$3,$4;
     }
+    function __num(x){
+        return x==int(x)&&x<1e16&&x>-1e16?sprintf("%.0f",x):sprintf("%.6g",x)}
 
     >>> str(output_data_desc)
     '# a\tb\tnew:float\ta2\tc\td'
+
+    The input_program is fused in: the fields of data_desc then refer to its outputs.
+
+    >>> awk, output_data_desc = map_program(
+    ...     output_data_desc, output_exprs=['x=new*2', 'c'], filter_exprs=['x>c'], input_program=awk)
+    >>> print re.sub('([{};])', r'\1\n', str(awk))  # doctest: +NORMALIZE_WHITESPACE
+    {
+        __var__0=($2+$3);
+        __var__1=($1/$3);
+        __var__2=($1*3);
+        __var__3=(__var__2/3);
+        __var__1=($1+1);
+        __var__0=$1;
+        __var__1=$2;
+        if(!((__var__3==($1*$4)||__var__3==($4*$1))&&__var__2>=__var__3))next;
+        __var__4=(__var__3*2);
+    }
+    __var__4>$3{
+        print (__var__4<2147483648&&__var__4>-2147483648?__var__4:__num(__var__4)),$3;
+    }
+    function __num(x){
+        return x==int(x)&&x<1e16&&x>-1e16?sprintf("%.0f",x):sprintf("%.6g",x)}
+    >>> str(output_data_desc)
+    '# x:float\tc'
     '''
     filter_exprs = filter_exprs or list()
 
     program = MapProgram()
+    generator_args = {}
+    if input_program:
+        program.row_exprs.extend(input_program.input_exprs())
+        program.var_count = input_program.var_count
+        generator_args['field_codes'] = input_program.output
+    generator_args['var_count'] = program.var_count
 
     try:
-        output = OutputAwkGenerator(data_desc)
+        output = OutputAwkGenerator(data_desc, **generator_args)
         for output_expr in output_exprs:
             try:
                 tree = ast.parse(output_expr)
@@ -90,11 +179,15 @@ def map_program(data_desc, output_exprs, filter_exprs=None):
                 raise TabkitException("Syntax error: %s" % e.msg)
             program.row_exprs.extend(output.visit(tree))
         program.output.extend(output.output_code())
+        program.numbers.update(output.number_codes(input_program.numbers if input_program else ()))
+        if input_program and not output_exprs:
+            program.output.extend(input_program.output)
+            program.numbers.update(input_program.numbers)
     except TabkitException as e:
         raise TabkitException("%s in output expressions" % e)
 
     try:
-        cond = ConditionAwkGenerator(data_desc, output.context)
+        cond = ConditionAwkGenerator(data_desc, output.context, **generator_args)
         for filter_expr in filter_exprs:
             try:
                 tree = ast.parse(filter_expr)
@@ -180,7 +273,8 @@ class AwkNodeVisitor(ast.NodeVisitor):
         ast.Add: '+',
         ast.Sub: '-',
         ast.Mult: '*',
-        ast.Pow: '**',
+        # ** isn't POSIX, mawk and busybox awk don't know it
+        ast.Pow: '^',
         ast.Div: '/'
     }
 
@@ -226,10 +320,11 @@ class AwkNodeVisitor(ast.NodeVisitor):
 
 
 class AwkGenerator(AwkNodeVisitor):
-    def __init__(self, data_desc, context=None):
+    def __init__(self, data_desc, context=None, field_codes=None, var_count=None):
         self.data_desc = data_desc
         self.context = context or OrderedDict()
-        self.var_count = count()
+        self.field_codes = field_codes or ["$%d" % (index + 1) for index in xrange(len(data_desc))]
+        self.var_count = var_count or count()
         super(AwkGenerator, self).__init__()
 
     var_name_template = "__var__%x"
@@ -289,7 +384,7 @@ class AwkGenerator(AwkNodeVisitor):
         if node.id in self.data_desc:
             field_index = self.data_desc.index(node.id)
             return SimpleExpression(
-                code="$%d" % (field_index + 1),
+                code=self.field_codes[field_index],
                 type=self.data_desc.fields[field_index].type)
 
         if node.id in self.context:
@@ -299,9 +394,9 @@ class AwkGenerator(AwkNodeVisitor):
 
 
 class OutputAwkGenerator(AwkGenerator):
-    def __init__(self, data_desc, context=None):
+    def __init__(self, data_desc, context=None, **kwargs):
         self.output = set()
-        super(OutputAwkGenerator, self).__init__(data_desc, context)
+        super(OutputAwkGenerator, self).__init__(data_desc, context, **kwargs)
 
     def output_context(self):
         return ((name, expr) for name, expr in self.context.iteritems() if name in self.output)
@@ -312,6 +407,20 @@ class OutputAwkGenerator(AwkGenerator):
     def output_data_desc(self):
         return DataDesc((name, expr.type) for name, expr in self.output_context())
 
+    def is_number(self, expr, inherited=()):
+        if isinstance(expr, SimpleExpression):
+            # a field as is, or an output of the input program
+            return expr.code in inherited
+        return expr.type in NUMBER_TYPES
+
+    def number_codes(self, inherited=()):
+        """
+        Codes of the outputs which are numbers computed by the program rather than fields as
+        they are, inherited are those of the input program
+        """
+        return set(expr.code for name, expr in self.output_context()
+                   if self.is_number(expr, inherited))
+
     def visit_Assign(self, node):
         if len(node.targets) != 1:
             raise TabkitException('Syntax error: multiple targets are not allowed in assignment')
@@ -319,7 +428,9 @@ class OutputAwkGenerator(AwkGenerator):
         target_name = node.targets[0].id
         value = self.visit(node.value)
 
-        if target_name in self.context:
+        # names bound to a simple expression alias a field, which must not be overwritten
+        if (target_name in self.context
+                and not isinstance(self.context[target_name], SimpleExpression)):
             target_var_name = self.context[target_name].code
         else:
             if not target_name.startswith("_"):
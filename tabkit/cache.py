@@ -0,0 +1,326 @@
+"""
+Column store: a headed TSV kept on disk by columns, so that the columns can be read without
+parsing text and only the columns needed are read at all.
+
+The store is a single file: the magic, the size of the metadata, the metadata in JSON
+(the header and the encodings of the columns), then the data of the columns, each aligned
+to 8 bytes. A column is encoded as
+
+    int, float, bool    fixed-width numbers, if all the values of the column are written
+                        the way they are printed back
+    dict                codes of the values in a dictionary, if there are few distinct values
+    text                the values each ending with a line end, and their offsets
+
+so that the TSV made back of the store is the same as the one it was made of, except for
+the rows of other widths than the header, which are padded or truncated.
+"""
+import sys
+import json
+import mmap
+import signal
+import shutil
+import struct
+import tempfile
+from array import array
+from itertools import izip, islice, repeat
+
+from .header import parse_header
+from .exception import TabkitException
+from .type import TabkitTypes
+
+
+MAGIC = "TABKITC1"
+BATCH_SIZE = 65536
+# a dictionary encoded column has at most this many distinct values and twice as many rows
+DICTIONARY_SIZE = 65536
+
+# typecodes of the arrays of the encodings, the store is read where they have the same sizes
+TYPECODES = {
+    'int': 'l',
+    'float': 'd',
+    'bool': 'B',
+    'codes': 'I',
+    'offsets': 'L',
+}
+
+_NUMBER_ENCODINGS = {
+    TabkitTypes.int: 'int',
+    TabkitTypes.float: 'float',
+    TabkitTypes.bool: 'bool',
+}
+
+
+def _align(size):
+    return (size + 7) // 8 * 8
+
+
+def _numbers(encoding, values):
+    """ Array of the values if they are all printed back the same, None otherwise """
+    try:
+        if encoding == 'int':
+            numbers = map(int, values)
+            if map(str, numbers) != values:
+                return None
+        elif encoding == 'float':
+            numbers = map(float, values)
+            if map(repr, numbers) != values:
+                return None
+        else:
+            if not set(values) <= {"0", "1"}:
+                return None
+            numbers = map(int, values)
+        return array(TYPECODES[encoding], numbers)
+    except (ValueError, OverflowError):
+        return None
+
+
+class _TextWriter(object):
+    """ Values ending with line ends and the offsets of their starts, in temporary files """
+    def __init__(self):
+        self.offsets = tempfile.TemporaryFile(prefix="tcache_")
+        self.text = tempfile.TemporaryFile(prefix="tcache_")
+        self.size = 0
+        self.count = 0
+        array(TYPECODES['offsets'], [0]).tofile(self.offsets)
+
+    def add(self, values):
+        offsets = array(TYPECODES['offsets'])
+        size = self.size
+        for value in values:
+            size += len(value) + 1
+            offsets.append(size)
+        offsets.tofile(self.offsets)
+        self.text.write("".join("%s\n" % value for value in values))
+        self.size = size
+        self.count += len(values)
+
+    def layout(self, offset):
+        return {'offset': offset, 'count': self.count}, _align(self.length())
+
+    def length(self):
+        return (self.count + 1) * array(TYPECODES['offsets']).itemsize + self.size
+
+    def copy(self, output):
+        for f in (self.offsets, self.text):
+            f.seek(0)
+            shutil.copyfileobj(f, output)
+        output.write("\0" * (_align(self.length()) - self.length()))
+
+
+class _ColumnWriter(object):
+    """ All the encodings of a column which are still possible, the best one is kept """
+    def __init__(self, type_):
+        self.encoding = _NUMBER_ENCODINGS.get(type_)
+        self.numbers = tempfile.TemporaryFile(prefix="tcache_") if self.encoding else None
+        self.text = _TextWriter()
+        self.dictionary = {}
+        self.codes = tempfile.TemporaryFile(prefix="tcache_")
+        self.rows = 0
+
+    def add(self, values):
+        if self.encoding:
+            numbers = _numbers(self.encoding, values)
+            if numbers is None:
+                self.encoding = None
+            else:
+                numbers.tofile(self.numbers)
+        if self.dictionary is not None:
+            dictionary = self.dictionary
+            array(TYPECODES['codes'],
+                  [dictionary.setdefault(value, len(dictionary)) for value in values]
+                  ).tofile(self.codes)
+            if len(dictionary) > DICTIONARY_SIZE:
+                self.dictionary = None
+        self.text.add(values)
+        self.rows += len(values)
+
+    def layout(self, offset):
+        """ Metadata of the column written at offset and the size it takes """
+        if self.encoding:
+            self.chosen = self.encoding
+            size = _align(self.rows * array(TYPECODES[self.encoding]).itemsize)
+            return {'encoding': self.encoding, 'offset': offset}, size
+        if self.dictionary is not None and len(self.dictionary) * 2 <= self.rows:
+            self.chosen = 'dict'
+            self.words = _TextWriter()
+            self.words.add(sorted(self.dictionary, key=self.dictionary.get))
+            codes_size = _align(self.rows * array(TYPECODES['codes']).itemsize)
+            words, words_size = self.words.layout(offset + codes_size)
+            return {'encoding': 'dict', 'offset': offset, 'dictionary': words}, \
+                codes_size + words_size
+        self.chosen = 'text'
+        text, size = self.text.layout(offset)
+        text['encoding'] = 'text'
+        return text, size
+
+    def copy(self, output):
+        if self.chosen == 'text':
+            self.text.copy(output)
+            return
+        data = self.numbers if self.chosen != 'dict' else self.codes
+        data.seek(0)
+        shutil.copyfileobj(data, output)
+        length = data.tell()
+        output.write("\0" * (_align(length) - length))
+        if self.chosen == 'dict':
+            self.words.copy(output)
+
+
+def write_store(lines, data_desc, output, batch_size=BATCH_SIZE):
+    """ Write the lines (with or without line ends) of the data_desc as a store to the output """
+    width = len(data_desc)
+    columns = [_ColumnWriter(field.type) for field in data_desc]
+    lines = iter(lines)
+    rows = 0
+    while True:
+        batch = list(islice(lines, batch_size))
+        if not batch:
+            break
+        values = [line.rstrip("\n").split("\t") for line in batch]
+        for row in values:
+            if len(row) != width:
+                row[:] = (row + [""] * width)[:width]
+        for column, column_values in izip(columns, izip(*values)):
+            column.add(list(column_values))
+        rows += len(batch)
+
+    meta = {
+        'header': str(data_desc),
+        'rows': rows,
+        'typecodes': dict((typecode, array(typecode).itemsize)
+                          for typecode in TYPECODES.itervalues()),
+        'columns': []
+    }
+    offset = 0
+    for column in columns:
+        if not rows:
+            column.encoding = None
+        layout, size = column.layout(offset)
+        meta['columns'].append(layout)
+        offset += size
+    meta_json = json.dumps(meta)
+    output.write(MAGIC)
+    output.write(struct.pack("<Q", len(meta_json)))
+    output.write(meta_json)
+    output.write("\0" * (_align(len(meta_json)) - len(meta_json)))
+    for column in columns:
+        column.copy(output)
+    output.flush()
+
+
+class ColumnStore(object):
+    r'''
+    Store read through mmap, the values are texts as they were in the TSV
+
+    >>> from .header import parse_header
+    >>> lines = ["x\t1\t0.5\t1", "y\t02\t1.5\t0", "x\t3\t2.5", "x\t4\t3.5\t1"]
+    >>> with tempfile.TemporaryFile() as f:
+    ...     write_store(lines, parse_header("# a, b:int, c:float, d:bool # ORDER: a"), f)
+    ...     store = ColumnStore(f)
+    >>> str(store.data_desc), store.rows
+    ('# a\tb:int\tc:float\td:bool\t# ORDER: a', 4)
+    >>> [str(column['encoding']) for column in store.columns]
+    ['dict', 'text', 'float', 'text']
+    >>> store.lines(1, 3)
+    ['y\t02\t1.5\t0', 'x\t3\t2.5\t']
+    >>> store.lines(0, 4, [2, 0])
+    ['0.5\tx', '1.5\ty', '2.5\tx', '3.5\tx']
+    '''
+    def __init__(self, fd):
+        self.name = getattr(fd, 'name', None)
+        self.data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data[:len(MAGIC)] != MAGIC:
+            raise TabkitException("Not a column store")
+        meta_size, = struct.unpack("<Q", self.data[len(MAGIC):len(MAGIC) + 8])
+        meta_start = len(MAGIC) + 8
+        meta = json.loads(self.data[meta_start:meta_start + meta_size])
+        for typecode, size in meta['typecodes'].iteritems():
+            if array(str(typecode)).itemsize != size:
+                raise TabkitException("Column store written on an incompatible platform")
+        self.base = meta_start + _align(meta_size)
+        self.data_desc = parse_header(str(meta['header']))
+        self.rows = meta['rows']
+        self.columns = meta['columns']
+
+    def encoding(self, index):
+        return self.columns[index]['encoding']
+
+    def _array(self, typecode, offset, start, stop):
+        size = array(typecode).itemsize
+        offset += self.base
+        return array(typecode, self.data[offset + start * size:offset + stop * size])
+
+    def _texts(self, block, start, stop):
+        offsets = self._array(TYPECODES['offsets'], block['offset'], start, stop + 1)
+        text = self.base + block['offset'] + \
+            (block['count'] + 1) * array(TYPECODES['offsets']).itemsize
+        values = self.data[text + offsets[0]:text + offsets[-1]].split("\n")
+        values.pop()
+        return values
+
+    def texts(self, index, start=0, stop=None):
+        """ Values of the field of rows start:stop """
+        stop = self.rows if stop is None else stop
+        column = self.columns[index]
+        encoding = column['encoding']
+        if encoding == 'text':
+            return self._texts(column, start, stop)
+        if encoding == 'dict':
+            words = self._texts(column['dictionary'], 0, column['dictionary']['count'])
+            return map(words.__getitem__,
+                       self._array(TYPECODES['codes'], column['offset'], start, stop))
+        numbers = self._array(TYPECODES[encoding], column['offset'], start, stop)
+        return map(repr if encoding == 'float' else str, numbers)
+
+    def numbers(self, index, start=0, stop=None):
+        """ numpy array of the numbers of the field of rows start:stop, mapped from the store
+        with no copy, None if the field isn't stored as numbers """
+        import numpy as np
+        stop = self.rows if stop is None else stop
+        column = self.columns[index]
+        encoding = column['encoding']
+        if encoding not in ('int', 'float', 'bool'):
+            return None
+        typecode = TYPECODES[encoding]
+        dtype = np.dtype(typecode)
+        return np.frombuffer(self.data, dtype=dtype, count=stop - start,
+                             offset=self.base + column['offset'] + start * dtype.itemsize)
+
+    def lines(self, start=0, stop=None, fields=None):
+        """ Lines without line ends of rows start:stop, of the fields only if given """
+        fields = xrange(len(self.data_desc)) if fields is None else fields
+        columns = [self.texts(index, start, stop) for index in fields]
+        if not columns:
+            return [""] * ((self.rows if stop is None else stop) - start)
+        return map("\t".join, izip(*columns))
+
+    def row_batches(self, fields=None, size=BATCH_SIZE):
+        """ Rows of the texts of the fields in batches, the values of other fields are None """
+        width = len(self.data_desc)
+        fields = xrange(width) if fields is None else fields
+        for start in xrange(0, self.rows, size):
+            stop = min(start + size, self.rows)
+            columns = [repeat(None)] * width
+            for index in fields:
+                columns[index] = self.texts(index, start, stop)
+            if fields:
+                yield izip(*columns)
+            else:
+                yield repeat((None,) * width, stop - start)
+
+    def line_batches(self, fields=None, size=BATCH_SIZE):
+        for start in xrange(0, self.rows, size):
+            yield self.lines(start, min(start + size, self.rows), fields)
+
+
+def main():
+    """ Write the lines of the store on the standard input, of the fields (indices) in argv """
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+    fields = map(int, sys.argv[1].split(",")) if len(sys.argv) > 1 else None
+    store = ColumnStore(sys.stdin)
+    for lines in store.line_batches(fields):
+        sys.stdout.write("".join("%s\n" % line for line in lines))
+
+
+if __name__ == '__main__':
+    main()
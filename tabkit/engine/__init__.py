@@ -0,0 +1 @@
+from .scalar import compile_map, map_lines, map_rows
@@ -0,0 +1,647 @@
+"""
+Columnar engine: expressions are evaluated with numpy on batches of rows, a column at a time.
+Values follow the awk semantics of the python engine: fields are numbers if they look like
+decimal numbers, computed numbers print as integers below 1e16 and with %.6g otherwise, as the
+awk programs print them with any awk. The output of --engine awk differs with mawk on fields
+like 0x1A, which mawk converts to numbers, and on sprintf("%d") beyond 2^31, which it clamps.
+
+The later operands of and/or are evaluated for the whole batch, but only the rows the earlier
+operands leave open count: a division by zero stops the run only in one of those.
+"""
+from itertools import izip, islice, imap
+
+import numpy as np
+
+from .generator import py_map, py_group, compile_function
+from .scalar import _to_number, _numeric_re, _sprintf, format_number
+from ..exception import TabkitException
+
+
+BATCH_SIZE = 65536
+
+
+def _texts(values):
+    return np.array(values, dtype=object)
+
+
+# first characters of the texts which may look like numbers
+_NUMBER_START = np.zeros(256, dtype=bool)
+_NUMBER_START[np.frombuffer(" \t\n+-.0123456789", dtype=np.uint8)] = True
+
+
+def _convert(texts):
+    """
+    Numbers of the texts the way awk converts them, and whether the texts look numeric. Only
+    the texts starting like numbers are converted, the rest are 0 and not numeric.
+
+    >>> _convert(_texts(["1", " 2e1 ", "3x", "x", "", "-inf", "0x1A"]))
+    (array([ 1., 20.,  3.,  0.,  0.,  0.,  0.]), array([ True,  True, False, False, False, False, False]))
+    """
+    num = np.zeros(len(texts))
+    numeric = np.zeros(len(texts), dtype=bool)
+    candidates = np.flatnonzero(_NUMBER_START[texts.astype('S1').view(np.uint8)])
+    values = texts[candidates]
+    try:
+        converted = values.astype(float)
+    except ValueError:
+        converted = None
+    # python takes nan and inf for numbers, awk doesn't
+    if converted is not None and np.isfinite(converted).all():
+        num[candidates] = converted
+        numeric[candidates] = True
+    else:
+        num[candidates] = [_to_number(text) for text in values]
+        numeric[candidates] = [_numeric_re.match(text) is not None for text in values]
+    return num, numeric
+
+
+def _ranks(texts):
+    """ Ranks of the texts in the order of their bytes, as awk compares strings """
+    # fixed width bytes sort without a python comparison per pair
+    return np.unique(texts.astype(str), return_inverse=True)[1]
+
+
+class Str(object):
+    """ String value, a constant or a sprintf result """
+    def __init__(self, text):
+        self.text = text
+        self._num = None
+
+    @property
+    def num(self):
+        if self._num is None:
+            if isinstance(self.text, np.ndarray):
+                self._num = _convert(self.text)[0]
+            else:
+                self._num = _to_number(self.text)
+        return self._num
+
+    def take(self, index):
+        return Str(self.text[index]) if isinstance(self.text, np.ndarray) else self
+
+
+class StrNum(Str):
+    """ Field value: a string which is also a number if it looks like one """
+    def __init__(self, text):
+        super(StrNum, self).__init__(text)
+        self._numeric = None
+
+    @property
+    def num(self):
+        if self._num is None:
+            self._num, self._numeric = _convert(self.text)
+        return self._num
+
+    @property
+    def numeric(self):
+        if self._numeric is None:
+            self._num, self._numeric = _convert(self.text)
+        return self._numeric
+
+    def take(self, index):
+        taken = StrNum(self.text[index])
+        if self._numeric is not None:
+            taken._num = self._num[index]
+            taken._numeric = self._numeric[index]
+        return taken
+
+
+def concat(values):
+    """ Values of the same kind joined together """
+    first = values[0]
+    if isinstance(first, StrNum):
+        return StrNum(np.concatenate([value.text for value in values]))
+    if isinstance(first, Str):
+        return Str(np.concatenate([np.broadcast_to(value.text, (1,)) if not isinstance(
+            value.text, np.ndarray) else value.text for value in values]))
+    return np.concatenate([np.atleast_1d(value) for value in values])
+
+
+def take(value, index):
+    if isinstance(value, Str):
+        return value.take(index)
+    if isinstance(value, np.ndarray) and value.ndim:
+        return value[index]
+    return value
+
+
+def num(value):
+    if isinstance(value, Str):
+        return value.num
+    return value
+
+
+def format_numbers(values):
+    """ Numbers as awk prints them: integers as is, the rest with %.6g """
+    values = np.asarray(values, dtype=float)
+    if not values.ndim:
+        return format_number(values)
+    texts = np.empty(len(values), dtype=object)
+    with np.errstate(invalid='ignore'):
+        integral = (values == np.trunc(values)) & (np.abs(values) < 1e16)
+    texts[integral] = values[integral].astype(np.int64).astype(str)
+    texts[~integral] = map("%.6g".__mod__, values[~integral].tolist())
+    return texts
+
+
+def text(value):
+    if isinstance(value, Str):
+        return value.text
+    return format_numbers(value)
+
+
+def truth(value):
+    if isinstance(value, StrNum):
+        if value.numeric.all():
+            return value.num != 0
+        return np.where(value.numeric, value.num != 0, value.text != "")
+    if isinstance(value, Str):
+        return value.text != ""
+    return np.asarray(value) != 0
+
+
+def _compare(op):
+    def compare(left, right):
+        numbers = None
+        if not isinstance(left, Str) and not isinstance(right, Str):
+            return op(left, right).astype(float) if isinstance(
+                op(left, right), np.ndarray) else float(op(left, right))
+        if isinstance(left, StrNum) and isinstance(right, StrNum):
+            numbers = left.numeric & right.numeric
+        elif isinstance(left, StrNum) and not isinstance(right, Str):
+            numbers = left.numeric
+        elif isinstance(right, StrNum) and not isinstance(left, Str):
+            numbers = right.numeric
+        strings = op(_texts(text(left)) if not isinstance(left, Str) else left.text,
+                     _texts(text(right)) if not isinstance(right, Str) else right.text)
+        if numbers is None:
+            return np.asarray(strings, dtype=float)
+        return np.where(numbers, op(num(left), num(right)), strings).astype(float)
+    return compare
+
+
+# masks of the rows which count for the and/or operands being evaluated
+_open_rows = []
+
+
+def _counted(rows):
+    """ The rows among rows which count """
+    for mask in _open_rows:
+        rows = rows & mask
+    return rows
+
+
+def _boolean(first, operands, combine, open_rows):
+    """ Truth of and/or: the operands are functions, evaluated for the rows left open """
+    result = truth(first)
+    for operand in operands:
+        _open_rows.append(open_rows(result))
+        try:
+            result = combine(result, truth(operand()))
+        finally:
+            _open_rows.pop()
+    return np.asarray(result, dtype=float)
+
+
+def and_(first, *operands):
+    return _boolean(first, operands, np.logical_and, lambda result: result)
+
+
+def or_(first, *operands):
+    return _boolean(first, operands, np.logical_or, np.logical_not)
+
+
+def _numbers(func):
+    def numbers(*args):
+        with np.errstate(all='ignore'):
+            return func(*(num(arg) for arg in args))
+    return numbers
+
+
+def div(left, right):
+    """ Quotients row by row, a zero divisor stops the run if its row counts """
+    right = np.asarray(num(right), dtype=float)
+    if np.any(_counted(right == 0)):
+        raise TabkitException("Division by zero")
+    with np.errstate(all='ignore'):
+        return num(left) / right
+
+
+def sprintf(fmt, *args):
+    """ sprintf of awk, row by row """
+    values = [fmt] + list(args)
+    size = max(np.size(text(value)) for value in values)
+    texts = [np.broadcast_to(text(value), (size,)) for value in values]
+    nums = [np.broadcast_to(num(value), (size,)) for value in values]
+    return Str(_texts([
+        _sprintf(row_texts[0], row_texts[1:], row_nums[1:])
+        for row_texts, row_nums in izip(izip(*texts), izip(*nums))]))
+
+
+FUNCTIONS = {
+    'Str': Str,
+    'eq': _compare(lambda a, b: a == b),
+    'ne': _compare(lambda a, b: a != b),
+    'lt': _compare(lambda a, b: a < b),
+    'le': _compare(lambda a, b: a <= b),
+    'gt': _compare(lambda a, b: a > b),
+    'ge': _compare(lambda a, b: a >= b),
+    'and_': and_,
+    'or_': or_,
+    'add': _numbers(np.add),
+    'sub': _numbers(np.subtract),
+    'mul': _numbers(np.multiply),
+    'pow_': _numbers(lambda a, b: np.power(a, b, dtype=float)),
+    'div': div,
+    'int_': _numbers(np.trunc),
+    'log': _numbers(np.log),
+    'exp': _numbers(np.exp),
+    'bool_': lambda arg: truth(arg).astype(float),
+    'sprintf': sprintf,
+}
+
+
+class Fields(object):
+    """ Columns of a batch of lines, split on demand """
+    def __init__(self, lines):
+        self.lines = lines
+        self.table = None
+        self.rows = None
+        self.columns = {}
+
+    def __len__(self):
+        return len(self.lines)
+
+    def _split(self):
+        width = self.lines[0].count("\t") + 1 if len(self.lines) else 0
+        values = "\t".join(self.lines).split("\t")
+        # a single split for the whole batch if all the lines have the same number of fields
+        if len(values) == width * len(self.lines):
+            self.table = _texts(values).reshape(len(self.lines), width)
+        else:
+            self.rows = [line.split("\t") for line in self.lines]
+
+    def __getitem__(self, index):
+        if index not in self.columns:
+            if self.table is None and self.rows is None:
+                self._split()
+            if self.table is not None:
+                if index < self.table.shape[1]:
+                    column = self.table[:, index]
+                else:
+                    column = np.full(len(self.lines), "", dtype=object)
+            else:
+                column = _texts([row[index] if index < len(row) else "" for row in self.rows])
+            self.columns[index] = StrNum(column)
+        return self.columns[index]
+
+    def take(self, index):
+        return Fields(self.lines[index])
+
+
+class _StoredNumbers(StrNum):
+    """ Field of a column store kept as numbers: its texts are made only if needed """
+    def __init__(self, numbers, encoding):
+        self.numbers = numbers
+        self.encoding = encoding
+        self._num = numbers.astype(float)
+        self._numeric = np.ones(len(numbers), dtype=bool)
+        self._text = None
+
+    @property
+    def text(self):
+        if self._text is None:
+            if self.encoding == 'float':
+                self._text = _texts(map(repr, self.numbers.tolist()))
+            else:
+                self._text = _texts(self.numbers.astype(np.int64).astype(str))
+        return self._text
+
+    def take(self, index):
+        return _StoredNumbers(self.numbers[index], self.encoding)
+
+
+class StoreFields(Fields):
+    """ Columns of the rows start:stop of a column store, read from it as they are needed """
+    def __init__(self, store, start, stop):
+        self.store = store
+        self.start = start
+        self.stop = stop
+        self.columns = {}
+        self._lines = None
+
+    def __len__(self):
+        return self.stop - self.start
+
+    @property
+    def lines(self):
+        if self._lines is None:
+            self._lines = _texts(self.store.lines(self.start, self.stop))
+        return self._lines
+
+    def __getitem__(self, index):
+        if index not in self.columns:
+            if index >= len(self.store.data_desc):
+                column = StrNum(np.full(len(self), "", dtype=object))
+            else:
+                numbers = self.store.numbers(index, self.start, self.stop)
+                if numbers is not None:
+                    column = _StoredNumbers(numbers, self.store.encoding(index))
+                else:
+                    column = StrNum(_texts(self.store.texts(index, self.start, self.stop)))
+            self.columns[index] = column
+        return self.columns[index]
+
+    def take(self, index):
+        return _TakenFields(self, index)
+
+
+class _TakenFields(object):
+    """ Columns of some of the rows of other fields """
+    def __init__(self, fields, index):
+        self.fields = fields
+        self.index = index
+
+    def __getitem__(self, index):
+        return take(self.fields[index], self.index)
+
+
+def file_batches(files, size=BATCH_SIZE):
+    """ Batches of the files: columns of column stores, lines of the other files """
+    for f in files.files:
+        store = getattr(f, 'store', None)
+        if store is None:
+            for batch in batches(f, size):
+                yield batch
+        else:
+            for start in xrange(0, store.rows, size):
+                yield StoreFields(store, start, min(start + size, store.rows))
+
+
+def batches(lines, size=BATCH_SIZE):
+    """ Lines without line ends, by batches of numpy arrays """
+    lines = iter(lines)
+    while True:
+        batch = list(islice(lines, size))
+        if not batch:
+            return
+        text = "".join(batch)
+        if text.count("\n") == len(batch) - (not text.endswith("\n")):
+            # a single split for the whole batch unless the last lines of files lack line ends
+            batch = (text[:-1] if text.endswith("\n") else text).split("\n")
+        else:
+            batch = [line.rstrip("\n") for line in batch]
+        yield _texts(batch)
+
+
+def _broadcast(value, size):
+    return np.broadcast_to(text(value), (size,))
+
+
+def _write_rows(output, columns):
+    if columns:
+        output.write("".join(["%s\n" % row for row in imap("\t".join, izip(*columns))]))
+
+
+def columnar_map(data_desc, output_exprs, filter_exprs=None):
+    """
+    Map function of a batch of lines (or Fields) to the output text, the second result is
+    the output data_desc
+
+    >>> from ..header import parse_header
+    >>> import sys
+    >>> mapper, data_desc = columnar_map(
+    ...     parse_header("# a, b:int"), ['a', 'x=b/4', 'y=sprintf("%03d", b)'], ['b>1 or a=="z"'])
+    >>> mapper(next(batches(["p\\t1\\n", "q\\t2\\n", "z\\t0\\n", "r\\t10\\n"])), sys.stdout)
+    ... # doctest: +NORMALIZE_WHITESPACE
+    q	0.5	002
+    z	0	000
+    r	2.5	010
+    """
+    code, output_data_desc = py_map(data_desc, output_exprs, filter_exprs, lazy_operands=True)
+    cond = "and_(%s)" % ",".join(
+        code.output_cond[:1] + ["lambda:%s" % cond for cond in code.output_cond[1:]]
+    ) if code.output_cond else "None"
+    output = "[%s]" % ",".join(code.output) if code.output else "None"
+    function = compile_function(
+        "columnar_map", ["f"], code.row_exprs, "%s, %s" % (cond, output), FUNCTIONS)
+
+    def mapper(lines, output_file):
+        fields = lines if isinstance(lines, Fields) else Fields(lines)
+        size = len(fields)
+        cond, columns = function(fields)
+        if cond is None:
+            mask = None
+        else:
+            mask = np.broadcast_to(truth(cond), (size,))
+        if columns is None:
+            selected = fields.lines if mask is None else fields.lines[mask]
+            output_file.write("".join("%s\n" % line for line in selected))
+            return
+        if mask is not None:
+            # only the rows passing the filter are formatted
+            columns = [take(full(column, size), mask) for column in columns]
+            _write_rows(output_file, [_broadcast(column, mask.sum()) for column in columns])
+        else:
+            _write_rows(output_file, [_broadcast(column, size) for column in columns])
+
+    return mapper, output_data_desc
+
+
+def full(value, size):
+    """ Value of every row, constants are repeated """
+    if isinstance(value, Str):
+        # the texts of stored numbers are made only if printed
+        if isinstance(value, _StoredNumbers) or (
+                isinstance(value.text, np.ndarray) and value.text.ndim):
+            return value
+        return value.__class__(np.broadcast_to(_texts([value.text]), (size,)))
+    return np.broadcast_to(np.asarray(value, dtype=float), (size,))
+
+
+def _sequential_sums(values, starts, lengths):
+    """
+    Sums of the runs of values added up one by one. The runs of lengths within a power of two
+    are laid out as the rows of a matrix, padded with zeros, and added up by cumsum along the
+    rows: sum adds pairwise.
+
+    >>> _sequential_sums(np.array([1e16, 1., 1., 2., 3.]), np.array([0, 3]), np.array([3, 2]))
+    array([1.e+16, 5.e+00])
+    """
+    sums = np.zeros(len(starts))
+    _, bits = np.frexp(lengths)
+    for width_bits in np.unique(bits):
+        runs = np.flatnonzero(bits == width_bits)
+        offsets = np.arange(lengths[runs].max())
+        index = starts[runs][:, np.newaxis] + offsets
+        padded = offsets < lengths[runs][:, np.newaxis]
+        rows = np.where(padded, values[np.where(padded, index, 0)], 0.0)
+        sums[runs] = np.cumsum(rows, axis=1)[:, -1]
+    return sums
+
+
+class _Aggregate(object):
+    """ Aggregates of the runs of rows with equal keys in a batch """
+    def __init__(self, name):
+        self.name = name
+
+    def runs(self, value, starts, ends, total, carried=None):
+        """
+        Aggregates of the runs starting at starts and ending at ends (inclusive), the first
+        one continues the carried aggregate if any. Cumulative aggregates continue the total.
+        """
+        lengths = ends - starts + 1
+        if self.name in ('count', 'cumcount'):
+            counts = lengths.astype(float)
+            if self.name == 'cumcount':
+                return np.cumsum(counts) + total
+            if carried is not None:
+                counts[0] += carried[0]
+            return counts
+        if self.name in ('sum', 'cumsum'):
+            # awk adds the values one by one, so does cumsum, unlike the pairwise sum of numpy
+            values = np.array(num(value), dtype=float)
+            if self.name == 'cumsum':
+                values[0] += total
+                return np.cumsum(values)[ends]
+            if carried is not None:
+                values[0] += carried[0]
+            return _sequential_sums(values, starts, lengths)
+        extremes = self._extremes(value, starts, ends)
+        if carried is not None and not FUNCTIONS[self.better](take(extremes, [0]), carried)[0]:
+            return concat([carried, take(extremes, slice(1, None))])
+        return extremes
+
+    @property
+    def better(self):
+        return 'gt' if self.name == 'max' else 'lt'
+
+    def _extremes(self, value, starts, ends):
+        # the first of the greatest (least) values of a run, compared the awk way
+        lengths = ends - starts + 1
+        mixed = ()
+        if type(value) is Str:
+            keys = _ranks(value.text)
+        elif isinstance(value, StrNum) and not value.numeric.all():
+            # values compare as numbers if both look numeric and as strings otherwise, so
+            # the runs of either kind are ordered by numbers or texts, mixed ones row by row
+            numeric = np.add.reduceat(value.numeric.astype(int), starts)
+            mixed = np.flatnonzero((numeric > 0) & (numeric < lengths))
+            keys = np.where(value.numeric, value.num, _ranks(value.text))
+        else:
+            keys = num(value)
+        best = (np.fmax if self.name == 'max' else np.fmin).reduceat(keys, starts)
+        # the first row of a run with its best key, the first row if none is (nan)
+        size = len(keys)
+        rows = np.where(keys == np.repeat(best, lengths), np.arange(size), size)
+        indices = np.minimum.reduceat(rows, starts)
+        indices = np.where(indices < size, indices, starts)
+        for run in mixed:
+            indices[run] = self._extreme_by_row(value, starts[run], ends[run])
+        return take(value, indices)
+
+    def _extreme_by_row(self, value, start, end):
+        better = FUNCTIONS[self.better]
+        best = start
+        for index in xrange(start + 1, end + 1):
+            if better(take(value, [index]), take(value, [best]))[0]:
+                best = index
+        return best
+
+
+def _differ(left, right):
+    """ Rows where the keys differ, fields compared by their texts first """
+    if type(left) is StrNum and type(right) is StrNum:
+        # equal texts are equal values, the numbers of the other rows may still be
+        differ = left.text != right.text
+        rows = np.flatnonzero(differ)
+        if len(rows):
+            differ[rows] = FUNCTIONS['ne'](take(left, rows), take(right, rows)) != 0
+        return differ
+    return FUNCTIONS['ne'](left, right) != 0
+
+
+def columnar_group(data_desc, grp_exprs, aggr_exprs=None):
+    """
+    Group function of batches of lines (or Fields) sorted by the group keys writing the output
+    text, the second result is the output data_desc
+
+    >>> from ..header import parse_header
+    >>> import sys
+    >>> grouper, data_desc = columnar_group(
+    ...     parse_header("# a, b:int"), ['a'], ['n=count()', 'm=max(b)', 's=cumsum(b)/2'])
+    >>> grouper([_texts(["p\\t1", "p\\t07", "q\\t2"]), _texts(["q\\t5", "r\\t3"])], sys.stdout)
+    ... # doctest: +NORMALIZE_WHITESPACE
+    p	2	07	4
+    q	2	5	7.5
+    r	1	3	9
+    """
+    code, output_data_desc = py_group(
+        data_desc, grp_exprs, aggr_exprs,
+        functions=('count', 'sum', 'min', 'max', 'cumsum', 'cumcount'), lazy_operands=True)
+
+    aggregates = [_Aggregate(aggregate.name) for aggregate in code.aggregates]
+    args = ",".join(aggregate.args[0] if aggregate.args else "None" for aggregate in code.aggregates)
+    keys_function = compile_function(
+        "columnar_keys", ["f"], code.grp_exprs,
+        "[%s], [%s]" % (",".join(code.grp_keys), args), FUNCTIONS)
+    output_function = compile_function(
+        "columnar_output", ["f"] + [aggregate.var_name for aggregate in code.aggregates],
+        code.grp_exprs + code.aggr_exprs, "[%s]" % ",".join(code.aggr_output), FUNCTIONS)
+    key_outputs = [code.grp_keys.index(expr) for expr in code.grp_output]
+
+    def grouper(batches, output_file):
+        # the last run of a batch, which may continue in the next one
+        last = None
+        totals = [0.0] * len(aggregates)
+        for lines in batches:
+            fields = lines if isinstance(lines, Fields) else Fields(lines)
+            size = len(fields)
+            keys, values = keys_function(fields)
+            keys = [full(key, size) for key in keys]
+            values = [full(value, size) for value in values]
+
+            starts = np.zeros(size, dtype=bool)
+            starts[0] = last is None
+            for key, last_key in izip(keys, last['keys'] if last else [None] * len(keys)):
+                if last_key is not None:
+                    starts[0] |= _differ(take(key, [0]), last_key)[0]
+                if size > 1:
+                    starts[1:] |= _differ(take(key, slice(1, None)), take(key, slice(None, -1)))
+            if last is not None and starts[0]:
+                _write_rows(output_file, last['output'])
+
+            run_starts = np.flatnonzero(starts)
+            if not starts[0]:
+                run_starts = np.concatenate([[0], run_starts])
+            ends = np.concatenate([run_starts[1:] - 1, [size - 1]])
+
+            continued = last is not None and not starts[0]
+            results = [
+                aggregate.runs(value, run_starts, ends, total,
+                               last['values'][index] if continued else None)
+                for index, (aggregate, value, total) in enumerate(izip(aggregates, values, totals))]
+            totals = [
+                float(num(take(result, [-1]))[0]) if aggregate.name.startswith('cum') else 0.0
+                for aggregate, result in izip(aggregates, results)]
+            first_keys = [take(key, run_starts) for key in keys]
+            if continued:
+                first_keys = [
+                    concat([last_key, take(key, slice(1, None))])
+                    for last_key, key in izip(last['first_keys'], first_keys)]
+
+            # the groups print keys of their first rows, other values of their last rows
+            outputs = output_function(fields.take(ends), *results)
+            columns = [_broadcast(first_keys[index], len(ends)) for index in key_outputs]
+            columns.extend(_broadcast(output, len(ends)) for output in outputs)
+            _write_rows(output_file, [column[:-1] for column in columns])
+            last = {
+                'keys': [take(key, [-1]) for key in keys],
+                'first_keys': [take(key, [-1]) for key in first_keys],
+                'values': [take(result, [-1]) for result in results],
+                'output': [column[-1:] for column in columns],
+            }
+        if last is not None:
+            _write_rows(output_file, last['output'])
+
+    return grouper, output_data_desc
@@ -0,0 +1,242 @@
+import ast
+
+from ..awk.map import AwkGenerator, OutputAwkGenerator, ConditionAwkGenerator, Expression
+from ..awk.group import (
+    GroupKeysAwkGenerator, AggregateAwkGenerator, SimpleAggregateExpressions, _visit_exprs
+)
+from ..exception import TabkitException
+from ..type import infer_type
+
+
+class PyGenerator(AwkGenerator):
+    """
+    Generates Python code instead of awk code from the same expressions. The code calls
+    the functions of an engine, which give the values the awk semantics: fields are
+    strings which compare as numbers if they look like numbers, and so on.
+
+    The operands of and/or are evaluated only if the previous ones leave the result open, as
+    in awk: with Python's and/or over their truth, or with lazy_operands as functions passed
+    to and_/or_ of the engine, which evaluates them over the rows left open.
+
+    >>> from ..header import parse_header
+    >>> generator = OutputPyGenerator(parse_header("# a, b:int"))
+    >>> generator.visit(ast.parse('x=a*2+b;y=log(b)>1 or a=="z"'))
+    ['__var__0=add(mul(f[0],2.0),f[1])', "__var__1=(1.0 if truth(gt(log(f[1]),1.0)) or truth(eq(f[0],Str('z'))) else 0.0)"]
+    >>> str(generator.output_data_desc())
+    '# x:int\\ty:bool'
+    >>> OutputPyGenerator(parse_header("# a"), lazy_operands=True).visit(ast.parse('x=a and 1/a'))
+    ['__var__0=and_(f[0],lambda:div(1.0,f[0]))']
+    """
+    compare_funcs = {
+        ast.Eq: 'eq',
+        ast.NotEq: 'ne',
+        ast.Lt: 'lt',
+        ast.LtE: 'le',
+        ast.Gt: 'gt',
+        ast.GtE: 'ge'
+    }
+
+    boolop_funcs = {
+        ast.And: 'and_',
+        ast.Or: 'or_'
+    }
+
+    boolop_keywords = {
+        ast.And: 'and',
+        ast.Or: 'or'
+    }
+
+    binop_funcs = {
+        ast.Add: 'add',
+        ast.Sub: 'sub',
+        ast.Mult: 'mul',
+        ast.Pow: 'pow_',
+        ast.Div: 'div'
+    }
+
+    func_names = {
+        'int': 'int_',
+        'sprintf': 'sprintf',
+        'log': 'log',
+        'exp': 'exp',
+        'bool': 'bool_'
+    }
+
+    def __init__(self, data_desc, context=None, lazy_operands=False, **kwargs):
+        self.lazy_operands = lazy_operands
+        kwargs.setdefault('field_codes', ["f[%d]" % index for index in xrange(len(data_desc))])
+        super(PyGenerator, self).__init__(data_desc, context, **kwargs)
+
+    # the awk code of AwkGenerator is skipped, the checks of AwkNodeVisitor are not
+
+    def visit_Compare(self, node):
+        left_expr, right_expr = super(AwkGenerator, self).visit_Compare(node)
+        op = type(node.ops[0])
+        return Expression(
+            code="%s(%s,%s)" % (self.compare_funcs[op], left_expr.code, right_expr.code),
+            type=infer_type(self.compareops[op], left_expr.type, right_expr.type),
+            children=[left_expr, right_expr]
+        )
+
+    def visit_BoolOp(self, node):
+        exprs = super(AwkGenerator, self).visit_BoolOp(node)
+        op = type(node.op)
+        if self.lazy_operands:
+            code = "%s(%s)" % (self.boolop_funcs[op], ",".join(
+                [exprs[0].code] + ["lambda:%s" % expr.code for expr in exprs[1:]]))
+        else:
+            code = "(1.0 if %s else 0.0)" % (" %s " % self.boolop_keywords[op]).join(
+                "truth(%s)" % expr.code for expr in exprs)
+        return Expression(
+            code=code,
+            type=infer_type(self.boolops[op], *(expr.type for expr in exprs)),
+            children=exprs
+        )
+
+    def visit_BinOp(self, node):
+        left_expr, right_expr = super(AwkGenerator, self).visit_BinOp(node)
+        op = type(node.op)
+        return Expression(
+            code="%s(%s,%s)" % (self.binop_funcs[op], left_expr.code, right_expr.code),
+            type=infer_type(self.binops[op], left_expr.type, right_expr.type),
+            children=[left_expr, right_expr]
+        )
+
+    def visit_Num(self, node):
+        return Expression(
+            code=repr(float(node.n)),
+            type=type(node.n)
+        )
+
+    def visit_Str(self, node):
+        return Expression(
+            code="Str(%r)" % node.s,
+            type=str
+        )
+
+    def visit_Function(self, node):
+        func = self.funcs[node.func.id]
+        args = super(AwkGenerator, self).visit_Function(node)
+        return Expression(
+            code="%s(%s)" % (self.func_names[node.func.id], ",".join(arg.code for arg in args)),
+            type=func.type,
+            children=args
+        )
+
+
+class OutputPyGenerator(OutputAwkGenerator, PyGenerator):
+    pass
+
+
+class ConditionPyGenerator(ConditionAwkGenerator, PyGenerator):
+    pass
+
+
+class GroupKeysPyGenerator(GroupKeysAwkGenerator, PyGenerator):
+    pass
+
+
+class PyAggregate(object):
+    """ Aggregate function computed by an engine: the values of args are aggregated in var_name """
+    # no code per row, the engine aggregates the arguments itself
+    code = None
+
+    def __init__(self, name, var_name, args, type):
+        self.name = name
+        self.var_name = var_name
+        self.args = args
+        self.type = type
+
+
+class AggregatePyGenerator(AggregateAwkGenerator, PyGenerator):
+    def __init__(self, data_desc, context=None, group_context=None, functions=None, **kwargs):
+        super(AggregatePyGenerator, self).__init__(data_desc, context, group_context, **kwargs)
+        # aggregate functions supported by the engine
+        self.functions = functions
+
+    def aggregate_function(self, node, var_name, args):
+        name = node.func.id
+        if self.functions is not None and name not in self.functions:
+            raise TabkitException("Syntax error: aggregate function '%s' is not supported" % name)
+        func = super(AggregatePyGenerator, self).aggregate_function(node, var_name, args)
+        return PyAggregate(name, var_name, [arg.code for arg in args], func.type)
+
+    def visit_Module(self, node):
+        return [code for code in super(AggregatePyGenerator, self).visit_Module(node) if code]
+
+
+class PyMap(object):
+    """
+    Code of a map: row statements, then the filter conditions and the outputs,
+    no outputs stand for the input line as is
+
+    >>> from ..header import parse_header
+    >>> code, data_desc = py_map(parse_header("# a, b:int"), ['x=b*2', 'a'], ['x>b'])
+    >>> code.row_exprs, code.output_cond, code.output
+    (['__var__0=mul(f[1],2.0)'], ['gt(__var__0,f[1])'], ['__var__0', 'f[0]'])
+    >>> str(data_desc)
+    '# x:int\\ta'
+    """
+    def __init__(self, row_exprs=None, output_cond=None, output=None):
+        self.row_exprs = row_exprs or []
+        self.output_cond = output_cond or []
+        self.output = output or []
+
+
+def py_map(data_desc, output_exprs, filter_exprs=None, lazy_operands=False):
+    code = PyMap()
+    output = OutputPyGenerator(data_desc, lazy_operands=lazy_operands)
+    code.row_exprs.extend(_visit_exprs(output, output_exprs, "output"))
+    code.output.extend(output.output_code())
+    cond = ConditionPyGenerator(data_desc, output.context, lazy_operands=lazy_operands,
+                                var_count=output.var_count)
+    code.output_cond.extend(_visit_exprs(cond, filter_exprs or [], "filter"))
+    return code, output.output_data_desc() if output_exprs else data_desc
+
+
+class PyGroup(object):
+    """
+    Code of a group by sorted keys: row statements computing the group keys and the
+    arguments of the aggregates, then the aggregate statements and the output.
+
+    >>> from ..header import parse_header
+    >>> code, data_desc = py_group(parse_header("# a, b:int"), ['a'], ['n=count()', 'avg=sum(b)/n'])
+    >>> code.grp_keys, code.grp_output, code.aggr_exprs, code.aggr_output
+    (['f[0]'], ['f[0]'], ['__aggr__2=div(__aggr__1,__aggr__0)'], ['__aggr__0', '__aggr__2'])
+    >>> [(aggr.name, aggr.var_name, aggr.args) for aggr in code.aggregates]
+    [('count', '__aggr__0', []), ('sum', '__aggr__1', ['f[1]'])]
+    >>> str(data_desc)
+    '# a\\tn:int\\tavg:float'
+    """
+    def __init__(self):
+        self.grp_exprs = []
+        self.grp_keys = []
+        self.grp_output = []
+        self.aggregates = []
+        self.aggr_exprs = []
+        self.aggr_output = []
+
+
+def py_group(data_desc, grp_exprs, aggr_exprs=None, functions=None, lazy_operands=False):
+    code = PyGroup()
+    group = GroupKeysPyGenerator(data_desc, lazy_operands=lazy_operands)
+    code.grp_exprs.extend(_visit_exprs(group, grp_exprs, "group"))
+    code.grp_keys.extend(group.group_keys())
+    code.grp_output.extend(group.output_code())
+
+    aggr = AggregatePyGenerator(data_desc, group_context=group.context, functions=functions,
+                                lazy_operands=lazy_operands, var_count=group.var_count)
+    code.aggr_exprs.extend(_visit_exprs(aggr, aggr_exprs or [], "aggregate"))
+    code.aggregates.extend(aggr.aggregators)
+    code.aggr_output.extend(aggr.output_code())
+
+    return code, group.output_data_desc() + aggr.output_data_desc()
+
+
+def compile_function(name, args, statements, result, namespace):
+    """ Function of args running the statements and returning the result, in the namespace """
+    source = "def %s(%s):\n%s    return %s\n" % (
+        name, ", ".join(args), "".join("    %s\n" % statement for statement in statements), result)
+    namespace = dict(namespace)
+    exec compile(source, "<%s>" % name, "exec") in namespace
+    return namespace[name]
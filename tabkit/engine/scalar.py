@@ -0,0 +1,281 @@
+"""
+Scalar engine: expressions are compiled to a Python function of a row and evaluated in
+process, with no awk to spawn. Values follow the awk semantics of the awk programs: fields
+are strings which compare as numbers if they look like numbers, numbers are printed as
+integers or with %.6g.
+"""
+import re
+import math
+
+from .generator import py_map, compile_function
+from ..exception import TabkitException
+
+
+_num_prefix = r'[ \t\n]*[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?'
+_num_prefix_re = re.compile(_num_prefix)
+_numeric_re = re.compile(_num_prefix + r'[ \t\n]*$')
+
+INF = float('inf')
+NAN = float('nan')
+# the integers of %d and the like infinities and nan end up as, as mawk converts them
+MAX_INT = 2 ** 31 - 1
+MAX_UINT = 2 ** 32 - 1
+
+
+def _to_number(text):
+    match = _num_prefix_re.match(text)
+    return float(match.group(0)) if match else 0.0
+
+
+def _text_number(text):
+    try:
+        number = float(text)
+    except ValueError:
+        return _to_number(text)
+    # python takes nan and inf for numbers, awk doesn't
+    return number if number - number == 0 else _to_number(text)
+
+
+def _looks_numeric(text):
+    try:
+        number = float(text)
+    except ValueError:
+        return False
+    return number - number == 0 or _numeric_re.match(text) is not None
+
+
+class Str(str):
+    """ String value, a constant or a sprintf result: never compared as a number """
+    __slots__ = ()
+
+
+def num(value):
+    if type(value) is float:
+        return value
+    if isinstance(value, basestring):
+        return _text_number(value)
+    return float(value)
+
+
+def format_number(value):
+    """
+    >>> [format_number(v) for v in [3.0, -0.5, 1e20, 2, True]]
+    ['3', '-0.5', '1e+20', '2', '1']
+    """
+    value = float(value)
+    if abs(value) < 1e16 and value == int(value):
+        return "%d" % value
+    return "%.6g" % value
+
+
+def text(value):
+    if isinstance(value, basestring):
+        return value
+    return format_number(value)
+
+
+def truth(value):
+    if isinstance(value, Str):
+        return value != ""
+    if isinstance(value, basestring):
+        return _text_number(value) != 0 if _looks_numeric(value) else value != ""
+    return value != 0
+
+
+def _comparable(value):
+    """ Number to compare the value as, None if it compares as a string """
+    if isinstance(value, Str):
+        return None
+    if isinstance(value, basestring):
+        return _text_number(value) if _looks_numeric(value) else None
+    return float(value)
+
+
+def _compare(op):
+    def compare(left, right):
+        left_num = _comparable(left)
+        right_num = _comparable(right)
+        if left_num is not None and right_num is not None:
+            return float(op(left_num, right_num))
+        return float(op(text(left), text(right)))
+    return compare
+
+
+def div(left, right):
+    right = num(right)
+    if right == 0:
+        raise TabkitException("Division by zero")
+    return num(left) / right
+
+
+def pow_(left, right):
+    left, right = num(left), num(right)
+    try:
+        return left ** right
+    except ZeroDivisionError:
+        return INF
+    except ValueError:
+        return NAN
+    except OverflowError:
+        return -INF if left < 0 and right % 2 == 1 else INF
+
+
+def int_(value):
+    value = num(value)
+    return float(math.trunc(value)) if value - value == 0 else value
+
+
+def log(value):
+    value = num(value)
+    if value > 0:
+        return math.log(value)
+    return -INF if value == 0 else NAN
+
+
+def exp(value):
+    try:
+        return math.exp(num(value))
+    except OverflowError:
+        return INF
+
+
+def sprintf(fmt, *args):
+    return Str(_sprintf(text(fmt), [text(arg) for arg in args], [num(arg) for arg in args]))
+
+
+_format_re = re.compile(r'%([-+ #0]*\d*(?:\.\d*)?)([a-zA-Z%])')
+
+
+def _integer(value, unsigned=False):
+    """
+    Integer of the value for %d (%u, %x...) conversions
+
+    >>> [_integer(value) for value in [2.7, -2.7, INF, -INF, NAN]]
+    [2, -2, 2147483647, -2147483647, -2147483647]
+    >>> [_integer(value, unsigned=True) for value in [INF, -INF, NAN]]
+    [4294967295, 0, 0]
+    """
+    # numpy numbers of the columnar engine would warn about inf - inf
+    value = float(value)
+    if value - value == 0:
+        return int(value)
+    if unsigned:
+        return MAX_UINT if value == INF else 0
+    return MAX_INT if value == INF else -MAX_INT
+
+
+def _sprintf(fmt, texts, nums):
+    """
+    sprintf of awk given the texts and numbers of the arguments; %c of an empty string is
+    empty, where mawk outputs a NUL character
+
+    >>> _sprintf("[%c][%3c][%-2c]", ["ab", "", ""], [0.0, 0.0, 0.0])
+    '[a][   ][  ]'
+    """
+    args = iter(xrange(len(texts)))
+
+    def conversion(match):
+        flags, conv = match.groups()
+        if conv == '%':
+            return '%'
+        index = next(args, None)
+        if index is None:
+            return ''
+        if conv in 'di':
+            return ('%' + flags + 'd') % _integer(nums[index])
+        if conv in 'ouxX':
+            return ('%' + flags + conv) % _integer(nums[index], unsigned=True)
+        if conv in 'eEfgG':
+            return ('%' + flags + conv) % nums[index]
+        if conv == 'c':
+            return ('%' + flags + 's') % texts[index][:1]
+        return ('%' + flags + 's') % texts[index]
+    return _format_re.sub(conversion, fmt)
+
+
+FUNCTIONS = {
+    'Str': Str,
+    'text': text,
+    'truth': truth,
+    'eq': _compare(lambda a, b: a == b),
+    'ne': _compare(lambda a, b: a != b),
+    'lt': _compare(lambda a, b: a < b),
+    'le': _compare(lambda a, b: a <= b),
+    'gt': _compare(lambda a, b: a > b),
+    'ge': _compare(lambda a, b: a >= b),
+    'add': lambda a, b: num(a) + num(b),
+    'sub': lambda a, b: num(a) - num(b),
+    'mul': lambda a, b: num(a) * num(b),
+    'pow_': pow_,
+    'div': div,
+    'int_': int_,
+    'log': log,
+    'exp': exp,
+    'bool_': lambda arg: float(truth(arg)),
+    'sprintf': sprintf,
+}
+
+
+def compile_map(data_desc, output_exprs=None, filter_exprs=None):
+    r'''
+    Map function of a row to the list of output values as awk prints them, None if the row
+    is filtered out; the second result is the output data_desc. A row is a sequence of
+    field values: strings as read from a file, or values of a parse_file row. Without
+    output expressions all the fields are output.
+
+    >>> from ..header import parse_header
+    >>> from ..utils import parse_file
+    >>> mapper, data_desc = compile_map(
+    ...     parse_header("# a, b:int"), ['a', 'x=b/4', 'y=sprintf("%03d", b)'], ['b>1 or a=="z"'])
+    >>> str(data_desc)
+    '# a\tx:float\ty'
+    >>> [mapper(row) for row in [['p', '1'], ['q', '2'], ['z', '0'], ['r', '10']]]
+    [None, ['q', '0.5', '002'], ['z', '0', '000'], ['r', '2.5', '010']]
+
+    >>> rows = parse_file(["# a, b:int, c:bool", "x\t3\t1", "y\t1\t0"])
+    >>> mapper, data_desc = compile_map(rows.data_desc, filter_exprs=['b>2 and c'])
+    >>> [mapper(row) for row in rows]
+    [['x', '3', '1'], None]
+    >>> compile_map(rows.data_desc, ['x=c*2'], ['a>"w"'])[0].fields
+    [0, 2]
+    '''
+    code, output_data_desc = py_map(data_desc, output_exprs or [], filter_exprs)
+    statements = list(code.row_exprs)
+    if code.output_cond:
+        statements.append("if not (%s): return None" % " and ".join(
+            "truth(%s)" % cond for cond in code.output_cond))
+    if code.output:
+        output = "[%s]" % ",".join("text(%s)" % value for value in code.output)
+        source = " ".join(statements + [output])
+        fields = sorted(set(int(index) for index in _field_re.findall(source)))
+    else:
+        output = "[text(value) for value in f]"
+        fields = range(len(data_desc))
+    function = compile_function("compiled_map", ["f"], statements, output, FUNCTIONS)
+    # the indices of the fields the function reads, the rest may be anything
+    function.fields = fields
+    return function, output_data_desc
+
+
+_field_re = re.compile(r'\bf\[(\d+)\]')
+
+
+def map_lines(mapper, width, lines, output_file, whole_lines=False):
+    """ Map lines of width fields to the output file, whole_lines outputs the lines as is """
+    for line in lines:
+        if not line.endswith("\n"):
+            line += "\n"
+        fields = line[:-1].split("\t")
+        if len(fields) < width:
+            fields.extend([""] * (width - len(fields)))
+        values = mapper(fields)
+        if values is not None:
+            output_file.write("%s\n" % "\t".join(values) if not whole_lines else line)
+
+
+def map_rows(mapper, rows, output_file):
+    """ Map rows of field values to the output file """
+    for row in rows:
+        values = mapper(row)
+        if values is not None:
+            output_file.write("%s\n" % "\t".join(values))
@@ -31,6 +31,14 @@ class OrderField(object):
     def __iter__(self):
         return iter((self.name, self.type, self.desc))
 
+    def __eq__(self, other):
+        return (isinstance(other, OrderField)
+                and (self.name, self.type, bool(self.desc)) ==
+                    (other.name, other.type, bool(other.desc)))
+
+    def __ne__(self, other):
+        return not self == other
+
 
 def _field_list(iterable, class_):
     return [class_(*field) if not isinstance(field, class_) else field for field in iterable]
@@ -85,6 +93,23 @@ class DataDesc(object):
         return namedtuple('DataRow', self.field_names)
 
 
+def common_order(order1, order2):
+    """
+    Length of the common prefix of two orders
+
+    >>> common_order(
+    ...     parse_header("# a, b, c # ORDER: a, b:desc, c").order,
+    ...     parse_header("# a, b, c # ORDER: a, b:str:desc, c:num").order)
+    2
+    """
+    length = 0
+    for field1, field2 in zip(order1, order2):
+        if field1 != field2:
+            break
+        length += 1
+    return length
+
+
 def concat_data_desc(desc1, desc2):
     R'''
     >>> desc = parse_header("# a:int, b:bool # ORDER: a:num:desc, b")
@@ -0,0 +1,205 @@
+"""
+Sparse index of a regular file sorted by the ORDER of its header: the order fields of every
+step-th line with the offset of the line. It is kept in a sidecar file next to the indexed
+one, valid as long as the header, the size and the mtime of the file stay the same.
+
+A lookup bisects the keys of the index and reads the file from the last line indexed before
+the first key looked up, so it reads at most step lines it doesn't output.
+"""
+import os
+import json
+import mmap
+import tempfile
+from bisect import bisect_left
+
+from .sort import order_key
+from .exception import TabkitException
+
+
+INDEX_SUFFIX = ".tidx"
+# lines per key of the index
+INDEX_STEP = 4096
+
+
+def index_path(f):
+    """ Path of the sidecar index of a file, None if it has no name to put one next to """
+    name = getattr(f.fd, 'name', None)
+    if not name or name.startswith("<"):
+        return None
+    return name + INDEX_SUFFIX
+
+
+def _order_indices(data_desc):
+    return [data_desc.index(order.name) for order in data_desc.order]
+
+
+class SparseIndex(object):
+    r'''
+    >>> from .utils import RegularFile
+    >>> with tempfile.NamedTemporaryFile() as fd:
+    ...     fd.write("# k, n:int # ORDER: k, n:num:desc\n")
+    ...     fd.write("".join("%s\t%d\n" % (k, n) for k in "abc" for n in [20, 10, 9, 9]))
+    ...     fd.flush()
+    ...     index = build_index(RegularFile(open(fd.name)), step=3)
+    ...     index.entries
+    ...     list(index.lookup(['b']))
+    ...     list(index.lookup(['a', '9'], ['b', '10']))
+    ...     list(index.lookup(['c', '100'])), list(index.lookup(['d']))
+    [(0, ['a', '20']), (14, ['a', '9']), (28, ['b', '9']), (41, ['c', '10'])]
+    ['b\t20', 'b\t10', 'b\t9', 'b\t9']
+    ['a\t9', 'a\t9', 'b\t20', 'b\t10']
+    ([], [])
+    '''
+    def __init__(self, f, meta, entries):
+        self.file = f
+        self.meta = meta
+        # offsets of the data and the values of the order fields of the lines
+        self.entries = entries
+        self._keys = {}
+
+    def valid(self):
+        stat = os.fstat(self.file.fd.fileno())
+        return (self.meta['header'] == str(self.file.data_desc()) and
+                self.meta['size'] == stat.st_size and self.meta['mtime'] == stat.st_mtime)
+
+    def bound_key(self, values):
+        """ Key of the lines with these values of the first order fields """
+        data_desc = self.file.data_desc()
+        if len(values) > len(data_desc.order):
+            raise TabkitException("Key has %d values, whereas ORDER has %d fields" %
+                                  (len(values), len(data_desc.order)))
+        return order_key(data_desc, len(values))(self._fields(values))
+
+    def _fields(self, values):
+        """ Fields of a line with these values of the first order fields """
+        data_desc = self.file.data_desc()
+        fields = [''] * len(data_desc)
+        for index, value in zip(_order_indices(data_desc), values):
+            fields[index] = value
+        return fields
+
+    def lookup(self, low, high=None):
+        """
+        Lines without line ends of keys from low to high (in the order of the file), the keys
+        are lists of values of the first order fields, the lines of the low key by default,
+        all the lines to the end if high is empty
+        """
+        high = low if high is None else high
+        low_key, high_key = self.bound_key(low), self.bound_key(high)
+        data_desc = self.file.data_desc()
+        position = 0
+        if low:
+            # the lines of the low key may start before the first entry of it
+            entry = bisect_left(self._entry_keys(len(low)), low_key) - 1
+            position = self.entries[entry][0] if entry >= 0 else 0
+        return self._scan(position, order_key(data_desc), low_key, high_key)
+
+    def _entry_keys(self, count):
+        """ Keys of the entries by the first count order fields """
+        if count not in self._keys:
+            key = order_key(self.file.data_desc(), count)
+            self._keys[count] = [key(self._fields(values)) for offset, values in self.entries]
+        return self._keys[count]
+
+    def _scan(self, position, key, low_key, high_key):
+        fd = self.file.fd.fileno()
+        size = os.fstat(fd).st_size
+        start = self.meta['offset']
+        if size <= start:
+            return
+        data = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        try:
+            low_count, high_count = len(low_key), len(high_key)
+            position += start
+            while position < size:
+                end = data.find("\n", position)
+                end = size if end < 0 else end
+                line = data[position:end]
+                line_key = key(line.split("\t"))
+                if high_count and line_key[:high_count] > high_key:
+                    break
+                if line_key[:low_count] >= low_key:
+                    yield line
+                position = end + 1
+        finally:
+            data.close()
+
+
+def build_index(f, step=INDEX_STEP):
+    """ Index of a RegularFile, the keys indexed are checked to be in order """
+    data_desc = f.data_desc()
+    if not data_desc.order:
+        raise TabkitException("File has no ORDER to index")
+    stat = os.fstat(f.fd.fileno())
+    meta = {
+        'header': str(data_desc),
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'offset': f.offset,
+        'step': step,
+    }
+    order_indices = _order_indices(data_desc)
+    key = order_key(data_desc)
+    entries = []
+    last_key = None
+    offset = 0
+    number = 0
+    for lines in f.line_batches():
+        for line in lines:
+            if not number % step:
+                fields = line.split("\t")
+                line_key = key(fields)
+                if last_key is not None and line_key < last_key:
+                    raise TabkitException("File isn't sorted by its ORDER at byte %d" %
+                                          (f.offset + offset))
+                last_key = line_key
+                entries.append((offset, [fields[index] if index < len(fields) else ''
+                                         for index in order_indices]))
+            offset += len(line) + 1
+            number += 1
+    return SparseIndex(f, meta, entries)
+
+
+def read_index(f, path):
+    """ Index of a RegularFile read from path, None if there is none or it is out of date """
+    try:
+        with open(path) as index_file:
+            meta = json.loads(index_file.readline())
+            entries = []
+            for line in index_file:
+                values = line.rstrip("\n").split("\t")
+                entries.append((int(values[0]), values[1:]))
+    except (IOError, ValueError):
+        return None
+    index = SparseIndex(f, meta, entries)
+    return index if index.valid() else None
+
+
+def write_index(index, path):
+    """ Write the index to path, replacing the old one at once """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(prefix=os.path.basename(path), dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as index_file:
+            index_file.write("%s\n" % json.dumps(index.meta))
+            for offset, values in index.entries:
+                index_file.write("%d\t%s\n" % (offset, "\t".join(values)))
+        os.rename(temp_path, path)
+    except:
+        os.unlink(temp_path)
+        raise
+
+
+def file_index(f, step=INDEX_STEP):
+    """ Index of a RegularFile from its sidecar, built and saved if it is missing or out of date """
+    path = index_path(f)
+    index = read_index(f, path) if path else None
+    if index is None:
+        index = build_index(f, step)
+        if path:
+            try:
+                write_index(index, path)
+            except (IOError, OSError):
+                # the index of a file in a read-only place lasts as long as the lookup
+                pass
+    return index
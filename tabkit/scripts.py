@@ -1,16 +1,88 @@
+import os
 import sys
+import atexit
+import errno
+import signal
+import shlex
+import shutil
+import tempfile
 import argparse
-from itertools import islice, izip, izip_longest, tee, chain
-
-from .awk import map_program, grp_program
-from .header import Field, DataDesc, OrderField, parse_order
+from pipes import quote
+from itertools import islice, izip, izip_longest, chain, imap
+
+from .awk import (
+    map_program, grp_program, combine_program, MapProgram, HashJoinProgram, awk_command, AWK_ENV
+)
+from .awk.group import MEMORY_PER_GROUP, SPILL_ENV
+from .engine import compile_map, map_lines, map_rows
+from .cache import write_store
+from .index import INDEX_STEP, INDEX_SUFFIX, index_path, build_index, write_index, file_index
+from .trace import TRACE_ENV, timed, start as start_trace
+from .header import Field, DataDesc, OrderField, parse_order, common_order
 from .exception import TabkitException, decorate_exceptions
 from .type import generic_type, narrowest_type
-from .utils import Files, xsplit
+from .sort import sort_options, sort_plan, sort_runs, describe_input
+from .utils import (
+    Files, RegularFile, CacheFile, file_obj, xsplit, shell_command, shell_call, shell_calls, shell_processes, completed,
+    parse_size, available_memory, compress_output, COMPRESSORS
+)
 
 
 def add_common_args(parser):
     parser.add_argument("-N", "--no-header", help="Don't output header", action="store_true")
+    parser.add_argument('--compress', choices=sorted(COMPRESSORS),
+                        help="Compress the output, with a multithreaded compressor if available")
+    parser.add_argument('--compress-level', metavar="N", type=int,
+                        help="Compression level, the compressor's default if omitted")
+    parser.add_argument('--compress-threads', metavar="N", type=int,
+                        help="Compression threads, all the cores by default")
+    parser.add_argument('--trace', metavar="PATH",
+                        help="Append timings, child rusage and row counts of this run to the "
+                             "TSV trace PATH, $%s by default" % TRACE_ENV)
+
+
+def parse_args(parser):
+    args = parser.parse_args()
+    if getattr(args, 'compress', None):
+        atexit.register(compress_output(args.compress, args.compress_level, args.compress_threads))
+    trace_path = getattr(args, 'trace', None) or os.environ.get(TRACE_ENV)
+    if trace_path:
+        # runs before the compressor finishes, the output is counted uncompressed
+        atexit.register(start_trace(trace_path, os.path.basename(sys.argv[0]), sys.argv[1:]))
+    return args
+
+
+ENGINES = {
+    'awk': "awk (default)",
+    'python': "python in process",
+    'numpy': "numpy by batches of columns, for tcache stores (on text awk is faster)"
+}
+
+
+def add_engine_arg(parser, engines=('awk', 'numpy')):
+    parser.add_argument('--engine', choices=engines, default='awk',
+                        help="Evaluate expressions with %s; unlike mawk, which outputs inf, "
+                             "the other engines stop on a division by zero" % ", ".join(
+                                 ENGINES[engine] for engine in engines))
+
+
+def add_awk_arg(parser):
+    parser.add_argument('--awk', metavar="AWK",
+                        help="Run awk programs with AWK, e.g. gawk or 'busybox awk', by default "
+                             "$%s or else the fastest compatible awk found" % AWK_ENV)
+
+
+def awk_args(args, *options):
+    """ Command line of the chosen awk splitting fields by tabs, with the options """
+    return awk_command(args.awk) + ["-F", "\t", '-v', 'OFS=\t'] + list(options)
+
+
+def columnar_engine():
+    try:
+        from .engine import columnar
+    except ImportError as e:
+        raise TabkitException("The numpy engine is unavailable: %s" % e)
+    return columnar
 
 
 def split_fields(string):
@@ -26,7 +98,7 @@ def cat():
     parser.add_argument('files', metavar='FILE', type=argparse.FileType('r'), nargs="*")
     add_common_args(parser)
 
-    args = parser.parse_args()
+    args = parse_args(parser)
     files = Files(args.files)
     data_desc = files.data_desc()
 
@@ -37,6 +109,32 @@ def cat():
     files.call(['cat'])
 
 
+def cut_fields(data_desc, fields=None, remove=None):
+    """ Indices of the fields kept by cut and the resulting data description """
+    if fields:
+        fields = split_fields(fields)
+    elif remove:
+        remove_fields = split_fields(remove)
+        [data_desc.index(field) for field in remove_fields]  # check remove fields even exist
+        fields = [name for name in data_desc.field_names if name not in remove_fields]
+    else:
+        raise TabkitException("You must specify list of fields")
+
+    field_indices = sorted(data_desc.index(field) for field in fields)
+
+    order = []
+    for order_key in data_desc.order:
+        if order_key.name not in fields:
+            break
+        order.append(order_key)
+
+    data_desc = DataDesc(
+        fields=[f for f in data_desc if f.name in fields],
+        order=order
+    )
+    return field_indices, data_desc
+
+
 @decorate_exceptions
 def cut():
     parser = argparse.ArgumentParser(
@@ -48,43 +146,43 @@ def cut():
     parser.add_argument('-r', '--remove', help="Remove these fields, keep the rest")
     add_common_args(parser)
 
-    args = parser.parse_args()
-    if not (args.fields or args.remove):
-        TabkitException("You must specify list of fields")
-
+    args = parse_args(parser)
     files = Files(args.files)
-    data_desc = files.data_desc()
-
-    if args.fields:
-        fields = split_fields(args.fields)
-
-    elif args.remove:
-        remove_fields = split_fields(args.remove)
-        [data_desc.index(field) for field in remove_fields]  # check remove fields even exist
-        fields = [name for name in data_desc.field_names if name not in remove_fields]
+    field_indices, data_desc = cut_fields(files.data_desc(), args.fields, args.remove)
 
-    field_indices = (data_desc.index(field) for field in fields)
     options = ['-f']
     options.append(",".join(str(index + 1) for index in field_indices))
 
-    order = []
-    for order_key in data_desc.order:
-        if order_key.name not in fields:
-            break
-        order.append(order_key)
-
-    data_desc = DataDesc(
-        fields=[f for f in data_desc if f.name in fields],
-        order=order
-    )
-
     if not args.no_header:
         sys.stdout.write("%s\n" % data_desc)
         sys.stdout.flush()
 
+    if all(isinstance(f, CacheFile) for f in files.files):
+        # column stores make back the kept fields only, the rest isn't even read
+        for f in files.files:
+            f.fields = field_indices
+        files.call(['cat'])
+        return
+
     files.call(['cut'] + options)
 
 
+@decorate_exceptions
+def cache():
+    parser = argparse.ArgumentParser(
+        add_help=True,
+        description="Convert FILE(s) to a column store, which every tool reads as a file "
+                    "and the engines read only the fields they need of."
+    )
+    parser.add_argument('files', metavar='FILE', type=argparse.FileType('r'), nargs="*")
+    parser.add_argument('-o', '--output', metavar="STORE", type=argparse.FileType('wb'),
+                        default=sys.stdout, help="Write the store to STORE instead of stdout")
+
+    args = parse_args(parser)
+    files = Files(args.files)
+    write_store(files, files.data_desc(), args.output)
+
+
 @decorate_exceptions
 def map():
     parser = argparse.ArgumentParser(
@@ -98,25 +196,102 @@ def map():
     parser.add_argument('-o', '--output', action="append", help="Output fields", default=[])
     parser.add_argument('-f', '--filter', action="append", help="Filter expression")
     parser.add_argument('-v', '--verbose', action="store_true", help="Verbose awk code")
+    parser.add_argument('-j', '--jobs', metavar="N", type=int, default=1,
+                        help="Map N chunks of regular files in parallel")
+    parser.add_argument('--unordered', action="store_true",
+                        help="Output the chunks as soon as they are mapped, in no particular order")
+    add_engine_arg(parser, ('awk', 'python', 'numpy'))
+    add_awk_arg(parser)
     add_common_args(parser)
 
-    args = parser.parse_args()
+    args = parse_args(parser)
     files = Files(args.files)
     data_desc = files.data_desc()
 
     # if args.all or not args.output:
     #     args.output.extend(f.name for f in data_desc)
     #
-    program, data_desc = map_program(data_desc, args.output, args.filter)
+    if args.engine == 'numpy':
+        if args.jobs > 1:
+            raise TabkitException("The numpy engine runs in a single process")
+        columnar = columnar_engine()
+        with timed('compile'):
+            mapper, data_desc = columnar.columnar_map(data_desc, args.output, args.filter)
+        if not args.no_header:
+            sys.stdout.write("%s\n" % data_desc)
+        for batch in columnar.file_batches(files):
+            mapper(batch, sys.stdout)
+        return
+
+    if args.engine == 'python':
+        if args.jobs > 1:
+            raise TabkitException("The python engine runs in a single process")
+        with timed('compile'):
+            mapper, output_data_desc = compile_map(data_desc, args.output, args.filter)
+        if not args.no_header:
+            sys.stdout.write("%s\n" % output_data_desc)
+        for f in files.files:
+            if isinstance(f, CacheFile):
+                # only the fields the expressions read are taken from the store
+                for rows in f.store.row_batches(mapper.fields):
+                    map_rows(mapper, rows, sys.stdout)
+            else:
+                map_lines(mapper, len(data_desc), f, sys.stdout, whole_lines=not args.output)
+        return
+
+    with timed('compile'):
+        program, data_desc = map_program(data_desc, args.output, args.filter)
+
+    chunks = files.chunks(args.jobs) if args.jobs > 1 else None
+    if chunks and len(chunks) > 1 and args.unordered:
+        data_desc = DataDesc(data_desc.fields)
 
     if args.verbose:
         sys.stderr.write("%s\n" % program)
 
+    command = awk_args(args, str(program))
     if not args.no_header:
         sys.stdout.write("%s\n" % data_desc)
         sys.stdout.flush()
 
-    files.call(['awk', "-F", "\t", '-v', 'OFS=\t', str(program)])
+    if not chunks or len(chunks) < 2:
+        files.call(command)
+        return
+
+    if args.verbose:
+        sys.stderr.write("%d chunks\n" % len(chunks))
+    # the first chunk goes right to the output, the rest wait for their turn in temporary files
+    outputs = [tempfile.TemporaryFile(prefix="tmap_") for chunk in chunks]
+    if not args.unordered:
+        outputs[0] = sys.stdout
+    with timed('child', len(chunks)):
+        _map_chunks(args, command, chunks, outputs)
+
+
+def _map_chunks(args, command, chunks, outputs):
+    """ Run the map command on the chunks concurrently, copying their outputs in turn """
+    processes = shell_processes([shell_command(command, chunk) for chunk in chunks], outputs)
+    output_files = dict(izip(processes, outputs))
+    try:
+        for process in completed(processes) if args.unordered else processes:
+            code = process.wait()
+            if code == 128 + signal.SIGPIPE:
+                # the reader of the output is gone
+                return
+            if code:
+                raise TabkitException("Map failed")
+            output = output_files[process]
+            if output is not sys.stdout:
+                output.seek(0)
+                shutil.copyfileobj(output, sys.stdout)
+                sys.stdout.flush()
+    except IOError as e:
+        if e.errno != errno.EPIPE:
+            raise
+    finally:
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
 
 
 @decorate_exceptions
@@ -130,18 +305,48 @@ def group():
     parser.add_argument('-g', '--group', action="append", help="Group fields", default=[])
     parser.add_argument('-o', '--output', action="append", help="Output fields", default=[])
     parser.add_argument('-v', '--verbose', action="store_true", help="Verbose awk code")
+    parser.add_argument('--hash', action="store_true",
+                        help="Aggregate in memory, the input needs not to be sorted by the group "
+                             "fields; groups are output in order of appearance")
+    parser.add_argument('-S', '--buffer-size', metavar="SIZE",
+                        help="Memory for groups in hash mode, partial aggregates spill to disk "
+                             "beyond it and the output is then sorted by the group fields "
+                             "(default: a quarter of the available memory)")
+    parser.add_argument('-T', '--temporary-directory', metavar="DIR",
+                        help="Keep spilled and partial aggregates in DIR")
+    parser.add_argument('-j', '--jobs', metavar="N", type=int, default=1,
+                        help="Aggregate N chunks of regular files in parallel and combine "
+                             "the results")
+    add_engine_arg(parser)
+    add_awk_arg(parser)
     add_common_args(parser)
 
-    args = parser.parse_args()
+    args = parse_args(parser)
     files = Files(args.files)
-    data_desc = files.data_desc()
+    input_data_desc = files.data_desc()
 
     if not args.group:
         args.group = ["_fake_implicit_group=1"]
     if args.output:
         TabkitException("You must specify list of output field")
 
-    program, data_desc = grp_program(data_desc, args.group, args.output)
+    if args.engine == 'numpy':
+        if args.hash or args.jobs > 1:
+            raise TabkitException("The numpy engine groups sorted input in a single process")
+        columnar = columnar_engine()
+        with timed('compile'):
+            grouper, data_desc = columnar.columnar_group(input_data_desc, args.group, args.output)
+        if not args.no_header:
+            sys.stdout.write("%s\n" % data_desc)
+        grouper(columnar.file_batches(files), sys.stdout)
+        return
+
+    with timed('compile'):
+        program, data_desc = grp_program(input_data_desc, args.group, args.output,
+                                         hashed=args.hash)
+        if args.jobs > 1:
+            combine, _ = combine_program(input_data_desc, args.group, args.output,
+                                         hashed=args.hash)
 
     if args.verbose:
         sys.stderr.write("%s\n" % program)
@@ -150,7 +355,147 @@ def group():
         sys.stdout.write("%s\n" % data_desc)
         sys.stdout.flush()
 
-    files.call(['awk', "-F", "\t", '-v', 'OFS=\t', str(program)])
+    if args.buffer_size:
+        memory = parse_size(args.buffer_size)
+    else:
+        memory = (available_memory() or 0) // 4
+    # no limit if the memory is unknown
+    max_groups = max(1, memory // MEMORY_PER_GROUP) if memory else 0
+
+    chunks = files.chunks(args.jobs) if args.jobs > 1 else None
+    if not chunks or len(chunks) < 2:
+        _group_call(files.call, program, input_data_desc, args, max_groups)
+        return
+
+    # aggregate the chunks in parallel, then combine their partial results in the chunk order
+    partial = program.partial()
+    command = awk_args(args)
+    if args.hash:
+        # a worker spills its partial results to the output as they are anyway
+        worker_groups = max(1, max_groups // len(chunks)) if max_groups else 0
+        command.extend(['-v', '__max_groups=%d' % worker_groups])
+        os.environ[SPILL_ENV] = '/dev/stdout'
+    parts = [
+        tempfile.NamedTemporaryFile(prefix="tgrp_", dir=args.temporary_directory) for chunk in chunks]
+    if args.verbose:
+        sys.stderr.write("%d chunks\n%s\n%s\n" % (len(chunks), partial, combine))
+    codes = shell_calls([shell_command(command + [str(partial)], chunk) for chunk in chunks], parts)
+    if any(codes):
+        raise TabkitException("Partial aggregation failed")
+
+    descriptors = [quote(part.name) for part in parts]
+    _group_call(lambda command: shell_call(shell_command(command, descriptors)),
+                combine, input_data_desc, args, max_groups)
+
+
+def _group_call(call, program, data_desc, args, max_groups):
+    """ Run the group program with call(awk args), in hash mode combine the spilled groups """
+    if not args.hash:
+        call(awk_args(args, str(program)))
+        return
+
+    spill = tempfile.NamedTemporaryFile(prefix="tgrp_", dir=args.temporary_directory)
+    os.environ[SPILL_ENV] = spill.name
+    call(awk_args(args, '-v', '__max_groups=%d' % max_groups, str(program)))
+
+    spill_size = os.fstat(spill.fileno()).st_size
+    if spill_size:
+        # groups were spilled more than once: sort the partial aggregates and combine them
+        combine, _ = combine_program(data_desc, args.group, args.output)
+        sort_args = ['sort', '-s', '-t', '\t', '-k1,%d' % len(program.keys())]
+        sort_args.extend(sort_plan(spill_size, temporary_directory=args.temporary_directory).options())
+        if args.verbose:
+            sys.stderr.write("%s\n" % combine)
+        shell_call("%s %s | %s" % (
+            shell_command(sort_args), quote(spill.name),
+            shell_command(awk_args(args, str(combine)))))
+
+
+def stage_parser():
+    parser = argparse.ArgumentParser(prog="stage", add_help=False)
+    stages = parser.add_subparsers(dest='stage')
+
+    map_parser = stages.add_parser('map', add_help=False)
+    map_parser.add_argument('-o', '--output', action="append", help="Output fields", default=[])
+    map_parser.add_argument('-f', '--filter', action="append", help="Filter expression")
+
+    cut_parser = stages.add_parser('cut', add_help=False)
+    cut_parser.add_argument('-f', '--fields', help="Select only these fields")
+    cut_parser.add_argument('-r', '--remove', help="Remove these fields, keep the rest")
+
+    group_parser = stages.add_parser('group', add_help=False)
+    group_parser.add_argument('-g', '--group', action="append", help="Group fields", default=[])
+    group_parser.add_argument('-o', '--output', action="append", help="Output fields", default=[])
+
+    return parser
+
+
+def pipe_program(data_desc, stages):
+    r'''
+    >>> from .header import parse_header
+    >>> awk, data_desc = pipe_program(
+    ...     parse_header("# fruit, qty:int, paid:bool"),
+    ...     ['map -f paid -o "fruit;qty;double=qty*2"', 'cut -r qty', 'group -g fruit -o "s=sum(double)"']
+    ... )
+    >>> str(awk)
+    '{__var__0=($2*2);if(!($3))next;__nr__++;}__nr__==1||__key__0!=$1{if(__nr__>1)print __key__0,(__aggr__1<2147483648&&__aggr__1>-2147483648?__aggr__1:__num(__aggr__1));__key__0=$1;__aggr__1=0;}{__aggr__1+=__var__0;}END{if(__nr__>0)print __key__0,(__aggr__1<2147483648&&__aggr__1>-2147483648?__aggr__1:__num(__aggr__1));}function __num(x){return x==int(x)&&x<1e16&&x>-1e16?sprintf("%.0f",x):sprintf("%.6g",x)}'
+    >>> str(data_desc)
+    '# fruit\ts:int'
+
+    >>> from .exception import test_exception
+    >>> test_exception(lambda: pipe_program(data_desc, ['group -o "n=count()"', 'cut -f n']))
+    doctest: Group stage must be the last one
+    '''
+    parser = stage_parser()
+    program = MapProgram.identity(data_desc)
+    grouped = False
+    for stage in stages:
+        if grouped:
+            raise TabkitException("Group stage must be the last one")
+        args = parser.parse_args(shlex.split(stage))
+        if args.stage == 'map':
+            program, data_desc = map_program(data_desc, args.output, args.filter, program)
+        elif args.stage == 'cut':
+            field_indices, data_desc = cut_fields(data_desc, args.fields, args.remove)
+            program = program.cut(field_indices)
+        elif args.stage == 'group':
+            program, data_desc = grp_program(
+                data_desc, args.group or ["_fake_implicit_group=1"], args.output, program)
+            grouped = True
+    return program, data_desc
+
+
+@decorate_exceptions
+def pipe():
+    parser = argparse.ArgumentParser(
+        add_help=True,
+        description="Perform map, cut and group STAGE(s) on all FILE(s) in a single awk process "
+                    "and write result to standard output."
+    )
+    parser.add_argument('stages', metavar='STAGE', nargs="+",
+                        help="Stage in tmap_awk, tcut or tgrp_awk syntax, e.g. 'map -f paid', "
+                             "'cut -f fruit,qty' or 'group -g fruit -o \"qty=sum(qty)\"'")
+    parser.add_argument('-i', '--input', metavar='FILE', type=argparse.FileType('r'),
+                        action="append", help="Input FILE, standard input by default")
+    parser.add_argument('-v', '--verbose', action="store_true", help="Verbose awk code")
+    add_awk_arg(parser)
+    add_common_args(parser)
+
+    args = parse_args(parser)
+    files = Files(args.input)
+    data_desc = files.data_desc()
+
+    with timed('compile'):
+        program, data_desc = pipe_program(data_desc, args.stages)
+
+    if args.verbose:
+        sys.stderr.write("%s\n" % program)
+
+    if not args.no_header:
+        sys.stdout.write("%s\n" % data_desc)
+        sys.stdout.flush()
+
+    files.call(awk_args(args, str(program)))
 
 
 def make_order(keys):
@@ -168,10 +513,22 @@ def sort():
     parser.add_argument('files', metavar='FILE', type=argparse.FileType('r'), nargs="*")
     parser.add_argument('-k', '--keys', action="append", default=[],
                         help="List sorting keys as field[:(str|num|general)][:desc]")
+    parser.add_argument('--parallel', metavar="N", type=int,
+                        help="Run N sorts concurrently, chosen from input size and cores by default")
+    parser.add_argument('-S', '--buffer-size', metavar="SIZE",
+                        help="Use SIZE for main memory buffer, e.g. 512M or 10%%, "
+                             "chosen from input size and available memory by default")
+    parser.add_argument('-T', '--temporary-directory', metavar="DIR",
+                        help="Use DIR for temporary files")
+    parser.add_argument('--compress-program', metavar="PROG", default='auto',
+                        help="Compress temporary files with PROG, 'none' to disable, "
+                             "by default a fast compressor is used when input doesn't fit in memory")
+    parser.add_argument('-v', '--verbose', action="store_true", help="Report the sort plan")
     add_common_args(parser)
 
-    args = parser.parse_args()
+    args = parse_args(parser)
     files = Files(args.files)
+    input_descs = list(files.data_descs())
     data_desc = files.data_desc()
 
     order = list(make_order(args.keys or data_desc.field_names))
@@ -181,20 +538,112 @@ def sort():
         order=order
     )
 
-    options = []
-    for order in data_desc.order:
-        option = "-k{0},{0}".format(data_desc.index(order.name) + 1)
-        if order.type != 'str':
-            option += order.type[0]
-        if order.desc:
-            option += "r"
-        options.append(option)
+    sorted_prefix = min(common_order(desc.order, order) for desc in input_descs)
+
+    if len(input_descs) == 1 and sorted_prefix == len(order):
+        if args.verbose:
+            sys.stderr.write("Sort plan: input is already sorted, pass through\n")
+        if not args.no_header:
+            sys.stdout.write("%s\n" % data_desc)
+            sys.stdout.flush()
+        files.call(['cat'])
+        return
+
+    if len(input_descs) == 1 and sorted_prefix > 0:
+        if args.verbose:
+            sys.stderr.write("Sort plan: input is sorted by %s, sort runs of equal keys\n" %
+                             ", ".join(o.name for o in order[:sorted_prefix]))
+        if not args.no_header:
+            sys.stdout.write("%s\n" % data_desc)
+        sys.stdout.writelines(sort_runs(files, data_desc, sorted_prefix))
+        return
+
+    # inputs already sorted as requested only need to be merged
+    merge = len(input_descs) if sorted_prefix == len(order) else 0
+
+    input_size = files.size()
+    plan = sort_plan(input_size, args.parallel, args.buffer_size, args.temporary_directory,
+                     args.compress_program, merge=merge)
+
+    if args.verbose:
+        sys.stderr.write("Sort plan: %s (%s)\n" % (plan, describe_input(input_size)))
 
     if not args.no_header:
         sys.stdout.write("%s\n" % data_desc)
         sys.stdout.flush()
 
-    files.call(['sort'] + options)
+    files.call(['sort', '-t', '\t'] + plan.options() + sort_options(data_desc))
+
+
+def regular_file(fd, purpose):
+    f = file_obj(fd)
+    if not isinstance(f, RegularFile):
+        raise TabkitException("%s need regular files, %s isn't one" % (purpose, fd.name))
+    return f
+
+
+@decorate_exceptions
+def index():
+    parser = argparse.ArgumentParser(
+        add_help=True,
+        description="Build sparse indices of regular FILE(s) sorted by their ORDER for tlookup, "
+                    "next to them as FILE%s." % INDEX_SUFFIX
+    )
+    parser.add_argument('files', metavar='FILE', type=argparse.FileType('r'), nargs="+")
+    parser.add_argument('-s', '--step', metavar="N", type=int, default=INDEX_STEP,
+                        help="Index every N-th line, default is %d" % INDEX_STEP)
+
+    args = parse_args(parser)
+    for fd in args.files:
+        f = regular_file(fd, "Indices")
+        path = index_path(f)
+        if not path:
+            raise TabkitException("Index of %s has no place to be written" % fd.name)
+        write_index(build_index(f, args.step), path)
+
+
+def split_key(key):
+    return key.split("\t")
+
+
+@decorate_exceptions
+def lookup():
+    parser = argparse.ArgumentParser(
+        add_help=True,
+        description="Output the lines of a regular FILE sorted by its ORDER with the KEYs, "
+                    "then the lines in the range of keys. The lines are found through a sparse "
+                    "index of FILE, built by tindex or else the first time it is needed."
+    )
+    parser.add_argument('file', metavar='FILE', type=argparse.FileType('r'))
+    parser.add_argument('-k', '--key', metavar="KEY", action="append", default=[],
+                        help="Values of the first order fields, separated by tabs")
+    parser.add_argument('--from', metavar="KEY", dest="from_",
+                        help="The range of keys starts with KEY, from the start by default")
+    parser.add_argument('--to', metavar="KEY",
+                        help="The range of keys ends with KEY, at the end by default")
+    parser.add_argument('-s', '--step', metavar="N", type=int, default=INDEX_STEP,
+                        help="Index every N-th line if the index is built, default is %d" %
+                             INDEX_STEP)
+    add_common_args(parser)
+
+    args = parse_args(parser)
+    # leave quietly as soon as the reader of the output is gone
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+    if not args.key and args.from_ is None and args.to is None:
+        raise TabkitException("Nothing to look up, give a key or a range")
+
+    f = regular_file(args.file, "Lookups")
+    index = file_index(f, args.step)
+
+    lookups = [index.lookup(split_key(key)) for key in args.key]
+    if args.from_ is not None or args.to is not None:
+        lookups.append(index.lookup(split_key(args.from_) if args.from_ is not None else [],
+                                    split_key(args.to) if args.to is not None else []))
+
+    if not args.no_header:
+        sys.stdout.write("%s\n" % f.data_desc())
+    for lines in lookups:
+        sys.stdout.writelines("%s\n" % line for line in lines)
 
 
 class add_set(argparse.Action):
@@ -233,13 +682,29 @@ def join():
     # square brackets in metavare cause assertion error http://bugs.python.org/issue11874
     parser.add_argument('-o', '--output', metavar="FILENO.FIELD, ...",
                         help="Specify output fields. FILENO is optional if FIELD is unambiguous.")
+    unsorted = parser.add_mutually_exclusive_group()
+    unsorted.add_argument('--hash', action="store_true",
+                          help="Load the smaller file into memory and stream the other one "
+                               "through it, inputs need not be sorted")
+    unsorted.add_argument('--auto-sort', action="store_true",
+                          help="Sort the files not sorted by the join field, both at once, "
+                               "and stream them into the join")
+    add_awk_arg(parser)
     add_common_args(parser)
-    args = parser.parse_args()
+    args = parse_args(parser)
 
     left, right = args.left, args.right
     files = Files([left, right])
     left_desc, right_desc = list(files.data_descs())
 
+    if args.hash:
+        # hash the smaller regular file, or the right one which is usually a dimension
+        left_size, right_size = (f.size() if isinstance(f, RegularFile) else None
+                                 for f in files.files)
+        hashed = 2
+        if left_size is not None and (right_size is None or left_size < right_size):
+            hashed = 1
+
     if not (args.join_key or (args.left_key and args.right_key)):
         raise TabkitException('Specify join field through -j or -1, -2 options')
     left_key = right_key = args.join_key
@@ -273,18 +738,25 @@ def join():
                                    right_desc.get_field(right_key).type)
         generic_key = Field(left_key, type_)
 
+    sort_filters = [None, None]
     for fileno, file, key, desc in ((1, left, left_key, left_desc),
                                     (2, right, right_key, right_desc)):
         if key not in desc:
             raise TabkitException("No such field %r in file %r" % (key, file.name))
-        try:
-            field, field_type, order = desc.order.pop(0)  # remove it
-            if not (field == key and field_type == "str" and not order):
-                raise ValueError
-        except (IndexError, ValueError):
-            raise TabkitException(
-                "File %r must be sorted lexicographicaly ascending by the field %r" %
-                (file.name, key))
+        if args.auto_sort and not (desc.order and desc.order[0] == OrderField(key)):
+            # a stable sort keeps the lines with equal keys in their former order
+            sort_filters[fileno - 1] = [
+                'sort', '-s', '-t', '\t', '-k{0},{0}'.format(desc.index(key) + 1)]
+            desc.order = [OrderField(key)] + [o for o in desc.order if o.name != key]
+        if not args.hash:
+            try:
+                field, field_type, order = desc.order.pop(0)  # remove it
+                if not (field == key and field_type == "str" and not order):
+                    raise ValueError
+            except (IndexError, ValueError):
+                raise TabkitException(
+                    "File %r must be sorted lexicographicaly ascending by the field %r" %
+                    (file.name, key))
         if not args.output:
             if args.only_unpairable and fileno not in args.only_unpairable:
                 continue
@@ -334,11 +806,47 @@ def join():
                     else:
                         raise TabkitException('Unknown output field %r' % field)
 
-    output_field_names = {f.name for f in output_desc}
-    output_order.extend(
-        f for f in chain(left_desc.order, right_desc.order) if f.name in output_field_names)
+    if args.hash:
+        # output follows the streamed file, unpairable lines of the hashed file come last
+        output_order = []
+        order_fileno = 3 - hashed
+        if args.only_unpairable == {hashed}:
+            order_fileno = hashed
+        elif hashed in args.add_unpairable | args.only_unpairable:
+            order_fileno = None
+        if order_fileno:
+            desc, key = ((left_desc, left_key), (right_desc, right_key))[order_fileno - 1]
+            for order_field in desc.order:
+                field_spec = "%d.%d" % (order_fileno, desc.index(order_field.name) + 1)
+                if order_field.name == key and "0" in output:
+                    name = generic_key.name
+                elif field_spec in output:
+                    name = output_desc[output.index(field_spec)].name
+                else:
+                    break
+                output_order.append(OrderField(name, order_field.type, order_field.desc))
+    else:
+        output_field_names = {f.name for f in output_desc}
+        output_order.extend(
+            f for f in chain(left_desc.order, right_desc.order) if f.name in output_field_names)
     output_desc = DataDesc(output_desc, output_order)
 
+    if args.hash:
+        hashed_key, streamed_key = (left_desc.index(left_key) + 1, right_desc.index(right_key) + 1)
+        if hashed == 2:
+            hashed_key, streamed_key = streamed_key, hashed_key
+            files.files.reverse()  # the hashed file is read first
+        with timed('compile'):
+            program = HashJoinProgram(hashed, hashed_key, streamed_key, output,
+                                      args.add_unpairable, args.only_unpairable, args.empty)
+
+        if not args.no_header:
+            sys.stdout.write("%s\n" % output_desc)
+            sys.stdout.flush()
+
+        files.call(awk_args(args, str(program)))
+        return
+
     options = ['-1', str(left_desc.index(left_key) + 1),
                '-2', str(right_desc.index(right_key) + 1)]
     for fileno in args.add_unpairable:
@@ -349,11 +857,29 @@ def join():
         options.extend(['-e', args.empty])
     options.extend(['-o', ','.join(output)])
 
+    # concurrent sorts share the cores and memory
+    sorts = [(f, sort_args) for f, sort_args in izip(files.files, sort_filters) if sort_args]
+    for f, sort_args in sorts:
+        plan = sort_plan(f.size() if isinstance(f, RegularFile) else None, share=len(sorts))
+        sort_args.extend(plan.options())
+
     if not args.no_header:
         sys.stdout.write("%s\n" % output_desc)
         sys.stdout.flush()
 
-    files.call(['join', '-t', "\t"] + options)
+    files.call(['join', '-t', "\t"] + options, sort_filters)
+
+
+def _update_widths(widths, lines):
+    r"""
+    >>> widths = [1, 5]
+    >>> _update_widths(widths, ["abc\tx", "", "a\tb\tlonger than all"])
+    >>> widths
+    [3, 5]
+    """
+    columns = izip_longest(*[line.split("\t") for line in lines], fillvalue="")
+    for index, column in enumerate(islice(columns, len(widths))):
+        widths[index] = max(widths[index], max(imap(len, column)))
 
 
 @decorate_exceptions
@@ -363,22 +889,44 @@ def pretty():
         description="Output FILE(s) as human-readable pretty table."
     )
     parser.add_argument('files', metavar='FILE', type=argparse.FileType('r'), nargs="*")
-    parser.add_argument('-n', default=100,
+    parser.add_argument('-n', type=int, default=100,
                         help="Preread N rows to calculate column widths, default is 100")
+    parser.add_argument('-x', '--exact', action="store_true",
+                        help="Calculate column widths of all the rows in a first pass over "
+                             "the files, which must be regular")
+    parser.add_argument('-l', '--limit', metavar="N", type=int,
+                        help="Output at most N rows and stop reading")
+
+    args = parse_args(parser)
+    # leave quietly as soon as the reader of the output is gone
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
 
-    args = parser.parse_args()
     files = Files(args.files)
     data_desc = files.data_desc()
-    preread, rows = tee((row.rstrip("\n") for row in files), 2)
+    rows = (row.rstrip("\n") for row in files)
+    if args.limit is not None:
+        rows = islice(rows, args.limit)
 
     nfields = len(data_desc)
     split = lambda row: islice(xsplit(row), nfields)
 
     # gather column widths
     widths = [len(str(f)) for f in data_desc]
-    for row in islice(preread, args.n):
-        for i, value in enumerate(split(row)):
-            widths[i] = max(widths[i], len(value))
+    if args.exact:
+        if not all(isinstance(f, RegularFile) for f in files.files):
+            raise TabkitException("Exact widths need regular files")
+        remaining = args.limit
+        for batch in chain.from_iterable(f.line_batches() for f in files.files):
+            if remaining is not None:
+                batch = batch[:remaining]
+                remaining -= len(batch)
+            _update_widths(widths, batch)
+            if remaining == 0:
+                break
+    else:
+        preread = list(islice(rows, args.n))
+        _update_widths(widths, preread)
+        rows = chain(preread, rows)
 
     widths = [w + 2 for w in widths]
     print "|".join((" %s " % (f,)).ljust(w) for w, f in izip(widths, data_desc))
@@ -388,6 +936,9 @@ def pretty():
             (" %s " % (v or '')).ljust(w or 0)
             for w, v in izip_longest(widths, split(row))
         )
+    sys.stdout.flush()
+    for f in files.files:
+        f.fd.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,287 @@
+import re
+import resource
+
+from .utils import which, cpu_count, available_memory, human_size
+
+
+# GNU sort hardly scales beyond this number of threads
+MAX_PARALLEL = 16
+# sorting less than this is faster single-threaded
+SMALL_INPUT = 16 * 1024 * 1024
+MIN_BUFFER_SIZE = 16 * 1024 * 1024
+# memory taken by sort per input byte: the lines themselves plus the line structures
+MEMORY_PER_BYTE = 1.5
+# fast compressors to spill temporary files through, in order of preference
+COMPRESS_PROGRAMS = ('lz4', 'zstd', 'pigz')
+
+
+def sort_options(data_desc):
+    r'''
+    >>> from .header import parse_header
+    >>> sort_options(parse_header("# a, b, c # ORDER: c:num:desc, a"))
+    ['-k3,3nr', '-k1,1']
+    '''
+    options = []
+    for order in data_desc.order:
+        option = "-k{0},{0}".format(data_desc.index(order.name) + 1)
+        if order.type != 'str':
+            option += order.type[0]
+        if order.desc:
+            option += "r"
+        options.append(option)
+    return options
+
+
+_num_re = re.compile(r'\s*(-?\d*(?:\.\d*)?)')
+_generic_re = re.compile(
+    r'\s*([-+]?(?:(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?|inf(?:inity)?|nan))', re.IGNORECASE)
+
+
+def num_key(value):
+    """
+    Key of sort -n: the numeric prefix, zero if there is none
+
+    >>> [num_key(v) for v in ['10', ' -2.5x', 'abc', '-', '.5']]
+    [10.0, -2.5, 0.0, 0.0, 0.5]
+    """
+    number = _num_re.match(value).group(1)
+    return float(number) if any(c.isdigit() for c in number) else 0.0
+
+
+def generic_key(value):
+    """
+    Key of sort -g: non-numbers first, then NaNs, then numbers
+
+    >>> sorted(['1e3', 'abc', '-inf', '20', 'nan'], key=generic_key)
+    ['abc', 'nan', '-inf', '20', '1e3']
+    """
+    match = _generic_re.match(value)
+    if not match:
+        return (0, 0.0)
+    number = float(match.group(1))
+    if number != number:
+        return (1, 0.0)
+    return (2, number)
+
+
+ORDER_KEYS = {'str': None, 'num': num_key, 'generic': generic_key}
+
+
+class _Desc(object):
+    """ Key compared the other way round """
+    __slots__ = ('key',)
+
+    def __init__(self, key):
+        self.key = key
+
+    def __eq__(self, other):
+        return self.key == other.key
+
+    def __ne__(self, other):
+        return self.key != other.key
+
+    def __lt__(self, other):
+        return other.key < self.key
+
+    def __le__(self, other):
+        return other.key <= self.key
+
+    def __gt__(self, other):
+        return other.key > self.key
+
+    def __ge__(self, other):
+        return other.key >= self.key
+
+
+def order_key(data_desc, count=None):
+    r'''
+    Function of the fields of a line to a tuple comparing as sort -t '\t' orders the lines
+    by the first count fields of data_desc.order, all of them by default
+
+    >>> from .header import parse_header
+    >>> data_desc = parse_header("# a, b # ORDER: b:num:desc, a")
+    >>> key = order_key(data_desc)
+    >>> sorted([['x', '1'], ['b', '10'], ['a', '1'], ['c']], key=key)
+    [['b', '10'], ['a', '1'], ['x', '1'], ['c']]
+    >>> key(['x', '2']) < key(['y', '1']), order_key(data_desc, 1)(['y', '2.0']) == key(['x', '2'])[:1]
+    (True, True)
+    '''
+    converters = []
+    for order in data_desc.order[:count]:
+        index = data_desc.index(order.name)
+        convert = ORDER_KEYS[order.type]
+        if order.desc:
+            convert = (lambda convert: lambda value: _Desc(convert(value)))(convert or str)
+        converters.append((index, convert))
+
+    def key(fields):
+        width = len(fields)
+        return tuple(
+            (convert(fields[index] if index < width else '') if convert
+             else fields[index] if index < width else '')
+            for index, convert in converters)
+    return key
+
+
+def sort_runs(lines, data_desc, prefix):
+    r'''
+    Sort lines already sorted by the first prefix fields of data_desc.order: only the runs
+    of lines with equal prefix keys are sorted, one at a time. The result is the same
+    as of sort -t '\t' with the same keys.
+
+    >>> from .header import parse_header
+    >>> lines = ['a\t10\tx\n', 'a\t9\tz\n', 'a\t9\ty\n', 'b\t1\tx\n', 'b\t2\tx']
+    >>> list(sort_runs(lines, parse_header("# a, b, c # ORDER: a, b:num:desc"), 1))
+    ['a\t10\tx\n', 'a\t9\ty\n', 'a\t9\tz\n', 'b\t2\tx\n', 'b\t1\tx\n']
+    '''
+    def field_key(order):
+        index = data_desc.index(order.name)
+        convert = ORDER_KEYS[order.type]
+        if convert:
+            return lambda fields: convert(fields[index] if index < len(fields) else '')
+        return lambda fields: fields[index] if index < len(fields) else ''
+
+    prefix_keys = [field_key(order) for order in data_desc.order[:prefix]]
+    run_keys = [(field_key(order), order.desc) for order in data_desc.order[prefix:]]
+
+    def sorted_run(run):
+        # the last resort comparison of whole lines, then keys from the least significant one
+        run.sort()
+        for key, desc in reversed(run_keys):
+            run.sort(key=lambda item: key(item[1]), reverse=bool(desc))
+        return (line for line, fields in run)
+
+    run = []
+    run_key = None
+    for line in lines:
+        if not line.endswith("\n"):
+            line += "\n"
+        fields = line[:-1].split("\t")
+        key = [prefix_key(fields) for prefix_key in prefix_keys]
+        if key != run_key:
+            for sorted_line in sorted_run(run):
+                yield sorted_line
+            run = []
+            run_key = key
+        run.append((line, fields))
+    for sorted_line in sorted_run(run):
+        yield sorted_line
+
+
+def merge_batch_size(inputs):
+    """ Merge all inputs in one pass unless they exceed the open files limit """
+    soft_limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+    if soft_limit == resource.RLIM_INFINITY:
+        return max(2, inputs)
+    # every input is held open by both the shell and sort
+    return max(2, min(inputs, soft_limit // 2 - 16))
+
+
+class SortPlan(object):
+    def __init__(self, parallel, buffer_size, temporary_directory=None, compress_program=None,
+                 merge=0):
+        self.parallel = parallel
+        self.buffer_size = buffer_size
+        self.temporary_directory = temporary_directory
+        self.compress_program = compress_program
+        # number of sorted inputs to merge, 0 for a full sort
+        self.merge = merge
+
+    def options(self):
+        options = []
+        if self.merge:
+            options.extend(["--merge", "--batch-size=%d" % merge_batch_size(self.merge)])
+        else:
+            options.append("--parallel=%d" % self.parallel)
+        options.append("--buffer-size=%s" % self.buffer_size)
+        if self.temporary_directory:
+            options.append("--temporary-directory=%s" % self.temporary_directory)
+        if self.compress_program:
+            options.append("--compress-program=%s" % self.compress_program)
+        return options
+
+    def __str__(self):
+        if self.merge:
+            mode = "merge of %d sorted inputs" % self.merge
+        else:
+            mode = "parallel %d" % self.parallel
+        return "%s, buffer size %s, temporary directory %s, compress program %s" % (
+            mode, self.buffer_size, self.temporary_directory or "default",
+            self.compress_program or "none")
+
+
+def _size_option(size):
+    return "%dK" % max(1, size // 1024)
+
+
+def sort_plan(input_size=None, parallel=None, buffer_size=None, temporary_directory=None,
+              compress_program='auto', cores=None, memory=None, share=1, merge=0):
+    r'''
+    Choose sort resources from the input size (None if unknown) and the available cores
+    and memory. The resources are split evenly between the number of concurrent sorts (share).
+    Merging sorted inputs (merge is their number) is a single streaming pass which needs
+    neither threads nor much memory.
+
+    >>> G = 1024 ** 3
+    >>> str(sort_plan(10 * G, cores=40, memory=64 * G, compress_program=None))
+    'parallel 16, buffer size 15728640K, temporary directory default, compress program none'
+
+    >>> str(sort_plan(100 * G, cores=40, memory=64 * G, share=2, compress_program=None))
+    'parallel 16, buffer size 16777216K, temporary directory default, compress program none'
+
+    >>> str(sort_plan(1024, cores=40, memory=64 * G))
+    'parallel 1, buffer size 16384K, temporary directory default, compress program none'
+
+    >>> str(sort_plan(None, parallel=2, buffer_size='10%', temporary_directory='/var/tmp',
+    ...               compress_program='gzip'))
+    'parallel 2, buffer size 10%, temporary directory /var/tmp, compress program gzip'
+
+    >>> str(sort_plan(100 * G, cores=40, memory=64 * G, merge=300))
+    'merge of 300 sorted inputs, buffer size 16384K, temporary directory default, compress program none'
+    '''
+    if merge:
+        if compress_program in ('auto', 'none'):
+            compress_program = None
+        return SortPlan(1, buffer_size or _size_option(MIN_BUFFER_SIZE), temporary_directory,
+                        compress_program, merge)
+
+    cores = cores or cpu_count()
+    memory = memory or available_memory()
+
+    if parallel is None:
+        if input_size is not None and input_size < SMALL_INPUT:
+            parallel = 1
+        else:
+            parallel = max(1, min(cores // share, MAX_PARALLEL))
+
+    needed = None if input_size is None else max(int(input_size * MEMORY_PER_BYTE), MIN_BUFFER_SIZE)
+    if buffer_size is None:
+        # leave a half of the memory to the page cache and the rest of the pipeline
+        budget = memory // 2 // share if memory else None
+        if needed and budget:
+            buffer_size = _size_option(min(needed, budget))
+        elif needed or budget:
+            buffer_size = _size_option(needed or budget)
+        else:
+            buffer_size = _size_option(MIN_BUFFER_SIZE)
+        spills = not needed or not budget or needed > budget
+    else:
+        spills = True
+
+    if compress_program == 'auto':
+        compress_program = None
+        if spills:
+            compress_program = next((p for p in COMPRESS_PROGRAMS if which(p)), None)
+    elif compress_program == 'none':
+        compress_program = None
+
+    return SortPlan(parallel, buffer_size, temporary_directory, compress_program)
+
+
+def describe_input(input_size, cores=None, memory=None):
+    """ Resources the plan is based on, for verbose output """
+    memory = memory or available_memory()
+    return "input %s, %d cores, %s memory available" % (
+        "unknown" if input_size is None else human_size(input_size),
+        cores or cpu_count(),
+        "unknown" if memory is None else human_size(memory))
@@ -0,0 +1,239 @@
+r'''
+Tracing of tool invocations, enabled by TABKIT_TRACE=path or --trace path: each invocation
+appends a record to the trace, which is a headed TSV itself, so that it can be analysed with
+the tools. Nothing is measured when tracing is disabled.
+
+A record holds the time spent parsing headers, compiling programs and running children
+(spawn to exit), the rusage of the children, and the bytes and rows that went in and out.
+The output and the streams read (decompressed files among them) are passed through counting
+pipes. Regular files add their size to the input bytes, but leave the input rows empty: a tool
+may read only a part of them (tpretty -l, tlookup) and counting their lines would read them
+whole. The times run from the start of tracing, once the tool has parsed its arguments, the CPU
+times cover whole processes.
+
+>>> import tempfile
+>>> with tempfile.NamedTemporaryFile() as trace_file:
+...     tracer = Tracer(trace_file.name, "tfoo", ["-f", "a\tb"], count_output=False)
+...     with tracer.timer('header'):
+...         pass
+...     tracer.write_record()
+...     tracer.write_record()
+...     lines = open(trace_file.name).read().splitlines()
+>>> len(lines), lines[0] == TRACE_HEADER
+(3, True)
+>>> lines[1].split("\t")[2:4]
+['tfoo', '-f a\\tb']
+'''
+import os
+import sys
+import time
+import fcntl
+import resource
+import threading
+from collections import OrderedDict
+
+
+TRACE_ENV = 'TABKIT_TRACE'
+TRACE_HEADER = (
+    "# time:float, pid:int, tool, args, seconds:float, cpu_seconds:float, "
+    "header_seconds:float, compile_seconds:float, child_seconds:float, children:int, "
+    "child_cpu_seconds:float, child_max_rss_kb:int, input_bytes:int, input_rows:int, "
+    "output_bytes:int, output_rows:int"
+)
+PUMP_SIZE = 65536
+
+_tracer = None
+
+
+class _NoTimer(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NO_TIMER = _NoTimer()
+
+
+def timed(stage, children=1):
+    """ Context timing the stage: header, compile or child; does nothing unless tracing """
+    return _tracer.timer(stage, children) if _tracer else _NO_TIMER
+
+
+def tracing():
+    return _tracer is not None
+
+
+def file_input(fd):
+    _tracer.file_input(fd)
+
+
+def stream_input(fd):
+    return _tracer.stream_input(fd)
+
+
+def start(path, tool, args):
+    """ Trace this invocation to path, the returned function writes the record at the end """
+    global _tracer
+    _tracer = Tracer(path, tool, args)
+    return _tracer.finish
+
+
+class _Timer(object):
+    def __init__(self, tracer, stage, children):
+        self.tracer = tracer
+        self.stage = stage
+        self.children = children
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *exc_info):
+        self.tracer.add(self.stage, time.time() - self.start, self.children)
+
+
+def _close_on_exec(fd):
+    """ The children must not hold the ends of the pumps: the readers would never see the end """
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+    return fd
+
+
+class _Pump(threading.Thread):
+    """ Copies a descriptor to another one, counting bytes and line ends """
+    def __init__(self, source, target, close_target=False):
+        super(_Pump, self).__init__()
+        self.daemon = True
+        self.source = source
+        self.target = target
+        self.close_target = close_target
+        self.bytes = 0
+        self.lines = 0
+        self.first = ""
+        self.last = ""
+
+    def run(self):
+        try:
+            while True:
+                chunk = os.read(self.source, PUMP_SIZE)
+                if not chunk:
+                    break
+                self.first = self.first or chunk[0]
+                self.last = chunk[-1]
+                self.bytes += len(chunk)
+                self.lines += chunk.count("\n")
+                while chunk:
+                    chunk = chunk[os.write(self.target, chunk):]
+        except OSError:
+            # the reader is gone, the writers will see it too
+            pass
+        finally:
+            os.close(self.source)
+            if self.close_target:
+                os.close(self.target)
+
+    def rows(self, header=True):
+        """ Lines counted, the header line aside """
+        lines = self.lines + (self.last not in ("", "\n"))
+        return max(0, lines - (header and lines > 0))
+
+
+class Tracer(object):
+    def __init__(self, path, tool, args, count_output=True):
+        self.path = path
+        self.record = OrderedDict([
+            ('time', time.time()),
+            ('pid', os.getpid()),
+            ('tool', tool),
+            ('args', " ".join(args)),
+        ])
+        self.stages = dict.fromkeys(['header', 'compile', 'child'], 0.0)
+        self.children = 0
+        self.file_bytes = []
+        self.input_pumps = []
+        self.output_pump = None
+        self.stdout = None
+        if count_output:
+            self._count_output()
+
+    def timer(self, stage, children=1):
+        return _Timer(self, stage, children)
+
+    def add(self, stage, seconds, children=1):
+        self.stages[stage] += seconds
+        if stage == 'child':
+            self.children += children
+
+    def _count_output(self):
+        """ Pass everything written to the standard output, by us and the children, to a pump """
+        sys.stdout.flush()
+        read_fd, write_fd = os.pipe()
+        self.stdout = _close_on_exec(os.dup(1))
+        os.dup2(write_fd, 1)
+        os.close(write_fd)
+        self.output_pump = _Pump(_close_on_exec(read_fd), self.stdout)
+        self.output_pump.start()
+
+    def stream_input(self, fd):
+        """ File reading the stream fd through a pump """
+        # the read end is left inheritable, the children read the streams through /dev/fd
+        read_fd, write_fd = os.pipe()
+        pump = _Pump(_close_on_exec(os.dup(fd.fileno())), _close_on_exec(write_fd),
+                     close_target=True)
+        pump.start()
+        self.input_pumps.append(pump)
+        return os.fdopen(read_fd)
+
+    def file_input(self, fd):
+        """ Regular file fd, counted by its size; its rows are unknown """
+        self.file_bytes.append(os.fstat(fd.fileno()).st_size)
+
+    def _input_counts(self):
+        input_bytes = sum(self.file_bytes) + sum(pump.bytes for pump in self.input_pumps)
+        if self.file_bytes:
+            return input_bytes, ""
+        return input_bytes, sum(pump.rows() for pump in self.input_pumps)
+
+    def write_record(self):
+        record = self.record
+        record['seconds'] = time.time() - record['time']
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        record['cpu_seconds'] = usage.ru_utime + usage.ru_stime
+        for stage in ('header', 'compile', 'child'):
+            record['%s_seconds' % stage] = self.stages[stage]
+        record['children'] = self.children
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        record['child_cpu_seconds'] = usage.ru_utime + usage.ru_stime
+        record['child_max_rss_kb'] = usage.ru_maxrss
+        record['input_bytes'], record['input_rows'] = self._input_counts()
+        pump = self.output_pump
+        record['output_bytes'] = pump.bytes if pump else 0
+        record['output_rows'] = pump.rows(header=pump.first == "#") if pump else 0
+        line = "\t".join(_escape(value) for value in record.itervalues())
+
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0666)
+        try:
+            # the stages of a pipeline finish at about the same time
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            header = "" if os.fstat(fd).st_size else "%s\n" % TRACE_HEADER
+            os.write(fd, "%s%s\n" % (header, line))
+        finally:
+            os.close(fd)
+
+    def finish(self):
+        if self.output_pump:
+            try:
+                sys.stdout.flush()
+            finally:
+                # the pump sees the end of the output once our end of the pipe is gone
+                os.dup2(self.stdout, 1)
+                self.output_pump.join()
+                os.close(self.stdout)
+        self.write_record()
+
+
+def _escape(value):
+    if isinstance(value, float):
+        return "%.6f" % value
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n")
@@ -48,7 +48,7 @@ def narrowest_type(*types):
 
 
 def infer_type(op, *types):
-    if op in ['+', '-', '*', '**']:
+    if op in ['+', '-', '*', '^']:
         if TabkitTypes.float in types:
             return TabkitTypes.float
         else:
@@ -1,46 +1,346 @@
 import os
 import sys
+import mmap
+import fcntl
+import signal
+import multiprocessing
+import ctypes
+import ctypes.util
 import subprocess
 import logging
+import threading
+import Queue
 from pipes import quote
-from itertools import izip, chain
+from array import array
+from collections import namedtuple
+from itertools import izip, islice, chain
 
 from .type import type_name
-from .header import parse_header, generic_data_desc
+from .header import DataDesc, parse_header, generic_data_desc
 from .exception import TabkitException
+from . import trace
+from .cache import MAGIC as CACHE_MAGIC, ColumnStore
+
+
+# rows per batch of parse_batches
+BATCH_SIZE = 65536
+
+# bytes of lines per batch of RegularFile.line_batches
+MMAP_BATCH_SIZE = 4 * 1024 * 1024
+
+POSIX_FADV_SEQUENTIAL = getattr(os, 'POSIX_FADV_SEQUENTIAL', 2)
+
+
+def _libc_posix_fadvise():
+    try:
+        posix_fadvise = ctypes.CDLL(ctypes.util.find_library('c')).posix_fadvise
+    except (OSError, AttributeError):
+        return None
+    posix_fadvise.argtypes = [ctypes.c_int, ctypes.c_long, ctypes.c_long, ctypes.c_int]
+    return posix_fadvise
+
+
+_posix_fadvise = getattr(os, 'posix_fadvise', None) or _libc_posix_fadvise()
+
+
+def fadvise_sequential(fd, offset=0, length=0):
+    """ Hint the kernel to read ahead aggressively, does nothing where unsupported """
+    if _posix_fadvise:
+        _posix_fadvise(fd, offset, length, POSIX_FADV_SEQUENTIAL)
 
 
 class File(object):
     def __init__(self, fd):
         self.fd = fd
         self.name = fd.name
+        self._data_desc = None
+
+    def __iter__(self):
+        return iter(self.fd)
 
     def descriptor(self):
         return "/dev/fd/%d" % (self.fd.fileno(),)
 
     def data_desc(self):
-        return parse_header(self.header())
+        r"""
+        The header parsed once, every caller gets a copy of its own to change
+
+        >>> import tempfile
+        >>> with tempfile.NamedTemporaryFile() as stream:
+        ...     stream.write("# a, b # ORDER: a\n")
+        ...     stream.flush()
+        ...     f = RegularFile(open(stream.name))
+        ...     del f.data_desc().order[:]
+        ...     str(f.data_desc())
+        '# a\tb\t# ORDER: a'
+        """
+        if self._data_desc is None:
+            with trace.timed('header'):
+                self._data_desc = parse_header(self.header())
+        return DataDesc(self._data_desc.fields, self._data_desc.order)
 
 
 class RegularFile(File):
+    def __init__(self, fd):
+        super(RegularFile, self).__init__(fd)
+        self.offset = None
+
     def header(self):
-        return self.fd.readline().rstrip()
+        header = self.fd.readline()
+        self.offset = self.fd.tell()
+        return header.rstrip()
+
+    def size(self):
+        return os.fstat(self.fd.fileno()).st_size - (self.offset or 0)
+
+    def seek(self):
+        """ Position the descriptor right after the header, so that the child can read it as is """
+        os.lseek(self.fd.fileno(), self.offset, os.SEEK_SET)
+        fadvise_sequential(self.fd.fileno(), self.offset)
+
+    def line_start(self, pos):
+        """ Position of the first line starting at pos of the data or after it """
+        if pos <= 0:
+            return 0
+        fd = self.fd.fileno()
+        # a line starts at pos if the previous byte is a newline
+        os.lseek(fd, self.offset + pos - 1, os.SEEK_SET)
+        while True:
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                return self.size()
+            newline = chunk.find("\n")
+            if newline >= 0:
+                return pos + newline
+            pos += len(chunk)
+
+    def line_batches(self, batch_size=MMAP_BATCH_SIZE):
+        """ Lines of the data without line ends, in lists of about batch_size bytes, read through mmap """
+        fd = self.fd.fileno()
+        size = os.fstat(fd).st_size
+        if size <= self.offset:
+            return
+        data = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        try:
+            start = self.offset
+            while start < size:
+                end = data.find("\n", start + batch_size) + 1 if start + batch_size < size else 0
+                end = end or size
+                lines = data[start:end].split("\n")
+                if not lines[-1]:
+                    lines.pop()
+                yield lines
+                start = end
+        finally:
+            data.close()
+
+    def range_descriptor(self, start, size):
+        """ Descriptor of size bytes of the data from start """
+        return "<( tail -c +%d %s | head -c %d )" % (
+            self.offset + start + 1, super(RegularFile, self).descriptor(), size)
 
     def descriptor(self):
+        # /dev/fd/N of a regular file is reopened from the start, hence the tail
         os.lseek(self.fd.fileno(), 0, os.SEEK_SET)
+        fadvise_sequential(self.fd.fileno())
         return "<( tail -n+2 %s )" % (super(RegularFile, self).descriptor(),)
 
 
 class StreamFile(File):
+    # the read-ahead left after the header must fit into a pipe buffer, see descriptor()
+    buffer_size = 65536
+
+    def __init__(self, fd):
+        super(StreamFile, self).__init__(fd)
+        self.buffer = ""
+
     def _read_header(self):
         while True:
-            c = os.read(self.fd.fileno(), 1)
-            if c is None or c == "\n":
+            chunk = os.read(self.fd.fileno(), self.buffer_size)
+            if not chunk:
                 return
-            yield c
+            pos = chunk.find("\n")
+            if pos >= 0:
+                self.buffer = chunk[pos + 1:]
+                yield chunk[:pos]
+                return
+            yield chunk
+
+    def header(self):
+        header = "".join(self._read_header())
+        if header.startswith(CACHE_MAGIC):
+            # the store is read in place, a stream would have to be copied whole first
+            raise TabkitException("Column store read from a stream, pass it as a file")
+        return header
+
+    def __iter__(self):
+        lines = self.buffer.splitlines(True)
+        rest = iter(self.fd)
+        if lines and not lines[-1].endswith("\n"):
+            lines[-1] += next(rest, "")
+        return chain(lines, rest)
+
+    def descriptor(self):
+        descriptor = super(StreamFile, self).descriptor()
+        if not self.buffer:
+            return descriptor
+        # hand the bytes read past the header over to the child through a pipe
+        read_fd, write_fd = os.pipe()
+        os.write(write_fd, self.buffer)
+        os.close(write_fd)
+        return "<( cat /dev/fd/%d %s )" % (read_fd, descriptor)
+
+
+# magic bytes of compressed files and programs to decompress them, in order of preference
+COMPRESSIONS = (
+    ('gzip', '\x1f\x8b', (['pigz', '-dc'], ['gzip', '-dc'])),
+    ('zstd', '\x28\xb5\x2f\xfd', (['zstd', '-dc', '-T0'],)),
+    ('bzip2', 'BZh', (['lbzip2', '-dc'], ['pbzip2', '-dc'], ['bzip2', '-dc'])),
+    ('xz', '\xfd7zXZ\x00', (['xz', '-dc', '-T0'],)),
+    ('lz4', '\x04\x22\x4d\x18', (['lz4', '-dc'],)),
+)
+
+
+def magic(fd):
+    """ The first bytes of a regular file, which tell its format """
+    fileno = fd.fileno()
+    pos = os.lseek(fileno, 0, os.SEEK_CUR)
+    head = os.read(fileno, 8)
+    os.lseek(fileno, pos, os.SEEK_SET)
+    return head
+
+
+def compression(head):
+    """ Compression of a regular file detected by its magic bytes, None if it isn't compressed """
+    return next((compression for compression in COMPRESSIONS if head.startswith(compression[1])),
+                None)
+
+
+def _inheritable(fd):
+    """ The children read pipes through /dev/fd, subprocess makes its own ones close on exec """
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags & ~fcntl.FD_CLOEXEC)
+
+
+def decompressed(fd, compression):
+    """
+    Stream of the decompressed data of a regular file: the decompressor runs alongside,
+    its output is read as any other stream
+    """
+    name, magic, programs = compression
+    args = next((args for args in programs if which(args[0])), None)
+    if not args:
+        raise TabkitException("No program to decompress %s file '%s', tried %s" % (
+            name, fd.name, ", ".join(args[0] for args in programs)))
+    process = subprocess.Popen(args, stdin=fd, stdout=subprocess.PIPE, close_fds=True,
+                               preexec_fn=_restore_sigpipe)
+    _inheritable(process.stdout)
+    return DecompressedFile(process, fd.name, args[0])
+
+
+class DecompressedFile(StreamFile):
+    """ Output of the decompressor process of a file, see decompressed """
+    def __init__(self, process, name, program):
+        super(DecompressedFile, self).__init__(process.stdout)
+        self.name = name
+        self.process = process
+        self.program = program
+
+    def __iter__(self):
+        return chain(super(DecompressedFile, self).__iter__(), self._waited())
+
+    def _waited(self):
+        self.wait()
+        return
+        yield
+
+    def wait(self):
+        """ Raise if the decompressor failed, the data read so far is then incomplete """
+        # a decompressor left with output nobody reads is done with by SIGPIPE
+        self.fd.close()
+        self.process.stdout.close()
+        code = self.process.wait()
+        if code and code != -signal.SIGPIPE:
+            raise TabkitException("Failed to decompress file '%s', %s exited with code %d" % (
+                self.name, self.program, code))
+
+
+# programs to compress the output with, in order of preference, and their default levels
+COMPRESSORS = {
+    'gzip': ((['pigz', '-c', '-{level}', '-p', '{threads}'], ['gzip', '-c', '-{level}']), 6),
+    'zstd': ((['zstd', '-c', '-q', '-{level}', '-T{threads}'],), 3),
+    'lz4': ((['lz4', '-c', '-q', '-{level}'],), 1),
+}
+
+
+def compressor_args(compression, level=None, threads=None):
+    """
+    >>> compressor_args('zstd', threads=4)
+    ['zstd', '-c', '-q', '-3', '-T4']
+    """
+    programs, default_level = COMPRESSORS[compression]
+    args = next((args for args in programs if which(args[0])), None)
+    if not args:
+        raise TabkitException("No program to compress with %s, tried %s" % (
+            compression, ", ".join(args[0] for args in programs)))
+    level = default_level if level is None else level
+    threads = threads or cpu_count()
+    return [arg.format(level=level, threads=threads) for arg in args]
+
+
+def compress_output(compression, level=None, threads=None):
+    """
+    Pass everything written to the standard output from now on, by us and by the children,
+    through a compressor. The returned function waits for the compressor to finish.
+    """
+    args = compressor_args(compression, level, threads)
+    sys.stdout.flush()
+    process = subprocess.Popen(args, stdin=subprocess.PIPE, close_fds=True,
+                               preexec_fn=_restore_sigpipe)
+    stdout = os.dup(1)
+    os.dup2(process.stdin.fileno(), 1)
+    process.stdin.close()
+
+    def finish():
+        try:
+            sys.stdout.flush()
+        finally:
+            # the compressor sees the end of the input once our end of the pipe is gone
+            os.dup2(stdout, 1)
+            os.close(stdout)
+            process.wait()
+    return finish
+
+
+class CacheFile(File):
+    """
+    Column store made by tcache. The tools get the lines made back of it through a decoder
+    process, of the fields (indices) only if set; the engines read the store itself.
+    """
+    def __init__(self, fd):
+        super(CacheFile, self).__init__(fd)
+        self.store = ColumnStore(fd)
+        self.fields = None
 
     def header(self):
-        return "".join(self._read_header())
+        return str(self.store.data_desc)
+
+    def __iter__(self):
+        return ("%s\n" % line
+                for lines in self.store.line_batches(self.fields) for line in lines)
+
+    def descriptor(self):
+        args = [sys.executable, '-m', 'tabkit.cache']
+        if self.fields is not None:
+            args.append(",".join(str(index) for index in self.fields))
+        env = dict(os.environ)
+        package_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [package_path, env.get('PYTHONPATH')]))
+        process = subprocess.Popen(args, stdin=self.fd, stdout=subprocess.PIPE, close_fds=True,
+                                   env=env, preexec_fn=_restore_sigpipe)
+        _inheritable(process.stdout)
+        self.process = process
+        return "/dev/fd/%d" % process.stdout.fileno()
 
 
 def file_obj(fd):
@@ -49,16 +349,34 @@ def file_obj(fd):
     except IOError:
         return StreamFile(fd)
     else:
+        head = magic(fd)
+        if head.startswith(CACHE_MAGIC):
+            return CacheFile(fd)
+        compressed = compression(head)
+        if compressed:
+            return decompressed(fd, compressed)
         return RegularFile(fd)
 
 
+def _trace_input(f):
+    """ Count the bytes and rows of the file in the trace """
+    if isinstance(f, (CacheFile, RegularFile)):
+        trace.file_input(f.fd)
+    else:
+        # the header isn't read yet, the stream is read through a pump from the start
+        f.fd = trace.stream_input(f.fd)
+
+
 class Files(object):
     def __init__(self, files=None):
         files = files or [sys.stdin]
         self.files = [file_obj(f) for f in files]
+        if trace.tracing():
+            for f in self.files:
+                _trace_input(f)
 
     def __iter__(self):
-        return chain.from_iterable(f.fd for f in self.files)
+        return chain.from_iterable(self.files)
 
     def data_descs(self):
         for f in self.files:
@@ -73,8 +391,8 @@ class Files(object):
             try:
                 this_data_desc = f.data_desc()
                 if data_desc:
-                    # for more than two files being cated together order is meaningless
-                    this_data_desc.order = None
+                    # the files are cated together: the types are generalized and the order
+                    # of a single file is meaningless
                     data_desc = generic_data_desc(data_desc, this_data_desc)
                 else:
                     data_desc = this_data_desc
@@ -82,17 +400,182 @@ class Files(object):
                 raise TabkitException("%s in file '%s'" % (e, f.name))
         return data_desc
 
-    def descriptors(self):
-        return (f.descriptor() for f in self.files)
+    def size(self):
+        """ Size of the data after the headers, None if there are streams among the files """
+        if not all(isinstance(f, RegularFile) for f in self.files):
+            return None
+        return sum(f.size() for f in self.files)
+
+    def chunks(self, count):
+        """
+        Split the data of the files into at most count chunks of about the same size on line
+        boundaries, for parallel processing. A chunk is a list of descriptors of byte ranges
+        of the files, the chunks follow in the input order. Streams can't be split: None.
+        """
+        size = self.size()
+        if size is None:
+            return None
+        chunks = [[] for _ in xrange(count)]
+        base = 0
+        for f in self.files:
+            file_size = f.size()
+            bounds = [min(max(size * n // count - base, 0), file_size) for n in xrange(count + 1)]
+            bounds = [f.line_start(bound) if 0 < bound < file_size else bound for bound in bounds]
+            for chunk, start, end in izip(chunks, bounds, bounds[1:]):
+                if end > start:
+                    chunk.append(f.range_descriptor(start, end - start))
+            base += file_size
+        return [chunk for chunk in chunks if chunk]
+
+    def stdin_file(self):
+        """
+        Regular file to be passed to the child as its standard input. The child then reads
+        it through our descriptor positioned after the header, with no extra process or copy.
+        Only one file can be passed this way, and only if our own stdin isn't needed otherwise.
+        """
+        for f in self.files:
+            if f.fd.fileno() == 0:
+                return f if isinstance(f, RegularFile) and f.offset is not None else None
+        return next(
+            (f for f in self.files if isinstance(f, RegularFile) and f.offset is not None), None)
+
+    def descriptors(self, stdin_file=None, filters=None):
+        """ Arguments naming the files for the child, each filter is a command to pass a file through """
+        filters = filters or [None] * len(self.files)
+        for f, filter_args in izip(self.files, filters):
+            descriptor = "-" if f is stdin_file else f.descriptor()
+            if filter_args:
+                descriptor = "<( LC_ALL=C %s %s )" % (
+                    " ".join(quote(arg) for arg in filter_args), descriptor)
+            yield descriptor
+
+    def call(self, args, filters=None):
+        stdin_file = self.stdin_file()
+        if stdin_file:
+            stdin_file.seek()
+        cmd = shell_command(args, self.descriptors(stdin_file, filters))
+        code = shell_call(cmd, stdin=stdin_file.fd if stdin_file else None)
+        for f in self.files:
+            if isinstance(f, DecompressedFile):
+                f.wait()
+        return code
+
+
+SHELL = ['bash', '-o', 'pipefail', '-o', 'errexit', '-c']
+
+
+def shell_command(args, descriptors=()):
+    """ Command line running args[0] with args[1:] quoted, followed by the file descriptors """
+    return "LC_ALL=C %s" % " ".join(
+        chain(args[:1], (quote(arg) for arg in args[1:]), descriptors))
+
+
+def _restore_sigpipe():
+    # python ignores SIGPIPE, so would a reader cut short like head -c without this
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
+
+def shell_call(cmd, stdin=None):
+    with trace.timed('child'):
+        return subprocess.call(SHELL + [cmd], stdin=stdin, preexec_fn=_restore_sigpipe)
+
+
+def shell_processes(cmds, stdouts):
+    """ Start commands concurrently, each one writing to its own output """
+    return [
+        subprocess.Popen(SHELL + [cmd], stdout=stdout, preexec_fn=_restore_sigpipe)
+        for cmd, stdout in izip(cmds, stdouts)]
 
-    def call(self, args):
-        cmd = (
-            "LC_ALL=C "
-            + args.pop(0)
-            + " " + " ".join(quote(arg) for arg in args)
-            + " " + " ".join(self.descriptors())
-        )
-        subprocess.call(['bash', '-o', 'pipefail', '-o', 'errexit', '-c', cmd])
+
+def shell_calls(cmds, stdouts):
+    """ Run commands concurrently, each one writing to its own output, return the exit codes """
+    with trace.timed('child', len(cmds)):
+        return [process.wait() for process in shell_processes(cmds, stdouts)]
+
+
+def completed(processes):
+    """
+    Yield the processes in the order they exit, their returncode set the way Popen sets it
+
+    >>> [process.returncode for process in completed(shell_processes(["exit 141"], [None]))]
+    [141]
+    """
+    pending = dict((process.pid, process) for process in processes)
+    while pending:
+        pid, status = os.wait()
+        process = pending.pop(pid, None)
+        if process:
+            if os.WIFSIGNALED(status):
+                process.returncode = -os.WTERMSIG(status)
+            else:
+                process.returncode = os.WEXITSTATUS(status)
+            yield process
+
+
+def which(program):
+    """ Full path to the program found in PATH, None if there is no such program """
+    for path in os.environ.get("PATH", os.defpath).split(os.pathsep):
+        candidate = os.path.join(path, program)
+        if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+            return candidate
+    return None
+
+
+def cpu_count():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def available_memory():
+    """ Memory available for new processes in bytes, None if unknown """
+    try:
+        with open("/proc/meminfo") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def human_size(size):
+    """
+    >>> human_size(1536 * 1024 * 1024)
+    '1.5G'
+    >>> human_size(100)
+    '100'
+    """
+    for unit in ('', 'K', 'M', 'G'):
+        if size < 1024:
+            break
+        size /= 1024.
+    else:
+        unit = 'T'
+    return ("%.1f" % size).rstrip("0").rstrip(".") + unit
+
+
+def parse_size(size):
+    """
+    Size in bytes from a number with an optional K, M, G or T suffix
+
+    >>> parse_size("64M")
+    67108864
+    >>> parse_size("100")
+    100
+    """
+    units = "KMGT"
+    number = size.strip().upper()
+    try:
+        if number and number[-1] in units:
+            return int(float(number[:-1]) * 1024 ** (units.index(number[-1]) + 1))
+        return int(number)
+    except ValueError:
+        raise TabkitException("Invalid size '%s'" % size)
 
 
 def xsplit(s, delim="\t"):
@@ -110,6 +593,28 @@ def xsplit(s, delim="\t"):
         start = pos + 1
 
 
+def row_converter(data_desc):
+    r'''
+    Function of a list of field strings returning the tuple of their values, the values of
+    str fields are left as they are. It is compiled once per data_desc.
+
+    >>> from .header import parse_header
+    >>> row_converter(parse_header("# a, b:int, c:float, d:bool"))(['x', '1', '2', '0'])
+    ('x', 1, 2.0, False)
+    '''
+    namespace = {}
+    codes = []
+    for index, field in enumerate(data_desc):
+        if field.type is str:
+            codes.append("values[%d]," % index)
+        else:
+            namespace["convert%d" % index] = field.type
+            codes.append("convert%d(values[%d])," % (index, index))
+    source = "def convert(values):\n    return (%s)\n" % "".join(codes)
+    exec compile(source, "<row_converter>", "exec") in namespace
+    return namespace['convert']
+
+
 class parse_file(object):
     r'''
     >>> from exception import test_exception
@@ -144,35 +649,48 @@ class parse_file(object):
 
     >>> test_exception(lambda: list(parse_file(file, strict=True)))
     doctest: Found 1 columns, whereas 4 columns expected at line 2
+
+    Longer rows are truncated even if strict, unless exact:
+
+    >>> list(parse_file(file[:1] + file[3:4], strict=True))
+    [DataRow(a=1, b=2.0, c='3', d=False)]
+
+    >>> test_exception(lambda: list(parse_file(file[:1] + file[3:], exact=True)))
+    doctest: Found 5 columns, whereas 4 columns expected at line 2
+
+    >>> list(parse_file(file[:1] + file[2:4], tuples=True))
+    [(1, 2.0, '', False), (1, 2.0, '3', False)]
     '''
 
-    def __init__(self, stream, strict=False, data_desc=None):
+    def __init__(self, stream, strict=False, data_desc=None, tuples=False, exact=False):
         stream = iter(stream)
         self.data_desc = data_desc or parse_header(next(stream).rstrip())
 
         def parse():
-            RowClass = self.data_desc.row_class()
+            convert = row_converter(self.data_desc)
+            row_class = None if tuples else self.data_desc.row_class()
+            new_row = tuple.__new__
             rowlen = len(self.data_desc)
+            defaults = tuple(f.type() for f in self.data_desc)
+            lineno = 0
             try:
-                for lineno, line in enumerate(stream):
-                    raw = xsplit(line.rstrip("\n"))
-                    try:
-                        values = [f.type(v) for v, f in izip(raw, self.data_desc)]
-                    except ValueError as e:
-                        raise TabkitException(str(e).capitalize())
-                    if len(values) != rowlen:
-                        if strict:
-                            raise TabkitException(
-                                'Found %d columns, whereas %d columns expected' %
-                                (len(values), rowlen)
-                            )
-                        if len(values) > rowlen:  # truncate if longer
-                            values = values[:rowlen]
-                        if len(values) < rowlen:  # pad if shorter
-                            values += [f.type() for f in self.data_desc.fields[len(values):]]
-                    yield RowClass(*values)
-            except (TabkitException) as e:
-                raise TabkitException('%s at line %d' % (e, lineno + 2))
+                for lineno, line in enumerate(stream, 2):
+                    raw = line.rstrip("\n").split("\t")
+                    if len(raw) == rowlen:
+                        values = convert(raw)
+                    elif exact or strict and len(raw) < rowlen:
+                        raise TabkitException(
+                            'Found %d columns, whereas %d columns expected' % (len(raw), rowlen))
+                    elif len(raw) > rowlen:  # truncate if longer
+                        values = convert(raw[:rowlen])
+                    else:  # pad if shorter
+                        values = tuple(f.type(v) for v, f in izip(raw, self.data_desc))
+                        values += defaults[len(values):]
+                    yield values if tuples else new_row(row_class, values)
+            except ValueError as e:
+                raise TabkitException('%s at line %d' % (str(e).capitalize(), lineno))
+            except TabkitException as e:
+                raise TabkitException('%s at line %d' % (e, lineno))
 
         self._iterator = parse()
 
@@ -183,6 +701,66 @@ class parse_file(object):
         return next(self._iterator)
 
 
+class parse_batches(parse_file):
+    r'''
+    Batches of at most batch_size rows, a batch is a namedtuple of columns: typed columns are
+    numpy arrays if numpy is available (numpy=None) or requested, array.array otherwise,
+    str columns are lists. Columns of numbers too big for an array are lists as well.
+
+    >>> file = ['# a, b:int, c:float, d:bool', 'x\t1\t0.5\t1', 'y\t2', 'z\t3\t1.5\t0']
+    >>> for batch in parse_batches(file, batch_size=2, numpy=False):
+    ...     print batch
+    DataBatch(a=['x', 'y'], b=array('l', [1, 2]), c=array('d', [0.5, 0.0]), d=array('b', [1, 0]))
+    DataBatch(a=['z'], b=array('l', [3]), c=array('d', [1.5]), d=array('b', [0]))
+
+    >>> from exception import test_exception
+    >>> test_exception(lambda: list(parse_batches(file + ['w\tnan'], numpy=False)))
+    doctest: Invalid literal for int() with base 10: 'nan' at line 5
+    '''
+
+    def __init__(self, stream, batch_size=BATCH_SIZE, strict=False, data_desc=None, numpy=None):
+        super(parse_batches, self).__init__(stream, strict, data_desc, tuples=True)
+        rows = self._iterator
+        batch_class = namedtuple('DataBatch', self.data_desc.field_names)
+        builders = [_column_builder(f.type, numpy) for f in self.data_desc]
+
+        def batches():
+            while True:
+                batch = list(islice(rows, batch_size))
+                if not batch:
+                    return
+                yield batch_class._make(
+                    build(column) for build, column in izip(builders, izip(*batch)))
+
+        self._iterator = batches()
+
+
+def _column_builder(type_, numpy=None):
+    """ Function making a column of the type out of a sequence of values """
+    if type_ is str:
+        return list
+    np = None
+    if numpy is not False:
+        try:
+            import numpy as np
+        except ImportError:
+            if numpy:
+                raise TabkitException("numpy is unavailable")
+    if np is not None:
+        dtype = {int: np.int64, float: np.float64}.get(type_, np.bool_)
+        make = lambda column: np.array(column, dtype=dtype)
+    else:
+        typecode = {int: 'l', float: 'd'}.get(type_, 'b')
+        make = lambda column: array(typecode, column)
+
+    def build(column):
+        try:
+            return make(column)
+        except OverflowError:
+            return list(column)
+    return build
+
+
 def _str(value):
     r"""
     >>> _str(True)
@@ -206,6 +784,36 @@ def _str(value):
     return str(value).replace("\n", "\v").replace("\t", "\v")
 
 
+_escape_table = "".join("\v" if c in "\t\n" else c for c in map(chr, xrange(256)))
+
+# code formatting value v of a field of the type as _str does, with a shortcut for the type
+_format_codes = {
+    str: "({v}.translate(_escape_table) if {v}.__class__ is str else _str({v}))",
+    int: "(str({v}) if {v}.__class__ is int else _str({v}))",
+    float: "(str({v}) if {v}.__class__ is float else _str({v}))",
+}
+_bool_format_code = "('1' if {v} is True else '0' if {v} is False else _str({v}))"
+
+
+def row_formatter(data_desc):
+    r"""
+    Function of a row tuple returning its line without the line end, the values are formatted
+    as _str does. It is compiled once per data_desc.
+
+    >>> format_row = row_formatter(parse_header("# a, b:int, c:float, d:bool"))
+    >>> format_row(('x\ty', 1, 0.5, True)), format_row((None, '2', 1, 0))
+    ('x\x0by\t1\t0.5\t1', '\t2\t1\t0')
+    """
+    names = ["v%d" % index for index in xrange(len(data_desc))]
+    codes = [_format_codes.get(field.type, _bool_format_code).format(v=name)
+             for name, field in izip(names, data_desc)]
+    source = "def format_row(row):\n    %s, = row\n    return \"\\t\".join((%s,))\n" % (
+        ", ".join(names), ", ".join(codes))
+    namespace = {'_str': _str, '_escape_table': _escape_table}
+    exec compile(source, "<row_formatter>", "exec") in namespace
+    return namespace['format_row']
+
+
 def Writer(fh, data_desc, strict=False, no_header=False):
     if strict:
         return StrictWriter(fh, data_desc, no_header)
@@ -213,13 +821,48 @@ def Writer(fh, data_desc, strict=False, no_header=False):
         return LooseWriter(fh, data_desc, no_header)
 
 
+# rows formatted and written to the file at once by writerows
+WRITE_BATCH_SIZE = 4096
+
+
 class WriterBase(object):
     def __init__(self, fh, data_desc, no_header=False):
         self.fh = fh
         self.data_desc = data_desc
+        self._format_row = row_formatter(data_desc)
         if not no_header:
             self.fh.write(str(data_desc) + "\n")
 
+    def writerows(self, rows):
+        """ Write rows, tuples of the values of the fields in order, in blocks of lines """
+        rows = iter(rows)
+        while True:
+            batch = list(islice(rows, WRITE_BATCH_SIZE))
+            if not batch:
+                return
+            self.fh.write("%s\n" % "\n".join(self._format_rows(batch)))
+
+    def _format_rows(self, rows):
+        return map(self._format_row, rows)
+
+
+def _check_value(field, value):
+    if isinstance(value, unicode):
+        value = value.encode('utf8')
+    try:
+        field.type(value)
+    except (TypeError, ValueError) as e:
+        raise TabkitException(
+            "Value convertable to type %s expected in field %r, but got %r" %
+            (type_name(field.type), field.name, value))
+
+
+# types of values which are valid for the type of a field as they are
+_valid_types = {
+    int: frozenset([int, long, bool, type(None)]),
+    float: frozenset([float, int, long, bool, type(None)]),
+}
+
 
 class StrictWriter(WriterBase):
     r'''
@@ -239,6 +882,16 @@ class StrictWriter(WriterBase):
     # a:int b       x:bool
       1     banana  0
 
+    >>> write = StrictWriter(StringIO(), parse_header("# a:int, b:str, x:bool"), no_header=True)
+    >>> write.writerows([(2, "apple", True), ("3", u"pear", None)])
+    >>> write.fh.getvalue()
+    '2\tapple\t1\n3\tpear\t\n'
+
+    >>> test_exception(lambda: write.writerows([(1, "a", 1), ("4.5", "b", 0)]))
+    doctest: Value convertable to type int expected in field 'a', but got '4.5'
+
+    >>> test_exception(lambda: write.writerows([(1, "a")]))
+    doctest: Found 2 values, whereas 3 fields expected
     '''
     def _get_values(self, kwargs):
         for field in self.data_desc:
@@ -246,14 +899,7 @@ class StrictWriter(WriterBase):
                 raise TabkitException("Field %r required" % field.name)
             value = kwargs.pop(field.name)
             if value is not None:
-                if isinstance(value, unicode):
-                    value = value.encode('utf8')
-                try:
-                    field.type(value)
-                except (TypeError, ValueError) as e:
-                    raise TabkitException(
-                        "Value convertable to type %s expected in field %r, but got %r" %
-                        (type_name(field.type), field.name, value))
+                _check_value(field, value)
             yield _str(value)
 
     def __call__(self, **kwargs):
@@ -261,6 +907,22 @@ class StrictWriter(WriterBase):
         if kwargs:
             raise TabkitException('Unexpected field %r' % kwargs.keys().pop())
 
+    def _format_rows(self, rows):
+        rowlen = len(self.data_desc)
+        for row in rows:
+            if len(row) != rowlen:
+                raise TabkitException(
+                    'Found %d values, whereas %d fields expected' % (len(row), rowlen))
+        # the columns are checked as a whole, value by value only if there are unusual types
+        for field, column in izip(self.data_desc, izip(*rows)):
+            valid_types = _valid_types.get(field.type)
+            if valid_types is None or valid_types.issuperset(map(type, column)):
+                continue
+            for value in column:
+                if value is not None and type(value) not in valid_types:
+                    _check_value(field, value)
+        return map(self._format_row, rows)
+
 
 class LooseWriter(WriterBase):
     r'''
@@ -275,6 +937,11 @@ class LooseWriter(WriterBase):
       1     banana  0
             10      True
 
+    >>> write = LooseWriter(StringIO(), parse_header("# a:int, b:str, x:bool"), no_header=True)
+    >>> write.writerows([(2, "apple\tpie", True), (None, 7), (3, "cherry", 1, "extra")])
+    >>> write.fh.getvalue()
+    '2\tapple\x0bpie\t1\n\t7\t\n3\tcherry\t1\n'
+
     >>> test_exception(lambda: write(c='True'))
     '''
 
@@ -283,6 +950,14 @@ class LooseWriter(WriterBase):
             _str(kwargs.get(name)) for name in self.data_desc.field_names
         ))
 
+    def _format_rows(self, rows):
+        try:
+            return map(self._format_row, rows)
+        except ValueError:
+            # rows of other lengths are padded with empty values or truncated
+            rowlen = len(self.data_desc)
+            return [self._format_row((tuple(row) + (None,) * rowlen)[:rowlen]) for row in rows]
+
 
 class LogStream(object):
     '''
@@ -299,3 +974,204 @@ class LogStream(object):
 
     def write(self, msg):
         self.handler.emit(logging.makeLogRecord(dict(msg=msg, **self.log_record_args)))
+
+    def flush(self):
+        self.handler.flush()
+
+    def close(self):
+        self.flush()
+
+
+def _lines(text):
+    r'''
+    >>> _lines("a\vb\nc\n"), _lines("a\nb")
+    (['a\x0bb\n', 'c\n'], ['a\n', 'b'])
+    '''
+    lines = text.split("\n")
+    return [line + "\n" for line in lines[:-1]] + ([lines[-1]] if lines[-1] else [])
+
+
+# what AsyncLogStream.write does when the queue is full
+OVERFLOW_POLICIES = ('block', 'drop-oldest', 'drop')
+
+
+class AsyncLogStream(LogStream):
+    r'''
+    LogStream which doesn't emit on the writer's thread: messages are queued and a background
+    thread emits them, packing as many lines as fit in record_size bytes into a record.
+    When the queue is full, write blocks, drops the oldest message or drops the message
+    being written, as overflow says; dropped messages are counted. Call close (or use the
+    stream as a context manager) to emit what is queued.
+
+    >>> class Messages(logging.Handler):
+    ...     messages = []
+    ...     def emit(self, record):
+    ...         self.messages.append(record.getMessage())
+    >>> with AsyncLogStream(Messages(), record_size=10) as stream:
+    ...     LooseWriter(stream, parse_header("# a:int, b"), no_header=True).writerows(
+    ...         [(1, 'x'), (2, 'y'), (3, 'z')])
+    >>> Messages.messages
+    ['1\tx\n2\ty\n', '3\tz\n']
+    >>> stream.messages, stream.dropped, stream.records, stream.bytes
+    (1, 0, 2, 12)
+
+    A failing emit is reported through the handler's handleError and doesn't stop the
+    stream:
+
+    >>> class Failing(Messages):
+    ...     def emit(self, record):
+    ...         if record.getMessage() == 'bad':
+    ...             raise ValueError(record.getMessage())
+    ...         Messages.emit(self, record)
+    ...     def handleError(self, record):
+    ...         self.messages.append('error: ' + record.getMessage())
+    >>> Messages.messages = []
+    >>> with AsyncLogStream(Failing()) as stream:
+    ...     stream.write('bad')
+    ...     stream.flush()
+    ...     stream.write('good')
+    >>> Messages.messages, stream.records, stream.errors
+    (['error: bad', 'good'], 1, 1)
+
+    With the background thread held in emit and a full queue, 'drop' loses the message
+    being written and 'drop-oldest' the one queued first:
+
+    >>> class Held(Messages):
+    ...     def __init__(self):
+    ...         Messages.__init__(self)
+    ...         self.emitting = threading.Event()
+    ...         self.release = threading.Event()
+    ...     def emit(self, record):
+    ...         self.emitting.set()
+    ...         self.release.wait()
+    ...         Messages.emit(self, record)
+    >>> def overflow(policy):
+    ...     Messages.messages = []
+    ...     handler = Held()
+    ...     stream = AsyncLogStream(handler, queue_size=2, overflow=policy)
+    ...     stream.write('a')
+    ...     handler.emitting.wait()
+    ...     for msg in 'bcd':
+    ...         stream.write(msg)
+    ...     handler.release.set()
+    ...     stream.close()
+    ...     return Messages.messages, stream.messages, stream.dropped
+    >>> overflow('drop')
+    (['a', 'bc'], 3, 1)
+    >>> overflow('drop-oldest')
+    (['a', 'cd'], 4, 1)
+    '''
+    _stop = object()
+
+    def __init__(self, handler, queue_size=10000, record_size=8192, overflow='block',
+                 **log_record_args):
+        super(AsyncLogStream, self).__init__(handler, **log_record_args)
+        if overflow not in OVERFLOW_POLICIES:
+            raise TabkitException("Unknown overflow policy '%s'" % overflow)
+        self.record_size = record_size
+        self.overflow = overflow
+        # messages queued and dropped, records and bytes emitted, records failed
+        self.messages = 0
+        self.dropped = 0
+        self.records = 0
+        self.bytes = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._queue = Queue.Queue(queue_size)
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="AsyncLogStream")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, msg):
+        if self._closed:
+            raise TabkitException("Write to a closed log stream")
+        if self.overflow == 'block':
+            self._queue.put(msg)
+        elif self.overflow == 'drop':
+            try:
+                self._queue.put_nowait(msg)
+            except Queue.Full:
+                with self._lock:
+                    self.dropped += 1
+                return
+        else:
+            while True:
+                try:
+                    self._queue.put_nowait(msg)
+                    break
+                except Queue.Full:
+                    try:
+                        self._queue.get_nowait()
+                    except Queue.Empty:
+                        continue
+                    self._queue.task_done()
+                    with self._lock:
+                        self.dropped += 1
+        with self._lock:
+            self.messages += 1
+
+    def _records(self, messages):
+        ''' Texts of the records to emit the messages in, split on line ends '''
+        parts = []
+        size = 0
+        for message in messages:
+            pieces = _lines(message) if len(message) > self.record_size else [message]
+            for piece in pieces:
+                if parts and size + len(piece) > self.record_size:
+                    yield "".join(parts)
+                    parts = []
+                    size = 0
+                parts.append(piece)
+                size += len(piece)
+        if parts:
+            yield "".join(parts)
+
+    def _run(self):
+        while True:
+            messages = [self._queue.get()]
+            # whatever else is queued by now goes along
+            try:
+                while True:
+                    messages.append(self._queue.get_nowait())
+            except Queue.Empty:
+                pass
+            stop = self._stop in messages
+            try:
+                for record in self._records(msg for msg in messages if msg is not self._stop):
+                    self._emit(record)
+            finally:
+                for _ in messages:
+                    self._queue.task_done()
+            if stop:
+                return
+
+    def _emit(self, record):
+        ''' Emit a record; a failure is reported by the handler and the thread goes on '''
+        try:
+            super(AsyncLogStream, self).write(record)
+        except Exception:
+            self.errors += 1
+            self.handler.handleError(
+                logging.makeLogRecord(dict(msg=record, **self.log_record_args)))
+        else:
+            self.records += 1
+            self.bytes += len(record)
+
+    def flush(self):
+        ''' Wait until the messages written so far are emitted '''
+        self._queue.join()
+        super(AsyncLogStream, self).flush()
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._queue.put(self._stop)
+            self._thread.join()
+            super(AsyncLogStream, self).flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -66,6 +66,15 @@ diff -b <(
 EOCASE
 ) || failed cat_from_stream
 
+# cat_wide_header
+diff -b <(
+    ( echo "# $(seq -s ', ' -f 'f%g' 2000)"; seq -s "$(printf '\t')" 2000 ) | run cat | cut -f 1,2000
+) <(cat <<EOCASE
+# f1    f2000
+1   2000
+EOCASE
+) || failed cat_wide_header
+
 # cat_unknow_order_field
 diff -b <(
     echo -e "# a:int, b:float # ORDER: a,b,c" | run cat 2>&1
@@ -107,6 +116,67 @@ diff -b <(
 4   0.4
 EOCASE
 ) || failed cat_from_file
+
+# cat_from_file_stdin
+diff -b <(
+    run cat $temp_file1 - < $temp_file2
+) <(cat <<EOCASE
+# a:int b:float
+1   0.1
+2   0.2
+3   0.3
+4   0.4
+EOCASE
+) || failed cat_from_file_stdin
+
+# cat_from_file_and_stream
+diff -b <(
+    cat $temp_file2 | run cat $temp_file1 - $temp_file1
+) <(cat <<EOCASE
+# a:int b:float
+1   0.1
+2   0.2
+3   0.3
+4   0.4
+1   0.1
+2   0.2
+EOCASE
+) || failed cat_from_file_and_stream
+
+# cat_compressed
+gzip -c $temp_file2 > $temp_file1
+diff -b <(
+    run cat $temp_file1 - < $temp_file1 | run map -o 'a;c=b*10'
+) <(cat <<EOCASE
+# a:int c:float
+3   3
+4   4
+3   3
+4   4
+EOCASE
+) || failed cat_compressed
+tmpdir=$(mktemp -d)
+seq 100000 | cat <(echo "# a:int") - | gzip -c > $tmpdir/data.gz
+head -c 50000 $tmpdir/data.gz > $temp_file1
+rm -r $tmpdir
+diff <(
+    run cat $temp_file1 2>&1 >/dev/null | grep ^cat: | cut -d, -f1
+    run map --engine python -o a $temp_file1 2>&1 >/dev/null | grep ^map: | cut -d, -f1
+) <(cat <<EOCASE
+cat: Failed to decompress file '$temp_file1'
+map: Failed to decompress file '$temp_file1'
+EOCASE
+) || failed cat_compressed_truncated
+
+# cat_compress
+diff -b <(
+    run cat --compress gzip --compress-level 1 $temp_file2 | gzip -dc
+) <(cat <<EOCASE
+# a:int b:float
+3   0.3
+4   0.4
+EOCASE
+) || failed cat_compress
 rm -r $temp_file1 $temp_file2
 trap - EXIT
 
@@ -219,6 +289,73 @@ diff -b <(
 EOCASE
 ) || failed map_log_exp
 
+# map_parallel
+echo -e "# a:int, b # ORDER: a\n1\tx\n2\ty\n3\tx\n4\ty\n5\tx\n6\ty\n7\tx" > $temp_file1
+diff -b <(
+    run map -j 3 -f 'b=="x"' $temp_file1
+) <(cat <<EOCASE
+# a:int b # ORDER: a
+1   x
+3   x
+5   x
+7   x
+EOCASE
+) || failed map_parallel
+
+# map_parallel_unordered
+diff -b <(
+    run map -j 3 --unordered -f 'b=="x"' $temp_file1 | (read header; echo "$header"; sort)
+) <(cat <<EOCASE
+# a:int b
+1   x
+3   x
+5   x
+7   x
+EOCASE
+) || failed map_parallel_unordered
+
+# map_numpy
+if python -c "import numpy" 2>/dev/null; then
+diff -b <(
+    echo -e "# a, b:int, c:float\nx\t1\t0.5\ny\t07\t2\nz\tabc\t-1.25\nw\t\t3" \
+        | run map --engine numpy -f 'b>0 or a=="z"' -o 'a;b;d=b*c/3;e=b>=c;s=sprintf("%05.1f", c)'
+) <(cat <<EOCASE
+# a b:int   d:float e:bool  s
+x   1   0.166667    1   000.5
+y   07  4.66667 1   002.0
+z   abc 0   1   -01.2
+EOCASE
+) || failed map_numpy
+
+# map_numpy_short_circuit
+diff <(
+    echo -e "# a\n1\n0\n1e400" | run map --engine numpy -f 'a>0 and 1/a>=0' -o 'x=sprintf("%d",a)'
+) <(echo -e "# x\n1\n2147483647") || failed map_numpy_short_circuit
+fi
+
+
+# map_python
+diff -b <(
+    echo -e "# a, b:int, c:float\nx\t1\t0.5\ny\t07\t2\nz\tabc\t-1.25\nw\t\t3" \
+        | run map --engine python -f 'b>0 or a=="z"' -o 'a;b;d=b*c/3;e=b>=c;s=sprintf("%05.1f", c)'
+) <(cat <<EOCASE
+# a b:int   d:float e:bool  s
+x   1   0.166667    1   000.5
+y   07  4.66667 1   002.0
+z   abc 0   1   -01.2
+EOCASE
+) || failed map_python
+
+# map_python_filter
+diff <(
+    echo -e "# a, b\nx\t1\ny\nz\t3\tmore" | run map --engine python -f 'b!=1'
+) <(echo -e "# a\tb\ny\nz\t3\tmore") || failed map_python_filter
+
+# map_python_short_circuit
+diff <(
+    echo -e "# a\n1\n0\n1e400" | run map --engine python -f 'a>0 and 1/a>=0' -o 'x=sprintf("%d",a)'
+) <(echo -e "# x\n1\n2147483647") || failed map_python_short_circuit
+
 
 ###### tgrp_awk
 
@@ -360,6 +497,156 @@ EOCASE
 ) || failed grp_cumsum
 
 
+# grp_hash
+
+diff -b <(
+cat <<EOINPUT | run group --hash -g a -o 'cnt=count();sum=sum(x);min=min(x);max=max(x)'
+# a, x:int
+foo	3
+bar	4
+foo	1
+baz	2
+bar	6
+foo	5
+EOINPUT
+) <(cat <<EOCASE
+# a	cnt:int	sum:int	min:int	max:int
+foo	3	9	1	5
+bar	2	10	4	6
+baz	1	2	2	2
+EOCASE
+) || failed grp_hash
+
+
+# grp_hash_spill
+
+diff -b <(
+cat <<EOINPUT | run group --hash -S 1K -g a -o 'cnt=count();max=max(x);all=group_concat(x)'
+# a, x:int
+foo	3
+bar	4
+foo	1
+baz	2
+bar	6
+foo	5
+EOINPUT
+) <(cat <<EOCASE
+# a	cnt:int	max:int	all
+bar	2	6	4, 6
+baz	1	2	2
+foo	3	5	3, 1, 5
+EOCASE
+) || failed grp_hash_spill
+
+spill_dir=$(mktemp -d)
+mkdir "$spill_dir/back\\tslash"
+diff -b <(
+    echo -e "# a\nfoo\nbar\nfoo\nbaz\nbar" |
+    run group --hash -S 1K -T "$spill_dir/back\\tslash" -g a -o 'cnt=count()'
+) <(echo -e "# a\tcnt:int\nbar\t2\nbaz\t1\nfoo\t2") || failed grp_hash_spill_backslash
+rm -r $spill_dir
+
+# the spilled sums are passed at full precision
+diff <(
+    echo -e "# a, x\nfoo\t1234567.5\nbar\t1\nbaz\t1\nfoo\t1234567.5" | run group --hash -S 1 -g a -o 'sum=sum(x)'
+) <(echo -e "# a\tsum\nbar\t1\nbaz\t1\nfoo\t2469135") || failed grp_hash_spill_precision
+
+
+# grp_parallel
+
+echo -e "# a, x:int\nbar\t1\nbar\t2\nbaz\t3\nfoo\t4\nfoo\t5" > $temp_file1
+echo -e "# a, x:int\nfoo\t6\nfoo\t7\nqux\t8" > $temp_file2
+diff -b <(
+    run group -j 4 -g a -o 'cnt=count();max=max(x);all=group_concat(x)' $temp_file1 $temp_file2
+) <(cat <<EOCASE
+# a	cnt:int	max:int	all
+bar	2	2	1, 2
+baz	1	3	3
+foo	4	7	4, 5, 6, 7
+qux	1	8	8
+EOCASE
+) || failed grp_parallel
+
+
+# grp_parallel_hash
+
+echo -e "# a, x:int\nfoo\t4\nbar\t1\nfoo\t5\nbaz\t3\nbar\t2\nfoo\t6" > $temp_file1
+diff -b <(
+    run group --hash -j 3 -g a -o 'cnt=count();min=min(x);all=group_concat(x)' $temp_file1
+) <(cat <<EOCASE
+# a	cnt:int	min:int	all
+foo	3	4	4, 5, 6
+bar	2	1	1, 2
+baz	1	3	3
+EOCASE
+) || failed grp_parallel_hash
+
+# the partial sums are passed at full precision
+echo -e "# a, x\nfoo\t1234567.5\nfoo\t1234567.5\nbar\t1234567.5\nbar\t2.5" > $temp_file1
+diff <(
+    run group -j 4 -g a -o 'n=count();sum=sum(x)' $temp_file1
+) <(
+    run group -j 1 -g a -o 'n=count();sum=sum(x)' $temp_file1
+) || failed grp_parallel_precision
+
+
+# grp_numpy
+if python -c "import numpy" 2>/dev/null; then
+diff -b <(
+cat <<EOINPUT | run group --engine numpy -g a -o 'cnt=count();sum=sum(x);min=min(x);max=max(x);cum=cumsum(x)'
+# a, x:int
+bar	3
+bar	04
+bar	6
+foo	1
+foo	2
+EOINPUT
+) <(cat <<EOCASE
+# a	cnt:int	sum:int	min:int	max:int	cum:int
+bar	3	13	3	6	13
+foo	2	3	1	2	16
+EOCASE
+) || failed grp_numpy
+fi
+
+
+###### tpipe
+
+# pipe_map_cut_group
+diff -b <(
+cat <<EOINPUT | run pipe 'map -f paid -o "fruit;qty;paid;double=qty*2"' 'cut -r paid' 'group -g fruit -o "x=sum(double);n=count()"'
+# fruit, qty:int, paid:bool
+apple	10	1
+apple	7	0
+apple	1	1
+orange	3	1
+orange	18	0
+EOINPUT
+) <(cat <<EOCASE
+# fruit	x:int	n:int
+apple	22	2
+orange	6	1
+EOCASE
+) || failed pipe_map_cut_group
+
+# pipe_keep_order
+diff -b <(
+    echo -e "# a, b, c # ORDER: a, b\n1\t2\t3\n4\t5\t6" | run pipe 'map -f "c>3"' 'cut -f a,c'
+) <(cat <<EOCASE
+# a c # ORDER: a
+4   6
+EOCASE
+) || failed pipe_keep_order
+
+# pipe_group_last
+diff -b <(
+    echo -e "# a" | run pipe 'group -o "n=count()"' 'cut -f n' 2>&1
+) <(cat <<EOCASE
+pipe: Group stage must be the last one
+EOCASE
+) || failed pipe_group_last
+
+
 ###### tsrt
 
 # sort_num
@@ -385,6 +672,82 @@ EOCASE
 ) || failed sort_generic
 
 
+# sort_plan
+diff -b <(
+    echo -e "# a, b\na\t10\na\t2\nb\t3" | run sort -k b:num --parallel 2 -S 1M --compress-program none
+) <(cat <<EOCASE
+# a b # ORDER: b:num
+a  2
+b  3
+a  10
+EOCASE
+) || failed sort_plan
+
+# sort_plan_verbose
+diff -b <(
+    echo -e "# a" | run sort --parallel 2 -S 1M -T /tmp --compress-program gzip -v 2>&1 >/dev/null | cut -d'(' -f1
+) <(cat <<EOCASE
+Sort plan: parallel 2, buffer size 1M, temporary directory /tmp, compress program gzip
+EOCASE
+) || failed sort_plan_verbose
+
+
+# sort_merge
+diff -b <(
+    run sort -k a:num -v <(
+        echo -e "# a, b # ORDER: a:num, b\n1\tx\n3\tx\n10\tx"
+    ) <(
+        echo -e "# a, b # ORDER: a:num\n2\ty\n3\ty\n4\ty"
+    ) 2>&1 | cut -d, -f1
+) <(cat <<EOCASE
+Sort plan: merge of 2 sorted inputs
+# a b # ORDER: a:num
+1   x
+2   y
+3   x
+3   y
+4   y
+10  x
+EOCASE
+) || failed sort_merge
+
+
+# sort_elide
+diff -b <(
+    echo -e "# a, b # ORDER: a, b:num\nb\t2\na\t1" | run sort -k a -v 2>&1
+) <(cat <<EOCASE
+Sort plan: input is already sorted, pass through
+# a b # ORDER: a
+b   2
+a   1
+EOCASE
+) || failed sort_elide
+
+# sort_runs
+diff -b <(
+    echo -e "# a, b, c # ORDER: a\na\t10\tx\na\t9\tz\na\t9\ty\nb\t1\tx\nb\t2\tx" | run sort -k a,b:num:desc,c -v 2>&1
+) <(cat <<EOCASE
+Sort plan: input is sorted by a, sort runs of equal keys
+# a b c # ORDER: a, b:num:desc, c
+a   10  x
+a   9   y
+a   9   z
+b   2   x
+b   1   x
+EOCASE
+) || failed sort_runs
+
+# sort_tab_separated
+diff -b <(
+    echo -e "# a, b\na\tz\na c\tb" | run sort -k b
+) <(cat <<EOCASE
+# a b # ORDER: b
+a c b
+a   z
+EOCASE
+) || failed sort_tab_separated
+
+
 ###### tpretty
 
 # pretty
@@ -400,6 +763,30 @@ diff -b <(
 EOCASE
 ) || failed pretty
 
+# pretty_exact
+echo -e "# a, b:int\nx\t1\ny\t2\nlonger than the preread\t3" > $temp_file1
+diff -b <(
+    python -mtabkit.scripts pretty -x -n 1 $temp_file1
+) <( cat <<EOCASE
+ a                       | b:int
+-------------------------+-------
+ x                       | 1
+ y                       | 2
+ longer than the preread | 3
+EOCASE
+) || failed pretty_exact
+
+# pretty_limit
+diff -b <(
+    (echo "# a"; yes) | python -mtabkit.scripts pretty -l 2
+) <( cat <<EOCASE
+ a
+---
+ y
+ y
+EOCASE
+) || failed pretty_limit
+
 
 ###### tjoin
 
@@ -509,4 +896,149 @@ diff -b <(
 2   orange  -
 4   -   purple
 EOCASE
-) || failed join_v_generic_key
\ No newline at end of file
+) || failed join_v_generic_key
+
+# join_hash
+diff -b <(
+    python -mtabkit.scripts join --hash -1 id -2 ID -a1 -e- <(
+        echo -e "# id:int, fruit # ORDER: fruit\n1\tapple\n3\tcucumber\n2\torange\n1\tpomegranate"
+    ) <(
+        echo -e "# ID, color\n3\tgreen\n1\tred\nfoo\tpurple\n1\truby"
+    )
+) <( cat <<EOCASE
+# id:int    fruit   color # ORDER: fruit
+1   apple       red
+1   apple       ruby
+3   cucumber    green
+2   orange      -
+1   pomegranate red
+1   pomegranate ruby
+EOCASE
+) || failed join_hash
+
+# join_hash_unpairable_hashed
+diff -b <(
+    python -mtabkit.scripts join --hash -1 id -2 ID -a2 -e- <(
+        echo -e "# id:int, fruit # ORDER: fruit\n1\tapple\n3\tcucumber\n2\torange"
+    ) <(
+        echo -e "# ID, color\n3\tgreen\n1\tred\nfoo\tpurple"
+    )
+) <( cat <<EOCASE
+# id    fruit   color
+1   apple       red
+3   cucumber    green
+foo -           purple
+EOCASE
+) || failed join_hash_unpairable_hashed
+
+# join_auto_sort
+diff -b <(
+    python -mtabkit.scripts join --auto-sort -1 id -2 ID -a1 -e- <(
+        echo -e "# id:int, fruit # ORDER: fruit\n1\tapple\n3\tcucumber\n2\torange\n1\tpomegranate"
+    ) <(
+        echo -e "# ID, color # ORDER: ID\n1\tred\n1\truby\n3\tgreen\nfoo\tpurple"
+    )
+) <( cat <<EOCASE
+# id:int    fruit   color # ORDER: id, fruit
+1   apple       red
+1   apple       ruby
+1   pomegranate red
+1   pomegranate ruby
+2   orange      -
+3   cucumber    green
+EOCASE
+) || failed join_auto_sort
+
+# cache
+tmpdir=$(mktemp -d)
+echo -e "# k, n:int, x:float, s\na\t1\t0.5\tfoo\nb\t02\t1.5\tbar\na\t3\t2.5\na\t4\t3.5\tfoo\tbaz" > $tmpdir/data.tsv
+python -mtabkit.scripts cache $tmpdir/data.tsv -o $tmpdir/data.tc
+diff <(python -mtabkit.scripts cat $tmpdir/data.tc) <( cat <<EOCASE
+# k	n:int	x:float	s
+a	1	0.5	foo
+b	02	1.5	bar
+a	3	2.5	
+a	4	3.5	foo
+EOCASE
+) || failed cache_cat
+diff <(python -mtabkit.scripts cut -f s,n $tmpdir/data.tc) <( cat <<EOCASE
+# n:int	s
+1	foo
+02	bar
+3	
+4	foo
+EOCASE
+) || failed cache_cut
+diff <(python -mtabkit.scripts map --engine python -f 'n>1' -o 'k;y=n*x' $tmpdir/data.tc) \
+    <(python -mtabkit.scripts map -f 'n>1' -o 'k;y=n*x' $tmpdir/data.tsv) || failed cache_map
+diff <(python -mtabkit.scripts sort -k n:num:desc $tmpdir/data.tc) \
+    <(python -mtabkit.scripts cat $tmpdir/data.tc | python -mtabkit.scripts sort -k n:num:desc) || failed cache_sort
+diff <(cat $tmpdir/data.tc | python -mtabkit.scripts cat 2>&1) \
+    <(echo "cat: Column store read from a stream, pass it as a file in file '<stdin>'") || failed cache_stream
+rm -r $tmpdir
+
+# lookup
+tmpdir=$(mktemp -d)
+echo -e "# k, n:int # ORDER: k, n:num:desc\na\t2\nb\t10\nb\t9\nb\t9\nc\t5\nd\t1" > $tmpdir/data.tsv
+python -mtabkit.scripts index -s 2 $tmpdir/data.tsv
+diff <(
+    python -mtabkit.scripts lookup -k b -k $'c\t5' -k x $tmpdir/data.tsv
+    python -mtabkit.scripts lookup -N --from $'b\t9' --to c $tmpdir/data.tsv
+) <( cat <<EOCASE
+# k	n:int	# ORDER: k, n:num:desc
+b	10
+b	9
+b	9
+c	5
+b	9
+b	9
+c	5
+EOCASE
+) || failed lookup
+[ -f $tmpdir/data.tsv.tidx ] || failed lookup_index
+seq 200000 | sed 's/^/b\t/' | cat <(echo -e "# k, n:int # ORDER: k") - > $tmpdir/long.tsv
+diff <(
+    python -mtabkit.scripts lookup -N -k b $tmpdir/long.tsv 2>$tmpdir/stderr | head -1
+    cat $tmpdir/stderr
+) <(echo -e "b\t1") || failed lookup_pipe
+rm -r $tmpdir
+
+# map_awk_override
+diff <(
+    echo -e "# a\n2\n3" | TABKIT_AWK="awk -v unused=1" python -mtabkit.scripts map -o "z=a**3"
+) <(echo -e "# z:int\n8\n27") || failed map_awk_override
+
+# map_awk_numbers
+diff <(
+    echo -e "# a\n3000000000\n0.5\n1e17" | run map -o "x=a*1;y=a"
+) <(
+    echo -e "# a\n3000000000\n0.5\n1e17" | run map --engine python -o "x=a*1;y=a"
+) || failed map_awk_numbers
+
+# trace
+tmpdir=$(mktemp -d)
+echo -e "# a:int, b\n1\tx\n2\ty\n3\tz" > $tmpdir/data.tsv
+diff <(
+    TABKIT_TRACE=$tmpdir/trace.tsv python -mtabkit.scripts cat $tmpdir/data.tsv
+    cat $tmpdir/data.tsv | python -mtabkit.scripts map -o "a;c=a*2" --trace $tmpdir/trace.tsv
+    python -mtabkit.scripts map -j 2 -N -o "a" --trace $tmpdir/trace.tsv $tmpdir/data.tsv
+    python -mtabkit.scripts cut -f tool,children,input_bytes,input_rows,output_rows $tmpdir/trace.tsv
+) <( cat <<EOCASE
+# a:int	b
+1	x
+2	y
+3	z
+# a:int	c:int
+1	2
+2	4
+3	6
+1
+2
+3
+# tool	children:int	input_bytes:int	input_rows:int	output_rows:int
+cat	1	23		3
+map	1	23	3	3
+map	2	23		3
+EOCASE
+) || failed trace
+rm -r $tmpdir
@@ -3,11 +3,24 @@
 import tabkit.exception
 import tabkit.header
 import tabkit.scripts
+import tabkit.sort
 import tabkit.type
 import tabkit.utils
 import tabkit.awk
 import tabkit.awk.map
 import tabkit.awk.group
+import tabkit.awk.join
+import tabkit.awk.implementations
+import tabkit.trace
+import tabkit.engine.generator
+import tabkit.engine.scalar
+import tabkit.cache
+import tabkit.index
+
+try:
+    import tabkit.engine.columnar as columnar
+except ImportError:  # numpy is optional
+    columnar = None
 
 
 if __name__ == '__main__':
@@ -15,8 +28,18 @@ if __name__ == '__main__':
     doctest.testmod(tabkit.exception)
     doctest.testmod(tabkit.header)
     doctest.testmod(tabkit.scripts)
+    doctest.testmod(tabkit.sort)
     doctest.testmod(tabkit.type)
     doctest.testmod(tabkit.utils)
     doctest.testmod(tabkit.awk)
     doctest.testmod(tabkit.awk.map)
     doctest.testmod(tabkit.awk.group)
+    doctest.testmod(tabkit.awk.join)
+    doctest.testmod(tabkit.awk.implementations)
+    doctest.testmod(tabkit.trace)
+    doctest.testmod(tabkit.engine.generator)
+    doctest.testmod(tabkit.engine.scalar)
+    doctest.testmod(tabkit.cache)
+    doctest.testmod(tabkit.index)
+    if columnar:
+        doctest.testmod(columnar)